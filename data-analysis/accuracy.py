@@ -3,20 +3,35 @@
 # https://github.com/Elsklivet
 
 import os
+import io
+import sys
 import argparse
-import termcolor
 import time
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import math
-from pyproj import Geod
-from random import uniform
+import tracemalloc
+from datetime import datetime, timezone
 
-# from pyproj import CRS, Transformer
-from shapely.geometry import Point, LineString
-import pandas as pd
+import numpy as np
 import geopandas as gpd
 from geopandas import GeoDataFrame
 from matplotlib import pyplot as plt
+from projection import LocalProjection, haversine, nearest
+from align import align, band, band_path_cost, synchronize
+from reader import read_ride, read_header, iter_ride, open_log, has_fix, prefetch
+from deadreckon import RECKON_COLUMNS, Track, dead_reckon
+from motion import segment_track
+from policy import Replay, parse_policies
+from reference import ReferenceTrack
+
+import cache
+import catalog
+import instrument
+import log
+from instrument import span, count
+from log import Log
 
 arg_parser = argparse.ArgumentParser(
     description="Commit sensitivity analysis about the azimuth-trigger parameter for TrackCycle.",
@@ -32,7 +47,9 @@ arg_parser.add_argument(
     "-b",
     "--back",
     type=str,
-    help="input file path from which to read BASELINE or DUTY-CYCLED sensor data",
+    nargs="+",
+    help="input file path(s) from which to read BASELINE or DUTY-CYCLED sensor data; with several, each is compared "
+    "against one indexed copy of the --there ride",
 )
 arg_parser.add_argument(
     "-d",
@@ -40,6 +57,88 @@ arg_parser.add_argument(
     type=int,
     help="debug level (0=no debugging (default), 1=debugging on)",
 )
+arg_parser.add_argument(
+    "-p",
+    "--projection",
+    type=str,
+    choices=["utm", "enu"],
+    default="utm",
+    help="local metric frame used for distance computations (default: utm)",
+)
+arg_parser.add_argument(
+    "-m",
+    "--match",
+    type=str,
+    choices=["nearest", "dtw", "frechet", "time"],
+    default="nearest",
+    help="how points are paired up: spatially nearest, an ordered DTW / discrete Frechet alignment, or by timestamp (default: nearest)",
+)
+arg_parser.add_argument(
+    "--band",
+    type=float,
+    default=60.0,
+    help="with --match dtw/frechet, how many seconds either side of its own place in the ride a point may be matched (default: 60)",
+)
+arg_parser.add_argument(
+    "-e",
+    "--estimate",
+    type=str,
+    choices=["line", "reckon"],
+    default="line",
+    help="how the BASELINE/DUTY-CYCLED ride is filled in between fixes: straight lines, or dead reckoning from the sensors (default: line)",
+)
+arg_parser.add_argument(
+    "--max-gap",
+    type=float,
+    default=10.0,
+    help="with --match time, the longest gap in seconds between reference fixes to interpolate across (default: 10)",
+)
+arg_parser.add_argument(
+    "--bin",
+    type=float,
+    default=5.0,
+    help="with --match time, width in seconds of the time-since-GPS-off buckets in the error breakdown; with several "
+    "--back files and --intervals, of the interval-duration buckets (default: 5)",
+)
+arg_parser.add_argument(
+    "--intervals",
+    action="store_true",
+    help="also report the error of every GPS-off interval of the duty-cycled ride on its own: duration, max "
+    "deviation and how fast the error grew",
+)
+arg_parser.add_argument(
+    "--schedule",
+    type=str,
+    help="take the GPS-off intervals from replaying this policy (see policy.py) over the duty-cycled log instead of "
+    "its GPS STOPPED/STARTED markers; fixes the GPS wouldn't have had are dropped before filling in",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+arg_parser.add_argument(
+    "--float32",
+    action="store_true",
+    help="store the sensor readings kept with each fix (azimuth, current, elevation) as float32",
+)
+arg_parser.add_argument(
+    "--collapse-stationary",
+    action="store_true",
+    help="collapse each stretch where a ride was stopped to a single point before matching (see motion.py)",
+)
+arg_parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    help="with several --back files, how many are compared at once (default: one per core)",
+)
+arg_parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=2,
+    help="with several --back files compared one at a time, how many of the next ones to parse in the background "
+    "(default: 2)",
+)
+cache.add_arguments(arg_parser)
+catalog.add_arguments(arg_parser, "--back files")
 
 args = None
 debug = False
@@ -60,177 +159,499 @@ debug = False
 # 90  |  1.570796
 # 180 |  3.141593 (pi)
 
-TTFS = 3000  # This actually could be anywhere from 1000 to 15000 :)
-GPS_START_TIME = 14000
-GPS_CYCLE_SAVE_THRESHOLD = 10000
-GPS_CYCLE_OFF_TIME = GPS_START_TIME + GPS_CYCLE_SAVE_THRESHOLD
-LINES_PER_SECOND = 90  # It is around this number, not exactly 90
-NUM_PTS_TO_AVG = 500
-
-
-class Log:
-    def error(msg: str):
-        level = termcolor.colored(f"ERROR", "red")
-        print(f"[ {level} ] {msg}")
-
-    def warning(msg: str):
-        level = termcolor.colored(f"WARNING", "yellow")
-        print(f"[ {level} ] {msg}")
-
-    def ok(msg: str):
-        level = termcolor.colored(f"OK", "green")
-        print(f"[ {level} ] {msg}")
-
-    def info(msg: str):
-        print(f"[ INFO ] {msg}")
-        
-def parse_line_strava(line: str):
-    # 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16
-    # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current
-    vals = line.split(",")
-    ret = None
-    try:
-        ret = {
-            "lat": float(vals[2]),
-            "lon": float(vals[3]),
-            "ele": float(vals[0]),
-            "time": int(vals[1].split("T")[1].split(":")[0]),
-        }
-    except IndexError:
-        ret = {"lat": float(vals[0]), "lon": float(vals[1]), "ele": float(vals[0])}
-    finally:
-        if not ret:
-            raise Exception("Returned a none value from parse")
-        return ret
+# Log columns a fix is built from
+FIX_COLUMNS = ["lat", "lon", "azimuth", "time", "current"]
 
 
-def parse_line(line: str):
-    # 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16
-    # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current
+def strava_time(stamp: str) -> int:
+    # Strava exports UTC ISO-8601 times ("2022-10-22T14:26:28Z"); TrackCycle
+    # logs epoch milliseconds, so convert to that to compare the two.
+    when = datetime.strptime(stamp.strip(), "%Y-%m-%dT%H:%M:%SZ")
+    return int(when.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def parse_line_strava(line: str) -> tuple:
+    # ele,time,lat,lon -> (lat, lon, time, ele)
     vals = line.split(",")
-    ret = None
     try:
-        ret = {
-            "lat": float(vals[0]),
-            "lon": float(vals[1]),
-            "azimuth": float(vals[11]),
-            "time": int(vals[14]),
-            "curr": int(vals[16]),
-        }
+        return float(vals[2]), float(vals[3]), strava_time(vals[1]), float(vals[0])
     except IndexError:
-        ret = {"lat": float(vals[0]), "lon": float(vals[1]), "azimuth": float(vals[11])}
-    finally:
-        if not ret:
-            raise Exception("Returned a none value from parse")
-        return ret
+        return float(vals[0]), float(vals[1]), 0, float(vals[0])
+
+
+def fix_dtype(sensor=np.float64) -> np.dtype:
+    # One record per GPS fix. Positions and times always keep full precision;
+    # the readings carried along with a fix (azimuth, current, and elevation
+    # for Strava) can be stored as float32.
+    return np.dtype(
+        [
+            ("lat", np.float64),
+            ("lon", np.float64),
+            ("time", np.int64),
+            ("x", np.float64),
+            ("y", np.float64),
+            ("azimuth", sensor),
+            ("curr", sensor),
+            ("ele", sensor),
+        ]
+    )
 
 
-def read_and_parse(path: str, queue: multiprocessing.Queue, mode: str):
+def new_fixes(lat: np.ndarray, lon: np.ndarray, last):
+    # The sensors collect several tens of times per second, and the GPS won't
+    # change in that time, so only rows where the position moved are kept.
+    # (0, 0) means no fix yet. The first fix of a ride only seeds `last`.
+    # Returns the kept rows and the last position seen, to carry into the
+    # next chunk.
+    valid = np.flatnonzero((lat != 0) | (lon != 0))
+    if not len(valid):
+        return valid, last
+    vlat, vlon = lat[valid], lon[valid]
+    first = (vlat[0], vlon[0]) if last is None else last
+    moved = np.empty(len(valid), dtype=bool)
+    moved[0] = (vlat[0], vlon[0]) != first
+    moved[1:] = (vlat[1:] != vlat[:-1]) | (vlon[1:] != vlon[:-1])
+    return valid[moved], (vlat[-1], vlon[-1])
+
+
+def parse_strava(infile, dtype: np.dtype) -> np.ndarray:
+    # Strava exports are one line a second, small enough to take in one go
+    rows = [parse_line_strava(line) for line in infile if line.strip()]
+    values = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    keep, _ = new_fixes(values[:, 0], values[:, 1], None)
+    fixes = np.zeros(len(keep), dtype=dtype)
+    fixes["lat"] = values[keep, 0]
+    fixes["lon"] = values[keep, 1]
+    fixes["time"] = values[keep, 2]
+    fixes["ele"] = values[keep, 3]
+    return fixes
+
+
+def parse_trackcycle(path: str, dtype: np.dtype) -> np.ndarray:
+    # Stream the log through the reader a small range at a time and keep
+    # only the fixes, so the whole file is never held in memory
+    parts, last = [], None
+    for ride in iter_ride(path, columns=FIX_COLUMNS, where=has_fix):
+        if "lon" not in ride:
+            continue
+        keep, last = new_fixes(ride["lat"], ride["lon"], last)
+        part = np.zeros(len(keep), dtype=dtype)
+        for field, column in (("lat", "lat"), ("lon", "lon"), ("azimuth", "azimuth"), ("time", "time"), ("curr", "current")):
+            if column in ride:
+                part[field] = ride[column][keep]
+        parts.append(part)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+
+def strava_export(first: str) -> bool:
+    # Going by its first line: Strava exports usually have an "s" line in
+    # front of their own column-header row
+    return first.startswith("s") or first.startswith("ele,time")
+
+
+def parse_file(path: str, dtype: np.dtype = None) -> np.ndarray:
+    # A couple special cases that need skipped by the processor:
+    #  *  The first line in each file is the column-header row (Strava
+    #     exports usually have an "s" line in front of it)
+    #  *  Any lines starting with "--" represent special markers for some of the other analyzers
+    if dtype is None:
+        dtype = fix_dtype()
+    with io.TextIOWrapper(open_log(path)) as infile:
+        first = infile.readline()
+        if strava_export(first):
+            if first.startswith("s"):
+                infile.readline()
+            return parse_strava(infile, dtype)
+    return parse_trackcycle(path, dtype)
+
+
+def read_and_parse(path: str, queue: multiprocessing.Queue, mode: str, sensor=np.float64, trace_memory: bool = False):
+    # The parse's peak memory is only measured with --trace-memory, since
+    # tracemalloc slows the parse down several times over
     start = time.time()
-    isStrava = 0
     Log.info(f"Begins processing '{path}'")
-    lines = []
+    if trace_memory:
+        tracemalloc.start()
     try:
-        with open(path, "r") as infile:
-            last_lat = last_lon = None
-            for idx, line in enumerate(infile.readlines()):
-                # A couple special cases that need skipped by the processor:
-                #  *  The first line in each file is the column-header row
-                #  *  Any lines starting with "--" represent special markers for some of the other analyzers
-                #  *  The sensors collect several tens of times per second, and the GPS won't change in that time,
-                #     so we can significantly save on space (and make our calculations easier) by skipping repeats.
-                if idx == 0 and line.startswith("s"):
-                    isStrava = 1
-                    continue
-                elif idx == 0:
-                    continue
-                elif idx == 1 and isStrava == 1:
-                    continue
-                elif line.startswith("--"):
-                    continue
-
-                if isStrava == 1:
-                    data = parse_line_strava(line)
-                else:
-                    data = parse_line(line)
-
-                if data["lat"] == 0 and data["lon"] == 0:
-                    continue
-
-                if not last_lat and not last_lon:
-                    # Initialize if not exists
-                    last_lat = data["lat"]
-                    last_lon = data["lon"]
-                elif data["lat"] == last_lat and data["lon"] == last_lon:
-                    # Skip if the data for this line is the same as the last
-                    # collected data
-                    continue
-                else:
-                    # Append the data otherwise
-                    last_lat = data["lat"]
-                    last_lon = data["lon"]
-                    lines.append(data)
+        fixes = parse_file(path, fix_dtype(sensor))
     except Exception:
         Log.error(f"Failed to parse file '{path}'")
         return
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
     end = time.time()
     Log.ok(f"Finished processing '{path}' in {end-start} seconds")
-    queue.put((mode, lines))
-    
-
-# haversine alpha = hav(delta lat) + cos(lat1) * cos(lat1) * hav(delta lon)
-# where hav(x) = sin^2(x/2)
-# geodesic distance = 2 * radius_earth * arctan(sqrt(alpha), sqrt(1-alpha))
-# Formula source: https://en.wikipedia.org/wiki/Haversine_formula#Formulation
-def hav(theta: float):
-    theta = math.radians(theta)
-    return math.sin(theta / 2) ** 2
-
-
-def alpha(coord1: tuple, coord2: tuple):
-    # (lat, lon)
-    delta_latitude = coord2[0] - coord1[0]
-    delta_longitude = coord2[1] - coord1[1]
-    
-    return (
-        hav(delta_latitude) 
-        + math.cos(math.radians(coord1[0])) 
-        * math.cos(math.radians(coord2[0]))
-        * hav(delta_longitude)
+    if peak is None:
+        Log.info(f"'{path}': {len(fixes)} fixes in {fixes.nbytes} bytes")
+    else:
+        Log.info(f"'{path}': {len(fixes)} fixes in {fixes.nbytes} bytes, {peak} bytes at peak while parsing")
+    queue.put((mode, fixes, peak))
+    # Spawned readers exit without running atexit hooks
+    Log.flush()
+
+
+def project_points(points: np.ndarray, proj: LocalProjection):
+    # Store projected coordinates on the fixes so they are computed exactly once
+    points["x"], points["y"] = proj.forward(points["lat"], points["lon"])
+
+
+def interpolate_gaps(points: np.ndarray, proj: LocalProjection, keep_current: bool, track: Track = None) -> np.ndarray:
+    # Wherever consecutive points are more than a second apart, fill in one
+    # point per second, then map the new points back to lat/lon for plotting.
+    # The new points go along the straight line between the two fixes in the
+    # projected frame, or along the dead-reckoned track if one is given.
+    n = len(points)
+    gap = np.zeros(n, dtype=np.int64)
+    if n > 1:
+        seconds = np.abs(np.diff(points["time"])) / 1000
+        gap[:-1] = np.where(seconds > 1, seconds, 0).astype(np.int64)
+    Log.trace("Detected %d time gaps", np.count_nonzero(gap))
+    # Fix k moves down by the number of points added in front of it
+    before = np.cumsum(gap) - gap
+    filled = np.zeros(n + int(gap.sum()), dtype=points.dtype)
+    filled[np.arange(n) + before] = points
+
+    src = np.repeat(np.arange(n), gap)
+    seconds = np.arange(len(src)) - before[src] + 1
+    frac = seconds / (gap[src] + 1)
+    times = points["time"][src] + seconds * 1000
+    if track is not None:
+        xs, ys = track.at(times)
+    else:
+        x, y = points["x"], points["y"]
+        xs = x[src] + (x[src + 1] - x[src]) * frac
+        ys = y[src] + (y[src + 1] - y[src]) * frac
+    added = src + before[src] + seconds
+    filled["time"][added] = times
+    filled["x"][added] = xs
+    filled["y"][added] = ys
+    filled["lat"][added], filled["lon"][added] = proj.inverse(xs, ys)
+    if keep_current:
+        filled["curr"][added] = points["curr"][src]
+    return filled
+
+
+def reckoned_track(path: str, proj: LocalProjection):
+    # Dead-reckoned path of a TrackCycle log, or None if it can't be built
+    # (Strava exports, or logs without timestamps / enough fixes)
+    try:
+        return dead_reckon(read_ride(path, columns=RECKON_COLUMNS), proj)
+    except ValueError as err:
+        Log.warning(f"Can't dead reckon '{path}', falling back to straight lines: {err}")
+        return None
+
+
+def collapse_stationary(points: np.ndarray, label: str) -> np.ndarray:
+    # Keep only the first point of every stop. Points may be in either time
+    # order; they stay in the order they came in.
+    order = np.argsort(points["time"], kind="stable")
+    with span("segment"):
+        segments = segment_track(points["time"][order], points["x"][order], points["y"][order])
+    keep = np.sort(order[segments.collapsed()])
+    Log.info(
+        f"Collapsed {int((~segments.moving).sum())} stops in the {label} ride, "
+        f"dropping {len(points) - len(keep)} of {len(points)} points"
     )
-    
-
-def geodesic_distance(coord1: tuple, coord2: tuple):
-    # Inspired by https://janakiev.com/blog/gps-points-distance-python/
-    # Reference [1]
-    
-    # Approximate average Earth radius
-    earth_radius = 6372800
-    
-    alph = alpha(coord1, coord2)
-
-    return (
-        2 * 
-        earth_radius * 
-        math.atan2(
-            math.sqrt(alph), 
-            math.sqrt(1 - alph)
+    return points[keep]
+
+
+def align_rides(query: np.ndarray, reference: np.ndarray, metric: str, width: float):
+    # Align in riding order, trying the reference both forwards and backwards
+    # (the "back" half of an out-and-back). Both are bounded from the start
+    # by the cheaper of the two band-middle paths, the direction with the
+    # lower bound goes first, and the other is abandoned as soon as it can
+    # no longer beat it.
+    qx, qy, qt = query["x"], query["y"], query["time"]
+    tries = []
+    for backwards in (False, True):
+        ref = reference[::-1] if backwards else reference
+        # Negated times keep the reversed clock increasing for the band
+        rt = -ref["time"] if backwards else ref["time"]
+        lo, hi = band(qt, rt, width)
+        bound = band_path_cost(qx, qy, ref["x"], ref["y"], lo, hi, metric)
+        tries.append((bound, backwards, ref, lo, hi))
+    limit = min(bound for bound, _, _, _, _ in tries)
+    best, flipped = None, False
+    for _, backwards, ref, lo, hi in sorted(tries, key=lambda t: t[0]):
+        result = align(qx, qy, ref["x"], ref["y"], lo, hi, metric, limit=best.cost if best else limit)
+        if result is None:
+            Log.debug("Abandoned the %s alignment", "reversed" if backwards else "forward")
+            continue
+        Log.debug("%s alignment cost %s over %d cells", "Reversed" if backwards else "Forward", result.cost, result.cells)
+        if best is None or result.cost < best.cost:
+            best, flipped = result, backwards
+    return best, flipped
+
+
+class Windows:
+    """
+    Interval index of when the GPS was off: window k runs from start[k] up
+    to, not including, end[k] (ms). Windows are sorted and don't overlap,
+    so finding the window of any number of times is one binary search over
+    the starts.
+    """
+
+    __slots__ = ("start", "end")
+
+    def __init__(self, start, end):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.minimum(np.asarray(end, dtype=np.float64), np.append(self.start[1:], np.inf))
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def find(self, times) -> np.ndarray:
+        # Window holding each time, -1 while the GPS was on
+        times = np.asarray(times, dtype=np.float64)
+        k = np.searchsorted(self.start, times, side="right") - 1
+        off = k >= 0
+        off[off] = times[off] < self.end[k[off]]
+        return np.where(off, k, -1)
+
+    def since(self, times) -> np.ndarray:
+        # Seconds since the GPS went off for each time, NaN while it was on
+        times = np.asarray(times, dtype=np.float64)
+        k = self.find(times)
+        off = k >= 0
+        since = np.full(len(times), np.nan)
+        since[off] = (times[off] - self.start[k[off]]) / 1000
+        return since
+
+
+def gps_off_windows(path: str, fix_times: list) -> Windows:
+    # When the GPS was off: from each GPS STOPPED marker up to the first fix
+    # once it was STARTED again (or just the first fix after the stop, for
+    # logs without STARTED markers). Logs without markers or a time column
+    # fall back to every gap of more than a second between consecutive fixes.
+    fix_times = np.asarray(fix_times, dtype=np.float64)
+    stopped = started = np.empty(0)
+    ride = None
+    try:
+        # Strava exports have neither markers nor a numeric time column
+        if not strava_export(read_header(path)[0]):
+            ride = read_ride(path, workers=1, columns=["time"])
+    except ValueError:
+        pass
+    if ride is not None and "time" in ride and len(ride):
+        # A marker sits in front of the row it precedes; use that row's time
+        rows = np.minimum(ride.markers("GPS STOPPED"), len(ride) - 1)
+        stopped = np.sort(ride["time"][rows])
+        rows = np.minimum(ride.markers("GPS STARTED"), len(ride) - 1)
+        started = np.sort(ride["time"][rows])
+    if len(stopped):
+        back_on = stopped
+        if len(started):
+            back_on = np.append(started, np.inf)[np.searchsorted(started, stopped, side="left")]
+        after = np.searchsorted(fix_times, back_on, side="right")
+        ends = np.append(fix_times, np.inf)[after]
+        return Windows(stopped, ends)
+    gaps = np.flatnonzero(np.diff(fix_times) > 1000)
+    return Windows(fix_times[gaps], fix_times[gaps + 1])
+
+
+def scheduled_off_windows(path: str, spec: str) -> Windows:
+    # When a GPS duty-cycled by the policy in `spec` would have been off
+    # over this log, see Replay.off_windows
+    policies = parse_policies(spec)
+    if len(policies) != 1:
+        raise ValueError(f"--schedule takes a single policy, '{spec}' gives {len(policies)}")
+    replay = Replay(policies)
+    with span("schedule"):
+        replay.feed(read_ride(path, columns=replay.columns()))
+    starts, ends = replay.off_windows()
+    Log.info(f"{policies[0].label()} switches the GPS off {len(starts)} times")
+    return Windows(starts, ends)
+
+
+def off_windows(path: str, fix_times, options) -> Windows:
+    # The GPS-off windows a comparison needs, or None if it needs none
+    if options.schedule:
+        return scheduled_off_windows(path, options.schedule)
+    if options.match == "time" or options.intervals:
+        return gps_off_windows(path, fix_times)
+    return None
+
+
+def scheduled_fixes(fixes: np.ndarray, windows: Windows) -> np.ndarray:
+    # The fixes a GPS following the schedule would still have delivered
+    keep = windows.find(fixes["time"]) < 0
+    count("fixes scheduled out", int((~keep).sum()))
+    kept = fixes[keep]
+    if not len(kept):
+        raise ValueError("The schedule leaves the duty-cycled ride without fixes")
+    return kept
+
+
+def interval_errors(windows: Windows, times, distances) -> dict:
+    """
+    Error figures of every GPS-off window that has compared points in it:
+    when it started (s into the ride), how long it lasted (s), the mean and
+    maximum distance (m) and the error growth (m/s), the least-squares
+    slope of distance against time since the GPS went off. Every figure is
+    a bincount over the windows' points, so this is linear in the points
+    however many windows there are. Lists, so the result can be cached.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    k = windows.find(times)
+    off = k >= 0
+    k, t, d = k[off], (times[off] - windows.start[k[off]]) / 1000, distances[off]
+    size = len(windows)
+    n = np.bincount(k, minlength=size)
+    st = np.bincount(k, t, minlength=size)
+    sd = np.bincount(k, d, minlength=size)
+    stt = np.bincount(k, t * t, minlength=size)
+    std = np.bincount(k, t * d, minlength=size)
+    biggest = np.zeros(size)
+    np.maximum.at(biggest, k, d)
+    last = np.zeros(size)
+    np.maximum.at(last, k, t)
+
+    used = np.flatnonzero(n)
+    n, st, sd, stt, std = n[used], st[used], sd[used], stt[used], std[used]
+    # A window still open when the ride ended lasted until its last point
+    seconds = (windows.end[used] - windows.start[used]) / 1000
+    seconds = np.where(np.isfinite(seconds), seconds, last[used])
+    spread = n * stt - st * st
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = np.where(spread > 0, (n * std - st * sd) / spread, np.nan)
+    origin = times.min() if len(times) else 0.0
+    return {
+        "windows": size,
+        "at": ((windows.start[used] - origin) / 1000).tolist(),
+        "seconds": seconds.tolist(),
+        "points": n.tolist(),
+        "mean": (sd / n).tolist(),
+        "max": biggest[used].tolist(),
+        "growth": [None if np.isnan(g) else float(g) for g in growth],
+    }
+
+
+def print_intervals(intervals: dict):
+    Log.flush()
+    print("=" * 72)
+    print(f"Error per GPS-off interval ({len(intervals['at'])} of {intervals['windows']} had points to compare)")
+    print("-" * 72)
+    print(f"{'at (s)':>10} {'seconds':>9} {'points':>8} {'mean (m)':>10} {'max (m)':>10} {'growth (m/s)':>13}")
+    for at, seconds, n, mean, biggest, growth in zip(
+        intervals["at"], intervals["seconds"], intervals["points"], intervals["mean"], intervals["max"], intervals["growth"]
+    ):
+        rate = "-" if growth is None else f"{growth:.3f}"
+        print(f"{at:>10.0f} {seconds:>9.1f} {n:>8} {mean:>10.2f} {biggest:>10.2f} {rate:>13}")
+    print("=" * 72)
+
+
+def interval_table(results: dict, paths: list) -> dict:
+    # Every ride's per-interval figures as one set of arrays, plus the ride
+    # each interval came from
+    names = ("seconds", "points", "mean", "max", "growth")
+    columns = {name: [] for name in names}
+    ride = []
+    for i, path in enumerate(paths):
+        intervals = (results.get(path) or {}).get("intervals")
+        if not intervals:
+            continue
+        for name in names:
+            columns[name].extend(intervals[name])
+        ride.extend([i] * len(intervals["at"]))
+    table = {name: np.array(values, dtype=np.float64) for name, values in columns.items()}
+    table["ride"] = np.array(ride, dtype=np.int64)
+    return table
+
+
+def print_interval_summary(results: dict, paths: list, width: float):
+    # The GPS-off intervals of all the rides together: per ride, then by
+    # how long the GPS stayed off
+    table = interval_table(results, paths)
+    if not len(table["ride"]):
+        return
+
+    def row(label: str, keep) -> str:
+        n = int(keep.sum())
+        if not n:
+            return f"{label:<{name_width}} {0:>9}"
+        growth = table["growth"][keep]
+        growth = growth[~np.isnan(growth)]
+        rate = f"{growth.mean():.3f}" if len(growth) else "-"
+        biggest = table["max"][keep]
+        return (
+            f"{label:<{name_width}} {n:>9} {table['seconds'][keep].sum():>10.0f} {np.median(biggest):>12.2f} "
+            f"{biggest.max():>10.2f} {rate:>13}"
         )
-    )
 
+    name_width = max([len(path) for path in paths] + [12])
+    line = "=" * (name_width + 60)
+    Log.flush()
+    print(line)
+    print("GPS-off intervals over all rides")
+    print("-" * len(line))
+    print(f"{'ride':<{name_width}} {'intervals':>9} {'s off':>10} {'median max':>12} {'max (m)':>10} {'growth (m/s)':>13}")
+    for i, path in enumerate(paths):
+        if results.get(path) is not None:
+            print(row(path, table["ride"] == i))
+    print(row("all", np.ones(len(table["ride"]), dtype=bool)))
+    print("-" * len(line))
+    buckets = np.floor(table["seconds"] / width).astype(np.int64)
+    for bucket in np.unique(buckets):
+        print(row(f"{bucket * width:g}-{(bucket + 1) * width:g} s off", buckets == bucket))
+    print(line)
+
+
+def off_time_errors(since, distances, width: float) -> list:
+    # [label, points, mean, rmse, median, max] per bucket of time since the
+    # GPS went off, GPS-on points first
+    on = np.isnan(since)
+    buckets = np.floor(since[~on] / width).astype(np.int64)
+    groups = [("GPS on", distances[on])]
+    off = distances[~on]
+    for bucket in np.unique(buckets):
+        label = f"{bucket * width:g}-{(bucket + 1) * width:g}"
+        groups.append((label, off[buckets == bucket]))
+    rows = []
+    for label, values in groups:
+        if not len(values):
+            rows.append([label, 0, None, None, None, None])
+            continue
+        rows.append(
+            [
+                label,
+                len(values),
+                float(values.mean()),
+                math.sqrt(float((values * values).mean())),
+                float(np.median(values)),
+                float(values.max()),
+            ]
+        )
+    return rows
+
+
+def print_off_time_errors(rows: list):
+    Log.flush()
+    print("=" * 72)
+    print("Error by time since the GPS was switched off")
+    print("-" * 72)
+    print(f"{'seconds off':<16} {'points':>8} {'mean (m)':>10} {'rmse (m)':>10} {'median (m)':>11} {'max (m)':>10}")
+    for label, n, mean, rmse, median, biggest in rows:
+        if not n:
+            print(f"{label:<16} {0:>8}")
+            continue
+        print(f"{label:<16} {n:>8} {mean:>10.2f} {rmse:>10.2f} {median:>11.2f} {biggest:>10.2f}")
+    print("=" * 72)
 
 
 def main():
     global args
     global debug
-    global TTFS
-    global GPS_START_TIME
-    global GPS_CYCLE_SAVE_THRESHOLD
-    global GPS_CYCLE_OFF_TIM
-    global LINES_PER_SECOND
-    global NUM_PTS_TO_AVG
 
     args = arg_parser.parse_args()
+    instrument.configure(args)
+
+    try:
+        args.back = (args.back or []) + catalog.selected(args)
+    except ValueError as err:
+        Log.error(str(err))
+        exit(1)
 
     if not args.there or not args.back:
         arg_parser.print_help()
@@ -244,11 +665,11 @@ def main():
         )
         exit(2)
 
-    cycled_path = args.back
-
-    if not os.path.exists(cycled_path):
-        Log.error(f"File (--back) '{cycled_path}' was inaccessible or does not exist")
-        exit(2)
+    for cycled_path in args.back:
+        if not os.path.exists(cycled_path):
+            Log.error(f"File (--back) '{cycled_path}' was inaccessible or does not exist")
+            exit(2)
+    cycled_path = args.back[0]
 
     if args.debug:
         if args.debug != 0 and args.debug != 1:
@@ -257,50 +678,144 @@ def main():
             )
         else:
             debug = args.debug == 1
+    log.configure(args, debug)
+
+    store = cache.configure(args)
+    sensor = np.float32 if args.float32 else np.float64
+    if len(args.back) > 1:
+        compare_many(alwayson_path, args.back, Options.from_args(args), store, args.prefetch, sensor, args.workers)
+        return
+
+    key = None
+    if store:
+        with span("cache"):
+            params = Options.from_args(args).to_dict()
+            key = store.key("accuracy", [alwayson_path, cycled_path], params, code_files())
+            result = cached_result(store, key)
+        if result is not None:
+            Log.ok(f"Using the cached comparison of '{alwayson_path}' and '{cycled_path}'")
+            report(result)
+            plot(result)
+            return
 
     # Need to come up with some way to read files of a different size as well as backwards and just "guess"?
 
     context = multiprocessing.get_context("spawn")
     queue = context.Queue()
     there_proc = multiprocessing.Process(
-        target=read_and_parse, args=(alwayson_path, queue, "there")
+        target=read_and_parse, args=(alwayson_path, queue, "there", sensor, args.trace_memory)
     )
     back_proc = multiprocessing.Process(
-        target=read_and_parse, args=(cycled_path, queue, "back")
+        target=read_and_parse, args=(cycled_path, queue, "back", sensor, args.trace_memory)
     )
 
-    there_proc.start()
-    back_proc.start()
+    with span("read"):
+        there_proc.start()
+        back_proc.start()
 
-    response = []
-    response.append(queue.get())
-    response.append(queue.get())
+        response = []
+        response.append(queue.get())
+        response.append(queue.get())
 
-    there_proc.join()
-    back_proc.join()
+        there_proc.join()
+        back_proc.join()
 
     there = back = None
 
-    for res in response:
-        if res[0] == "there":
-            there = res[1]
+    for mode, fixes, peak in response:
+        if peak is not None:
+            count(f"{mode} parse peak bytes", peak)
+        if mode == "there":
+            there = fixes
         else:
-            back = res[1]
-
-    # print(there[0])
-    # print(back[0])
+            back = fixes
 
-    if not there or type(there) != list:
-        Log.error(f"Respone 'there' was somehow not a list")
+    if there is None or not len(there):
+        Log.error(f"Response 'there' had no fixes")
         exit(3)
-    if not back or type(back) != list:
-        Log.error(f"Respone 'back' was somehow not a list")
+    if back is None or not len(back):
+        Log.error(f"Response 'back' had no fixes")
         exit(3)
 
-    # Now we have to process those points
-
     start = time.time()
+    try:
+        result = evaluate(there, back, cycled_path, Options.from_args(args))
+    except ValueError as err:
+        Log.error(str(err))
+        exit(3)
+    end = time.time()
+    Log.ok(f"Finished processing in {end-start} seconds")
+    if store:
+        cache_result(store, key, result)
+    report(result)
+    plot(result)
+
+
+class Options:
+    # How two rides are compared; the defaults are the command line's
+    __slots__ = (
+        "projection",
+        "match",
+        "band",
+        "estimate",
+        "max_gap",
+        "bin",
+        "collapse_stationary",
+        "intervals",
+        "schedule",
+    )
 
+    def __init__(
+        self,
+        projection: str = "utm",
+        match: str = "nearest",
+        band: float = 60.0,
+        estimate: str = "line",
+        max_gap: float = 10.0,
+        bin: float = 5.0,
+        collapse_stationary: bool = False,
+        intervals: bool = False,
+        schedule: str = None,
+    ):
+        self.projection = projection
+        self.match = match
+        self.band = band
+        self.estimate = estimate
+        self.max_gap = max_gap
+        self.bin = bin
+        self.collapse_stationary = collapse_stationary
+        self.intervals = intervals
+        self.schedule = schedule
+
+    @staticmethod
+    def from_args(args) -> "Options":
+        return Options(**{name: getattr(args, name) for name in Options.__slots__})
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def compare(there_path: str, back_path: str, options: Options = None, sensor=np.float64) -> dict:
+    # Parse both logs in this process and evaluate() them
+    there = parse_file(there_path, fix_dtype(sensor))
+    back = parse_file(back_path, fix_dtype(sensor))
+    if not len(there) or not len(back):
+        raise ValueError("One of the rides had no fixes")
+    return evaluate(there, back, back_path, options)
+
+
+def evaluate(there: np.ndarray, back: np.ndarray, cycled_path: str, options: Options = None) -> dict:
+    """
+    Compare the fixes of an always-on ride (there) against a duty-cycled
+    one (back) and return the error figures. cycled_path is re-read for
+    dead reckoning and the GPS off windows. The fix arrays are written to
+    (projected x/y), so pass copies to keep the originals. Raises
+    ValueError if the rides can't be compared.
+    """
+    options = options or Options()
+    windows = off_windows(cycled_path, back["time"], options)
+    if options.schedule:
+        back = scheduled_fixes(back, windows)
     # Need lengths of arrays for clamping
     there_len = len(there)
     back_len = len(back)
@@ -311,243 +826,423 @@ def main():
     # Difference in duration is important for determining interpolation
     diff = abs(there_len - back_len)
 
-    if debug:
-        Log.info(f"Length of first trip={there_len}")
-        Log.info(f"Length of back trip={back_len}")
-        Log.info(
+    if Log.enabled():
+        Log.debug(f"Length of first trip={there_len}")
+        Log.debug(f"Length of back trip={back_len}")
+        Log.debug(
             f"Duration difference of {abs(there_duration-back_duration)/1000} s with first trip={there_duration/1000} s and back={back_duration/1000} s"
         )
-        dis = geodesic_distance(
-            (there[0]["lat"], there[0]["lon"]), (back[-1]["lat"], back[-1]["lon"])
+        dis = haversine(there[0]["lat"], there[0]["lon"], back[-1]["lat"], back[-1]["lon"])
+        Log.debug(f"Distance between initial points of {dis} meters")
+
+    # Project both rides once into a shared local metric frame. Everything
+    # below (interpolation, nearest-neighbour matching) is then plain
+    # Euclidean arithmetic on the cached x/y values.
+    count("fixes", there_len + back_len)
+    with span("project"):
+        proj = LocalProjection(
+            np.concatenate((there["lat"], back["lat"])),
+            np.concatenate((there["lon"], back["lon"])),
+            mode=options.projection,
         )
-        Log.info(f"Distance between initial points of {dis} meters")
-
-    geoid = Geod(ellps="WGS84")
-
-    # Begin by interpolating shorter list to be size of longer list
-    if there_len < back_len:
-        # First array is shorter
-        idx = 0
-        while idx < len(there):
-            # current = there[idx]["curr"]
-            curr_time = there[idx]["time"]
-            next_time = None
-            if idx + 1 < len(there):
-                next_time = there[idx + 1]["time"]
-            if next_time:
-                time_diff = abs(next_time - curr_time)
-                time_diff /= 1000
-                if debug:
-                    Log.info(f"Time difference of {time_diff}")
-                if time_diff > 1:
-                    if debug:
-                        Log.info(f"Detected time difference")
-                    # Longer than one second in between, interpolate here
-                    # start_point = Point(there[idx]['lat'], there[idx]['lon'])
-                    # end_point = Point(there[idx+1]['lat'], there[idx+1]['lon'])
-                    # line = LineString([start_point, end_point])
-                    points = geoid.npts(
-                        there[idx]["lat"],
-                        there[idx]["lon"],
-                        there[idx + 1]["lat"],
-                        there[idx + 1]["lon"],
-                        time_diff,
-                    )
-                    if debug:
-                        Log.info(
-                            f"Initial point = {(there[idx]['lat'], there[idx]['lon'])}"
-                        )
-                        Log.info(f"{points}")
-                        Log.info(
-                            f"Final point = {(there[idx+1]['lat'], there[idx+1]['lon'])}"
-                        )
-                    seconds = 1
-                    for point in points:
-                        inst = {
-                            "lat": point[0],
-                            "lon": point[1],
-                            "azimuth": 0,
-                            "time": curr_time + seconds * 1000,
-                            "curr": 0,
-                        }
-                        there.insert(idx + 1, inst)
-                        idx += 1
-                        seconds += 1
-            idx += 1
-
-        there.reverse()
-
-        # if len(there) < len(back):
-        #     idx = len(there) - 1
-        #     diff = len(back) - len(there)
-        #     points = geoid.npts(there[idx]['lat'], there[idx]['lon'], back[-1]['lat'], back[-1]['lon'], diff)
-        #     if debug:
-        #         Log.info(f"Initial point = {(there[idx]['lat'], there[idx]['lon'])}")
-        #         Log.info(f"{points}")
-        #         Log.info(f"Final point = {(back[-1]['lat'], back[-1]['lon'])}")
-        #     seconds = 1
-        #     for point in points:
-        #         inst = {'lat': point[0], 'lon':point[1], "azimuth":0, "time": curr_time + seconds*1000, "curr": current}
-        #         there.insert(idx+1, inst)
-        #         idx += 1
-
-    elif back_len < there_len:
-        # Second array is shorter
-        idx = 0
-        while idx < len(back):
-            current = back[idx]["curr"]
-            curr_time = back[idx]["time"]
-            next_time = None
-            if idx + 1 < len(back):
-                next_time = back[idx + 1]["time"]
-            if next_time:
-                time_diff = abs(next_time - curr_time)
-                time_diff /= 1000
-                if debug:
-                    Log.info(f"Time difference of {time_diff}")
-                if time_diff > 1:
-                    if debug:
-                        Log.info(f"Detected time difference")
-                    # Longer than one second in between, interpolate here
-                    points = geoid.npts(
-                        back[idx]["lat"],
-                        back[idx]["lon"],
-                        back[idx + 1]["lat"],
-                        back[idx + 1]["lon"],
-                        time_diff,
-                    )
-                    if debug:
-                        Log.info(
-                            f"Initial point = {(back[idx]['lat'], back[idx]['lon'])}"
-                        )
-                        Log.info(f"{points}")
-                        Log.info(
-                            f"Final point = {(back[idx+1]['lat'], back[idx+1]['lon'])}"
-                        )
-                    seconds = 1
-                    for point in points:
-                        inst = {
-                            "lat": point[0],
-                            "lon": point[1],
-                            "azimuth": 0,
-                            "time": curr_time + seconds * 1000,
-                            "curr": current,
-                        }
-                        back.insert(idx + 1, inst)
-                        idx += 1
-                        seconds += 1
-
-            idx += 1
-
-        back.reverse()
-
-        # if len(back) < len(there):
-        #     idx = len(back) - 1
-        #     diff = len(there) - len(back)
-        #     points = geoid.npts(back[idx]['lat'], back[idx]['lon'], there[-1]['lat'], there[-1]['lon'], diff)
-        #     if debug:
-        #         Log.info(f"Initial point = {(back[idx]['lat'], back[idx]['lon'])}")
-        #         Log.info(f"{points}")
-        #         Log.info(f"Final point = {(there[-1]['lat'], there[-1]['lon'])}")
-        #     seconds = 1
-        #     for point in points:
-        #         inst = {'lat': point[0], 'lon':point[1], "azimuth":0, "time": curr_time + seconds*1000, "curr": current}
-        #         back.insert(idx+1, inst)
-        #         idx += 1
-
-    # In the rare occasion they are of equal length, nothing can safely be interpolated.
-    if debug:
-        Log.info(f"There preview {there[-5:]}")
-        Log.info(f"Back preview {back[-5:]}")
-        Log.info(f"Length of there = {len(there)}")
-        Log.info(f"Length of back = {len(back)}")
-    if len(there) != len(back):
-        Log.error("Lengths not equal")
+        Log.debug("Using %s", proj)
+        project_points(there, proj)
+        project_points(back, proj)
+
+    track = None
+    if options.estimate == "reckon":
+        with span("reckon"):
+            track = reckoned_track(cycled_path, proj)
+
+    if options.match == "nearest":
+        # Begin by interpolating shorter list to be size of longer list
+        with span("interpolate"):
+            if there_len < back_len:
+                # First array is shorter
+                there = interpolate_gaps(there, proj, keep_current=False)[::-1]
+            elif back_len < there_len:
+                # Second array is shorter
+                back = interpolate_gaps(back, proj, keep_current=True, track=track)[::-1]
+        count("interpolated points", len(there) + len(back) - there_len - back_len)
+
+        # In the rare occasion they are of equal length, nothing can safely be interpolated.
+        if Log.enabled():
+            Log.debug(f"There preview {there[-5:]}")
+            Log.debug(f"Back preview {back[-5:]}")
+            Log.debug(f"Length of there = {len(there)}")
+            Log.debug(f"Length of back = {len(back)}")
+        if len(there) != len(back):
+            Log.error("Lengths not equal")
+
+        # Not even sure how to do this
+        if len(back) < len(there):
+            # Clamp to way back
+            query, reference = back, there
+        else:
+            # Clamp to way there
+            query, reference = there, back
+            if options.intervals:
+                Log.warning("The always-on ride is the query here, so there are no GPS-off intervals to report")
+            windows = None
+        if options.collapse_stationary:
+            query = collapse_stationary(query, "query")
+            reference = collapse_stationary(reference, "reference")
+
+        with span("match"):
+            distances, matches = nearest(query["x"], query["y"], reference["x"], reference["y"])
+        query_idx = np.arange(len(query))
+        count("distance evaluations", len(query) * len(reference))
+    elif options.match in ("dtw", "frechet"):
+        # Ordered alignment: both rides are filled in to one point a second
+        # and kept in riding order, so a point can't be matched to the wrong leg
+        # of an out-and-back route.
+        with span("interpolate"):
+            there = interpolate_gaps(there, proj, keep_current=False)
+            back = interpolate_gaps(back, proj, keep_current=True, track=track)
+        count("interpolated points", len(there) + len(back) - there_len - back_len)
+        query, reference = back, there
+        if options.collapse_stationary:
+            query = collapse_stationary(query, "query")
+            reference = collapse_stationary(reference, "reference")
+        with span("match"):
+            alignment, flipped = align_rides(query, reference, options.match, options.band)
+        if alignment is None:
+            raise ValueError("Could not align the two rides inside the band, try a wider --band")
+        if flipped:
+            Log.info("The rides were ridden in opposite directions")
+            reference = reference[::-1]
+        query_idx, matches, distances = alignment.query, alignment.reference, alignment.distances
+        count("distance evaluations", alignment.cells)
+    else:
+        # Time-synchronized: compare each duty-cycled position (real fix or
+        # estimate) against where the reference was at that same instant.
+        with span("interpolate"):
+            back = interpolate_gaps(back, proj, keep_current=True, track=track)
+        count("interpolated points", len(back) - back_len)
+        query, reference = back, there
+        if options.collapse_stationary:
+            # The reference stays whole so every instant can still be looked up
+            query = collapse_stationary(query, "query")
+        with span("match"):
+            sync_x, sync_y = synchronize(
+                query["time"],
+                reference["time"],
+                reference["x"],
+                reference["y"],
+                max_gap=options.max_gap * 1000,
+            )
+        query_idx = np.flatnonzero(~np.isnan(sync_x))
+        if not len(query_idx):
+            raise ValueError("The rides don't overlap in time, nothing to compare")
+        distances = np.hypot(
+            query["x"][query_idx] - sync_x[query_idx],
+            query["y"][query_idx] - sync_y[query_idx],
+        )
+        ref_lat, ref_lon = proj.inverse(sync_x[query_idx], sync_y[query_idx])
+        count("distance evaluations", len(query_idx))
+        Log.info(f"{len(query_idx)} of {len(query)} points overlap the reference in time")
+
+    if Log.enabled():
+        for dist in distances:
+            Log.trace("Distance of %s", dist)
+
+    if options.match != "time":
+        ref_lat = reference["lat"][matches]
+        ref_lon = reference["lon"][matches]
+    result = figures(distances, query, query_idx, ref_lat, ref_lon, windows, options)
+    # Just what the map needs, so a cached result can still be plotted
+    result["there"] = {"lat": there["lat"], "lon": there["lon"]}
+    result["back"] = {"lat": back["lat"], "lon": back["lon"]}
+    return result
+
+
+def figures(distances, query, query_idx, ref_lat, ref_lon, windows: Windows, options: Options) -> dict:
+    # Error statistics of query[query_idx] against the matched reference
+    # positions. When the query is the duty-cycled ride, `windows` are its
+    # GPS-off windows, for the breakdown by time since the GPS went off
+    # (matching by time) and the figures per interval (options.intervals).
+
     # Root mean squared error
     # RMSE = sqrt( ( sum( (predicted - actual)^2 ) ) / n )
-    rmse = 0
-    avg_dist = 0
-    n = 0
-    distances = []
-
-    # Not even sure how to do this
-    if len(back) < len(there):
-        # Clamp to way back
-
-        for back_point in back:
-            diffs = []
-            for there_point in there:
-                dis = geodesic_distance(
-                    (there_point["lat"], there_point["lon"]),
-                    (back_point["lat"], back_point["lon"]),
-                )
-                diffs.append(dis)
-            dist = min(diffs)
-            distances.append(min(diffs))
-            if debug:
-                Log.info(f"Distance of {dist}")
-            avg_dist += dist
-            rmse += dist * dist
-            n += 1
+    n = len(distances)
+    rmse = math.sqrt(float((distances * distances).sum()) / n)
+    avg_dist = float(distances.sum()) / n
+    median = float(np.median(distances))
+
+    # How far off is the flat-earth figure from the spherical one for the pairs we matched?
+    spherical = haversine(query["lat"][query_idx], query["lon"][query_idx], ref_lat, ref_lon)
+    proj_error = np.abs(distances - spherical)
+
+    breakdown = intervals = None
+    if windows is not None:
+        times = query["time"][query_idx].astype(np.float64)
+        if options.match == "time":
+            with span("breakdown"):
+                breakdown = off_time_errors(windows.since(times), distances, options.bin)
+        if options.intervals:
+            with span("intervals"):
+                intervals = interval_errors(windows, times, distances)
+
+    return {
+        "rmse": rmse,
+        "min": float(distances.min()),
+        "mean": avg_dist,
+        "median": median,
+        "max": float(distances.max()),
+        "projection_error": [float(proj_error.mean()), float(proj_error.max())],
+        "breakdown": breakdown,
+        "intervals": intervals,
+    }
+
+
+def code_files() -> list:
+    # Source a comparison depends on, for cache keys
+    return [__file__] + [
+        sys.modules[name].__file__
+        for name in ("projection", "align", "deadreckon", "motion", "reader", "reference", "policy")
+    ]
+
+
+def reference_track(path: str, mode: str, sensor=np.float64, store=None) -> ReferenceTrack:
+    # The indexed always-on ride, from the cache if it has been built before
+    directory = None
+    if store:
+        params = {"projection": mode, "sensor": np.dtype(sensor).name}
+        directory = store.entry_dir(store.key("reference", [path], params, code_files()))
+        try:
+            return ReferenceTrack.load(directory)
+        except (OSError, ValueError):
+            pass
+    fixes = parse_file(path, fix_dtype(sensor))
+    if not len(fixes):
+        raise ValueError(f"'{path}' had no fixes")
+    track = ReferenceTrack.build(path, fixes, mode)
+    if store:
+        store.put_dir(directory, track.save)
+    return track
+
+
+def evaluate_against(reference: ReferenceTrack, back: np.ndarray, cycled_path: str, options: Options = None) -> dict:
+    """
+    evaluate() for a duty-cycled ride against an indexed reference. The
+    ride is projected into the reference's frame and filled in between
+    fixes (options.estimate); the reference is used as built and isn't
+    filled in, so for nearest and time matching the work is in the
+    candidate's size only. `back` is written to, like in evaluate().
+    """
+    options = options or Options()
+    windows = off_windows(cycled_path, back["time"], options)
+    if options.schedule:
+        back = scheduled_fixes(back, windows)
+    back_len = len(back)
+    count("fixes", back_len)
+    proj = reference.proj
+    with span("project"):
+        project_points(back, proj)
+    track = None
+    if options.estimate == "reckon":
+        with span("reckon"):
+            track = reckoned_track(cycled_path, proj)
+    with span("interpolate"):
+        back = interpolate_gaps(back, proj, keep_current=True, track=track)
+    count("interpolated points", len(back) - back_len)
+    query, ref = back, reference.points
+    if options.collapse_stationary:
+        query = collapse_stationary(query, "query")
+
+    if options.match == "nearest":
+        with span("match"):
+            distances, matches = reference.nearest(query["x"], query["y"])
+        query_idx = np.arange(len(query))
+    elif options.match in ("dtw", "frechet"):
+        with span("match"):
+            alignment, flipped = align_rides(query, ref, options.match, options.band)
+        if alignment is None:
+            raise ValueError("Could not align the two rides inside the band, try a wider --band")
+        if flipped:
+            Log.info("The rides were ridden in opposite directions")
+            ref = ref[::-1]
+        query_idx, matches, distances = alignment.query, alignment.reference, alignment.distances
     else:
-        # Clamp to way there
-        for there_point in there:
-            diffs = []
-            for back_point in back:
-                dis = geodesic_distance(
-                    (there_point["lat"], there_point["lon"]),
-                    (back_point["lat"], back_point["lon"]),
-                )
-                diffs.append(dis)
-            dist = min(diffs)
-            if debug:
-                Log.info(f"Distance of {dist}")
-            distances.append(dist)
-            avg_dist += dist
-            rmse += dist * dist
-            n += 1
-
-    # for there_point, back_point in zip(there,back):
-    #     dis = haversine((there_point['lat'], there_point['lon']), (back_point['lat'], back_point['lon']))
-    #     Log.info(f"{(there_point['lat'], there_point['lon'])} @ {(back_point['lat'], back_point['lon'])}")
-    #     # Log.info(f"Distance = {dis}")
-    #     rmse += dis*dis
-    #     avg_dist += dis
-    #     distances.append(dis)
-    #     n += 1
-
-    distances.sort()
-    # GFG median trick
-    mid = len(distances) // 2
-    median = (distances[mid] + distances[~mid]) / 2
-    avg_dist /= n
-    rmse /= n
-    rmse = math.sqrt(rmse)
+        with span("match"):
+            sync_x, sync_y = reference.at(query["time"], options.max_gap * 1000)
+        query_idx = np.flatnonzero(~np.isnan(sync_x))
+        if not len(query_idx):
+            raise ValueError("The rides don't overlap in time, nothing to compare")
+        distances = np.hypot(
+            query["x"][query_idx] - sync_x[query_idx],
+            query["y"][query_idx] - sync_y[query_idx],
+        )
+        ref_lat, ref_lon = proj.inverse(sync_x[query_idx], sync_y[query_idx])
+        Log.info(f"{len(query_idx)} of {len(query)} points overlap the reference in time")
+    if options.match != "time":
+        ref_lat, ref_lon = ref["lat"][matches], ref["lon"][matches]
+    return figures(distances, query, query_idx, ref_lat, ref_lon, windows, options)
+
+
+# The reference a worker process compares against, set once per process
+shared_reference = None
 
-    end = time.time()
-    Log.ok(f"Finished processing in {end-start} seconds")
-    Log.ok(f"RMSE = {rmse}")
-    Log.ok(f"Minimum distance = {min(distances)}")
-    Log.ok(f"Average distance = {avg_dist}")
-    Log.ok(f"Median distance = {median}")
-    Log.ok(f"Maximum distance = {max(distances)}")
 
-    there_df = pd.DataFrame(there)
-    back_df = pd.DataFrame(back)
+def use_reference(reference: ReferenceTrack):
+    global shared_reference
+    shared_reference = reference
 
-    there_geom = [Point(xy) for xy in zip(there_df["lon"], there_df["lat"])]
-    there_gdf = GeoDataFrame(there_df, geometry=there_geom)
 
-    back_geom = [Point(xy) for xy in zip(back_df["lon"], back_df["lat"])]
-    back_gdf = GeoDataFrame(back_df, geometry=back_geom)
+def compare_candidate(path: str, options: Options, sensor=np.float64, back: np.ndarray = None) -> tuple:
+    # (result, None), or (None, why) if the ride can't be compared. `back`
+    # is the ride's fixes if they have been parsed already.
+    if back is None:
+        back = parse_file(path, fix_dtype(sensor))
+    if not len(back):
+        return None, "it had no fixes"
+    try:
+        return evaluate_against(shared_reference, back, path, options), None
+    except ValueError as err:
+        return None, str(err)
+
+
+def compare_many(
+    there_path: str,
+    back_paths: list,
+    options: Options,
+    store=None,
+    depth: int = 2,
+    sensor=np.float64,
+    workers: int = None,
+):
+    # One reference, many duty-cycled rides: the reference is parsed,
+    # projected and indexed once (and kept in the cache), then handed to
+    # each worker process once; each candidate only costs its own parse
+    # and queries. Compared one at a time, the next `depth` candidates are
+    # parsed in the background meanwhile (see reader.prefetch). No maps
+    # are drawn.
+    keys, results = {}, {}
+    if store:
+        with span("cache"):
+            params = dict(options.to_dict(), shared_reference=True)
+            for path in back_paths:
+                keys[path] = store.key("accuracy", [there_path, path], params, code_files())
+                results[path] = store.get(keys[path])
+    pending = [path for path in back_paths if results.get(path) is None]
+
+    start = time.time()
+    if pending:
+        with span("reference"):
+            try:
+                reference = reference_track(there_path, options.projection, sensor, store)
+            except ValueError as err:
+                Log.error(str(err))
+                exit(3)
+        Log.info(f"Reference '{there_path}' has {len(reference)} fixes")
+        workers = max(1, min(workers or os.cpu_count() or 1, len(pending)))
+        with span("compare"):
+            if workers == 1:
+                use_reference(reference)
+                done = {}
+                loads = prefetch(pending, partial(parse_file, dtype=fix_dtype(sensor)), depth)
+                for path, loaded in zip(pending, loads):
+                    try:
+                        back = loaded.result()
+                    except (ValueError, OSError) as err:
+                        done[path] = None, str(err)
+                        continue
+                    done[path] = compare_candidate(path, options, sensor, back)
+            else:
+                with ProcessPoolExecutor(max_workers=workers, initializer=use_reference, initargs=(reference,)) as pool:
+                    futures = {path: pool.submit(compare_candidate, path, options, sensor) for path in pending}
+                    done = {path: future.result() for path, future in futures.items()}
+        for path, (result, why) in done.items():
+            if result is None:
+                Log.error(f"Could not compare '{path}': {why}")
+                continue
+            results[path] = result
+            if store:
+                store.put(keys[path], result)
+    end = time.time()
+    Log.ok(f"Compared {len(back_paths)} rides against '{there_path}' in {end-start} seconds")
+
+    for path in back_paths:
+        if results.get(path) is None:
+            continue
+        Log.flush()
+        print(f"{path}:")
+        report(results[path])
+    print_comparisons(results, back_paths)
+    if options.intervals:
+        print_interval_summary(results, back_paths, options.bin)
+
+
+def print_comparisons(results: dict, paths: list):
+    Log.flush()
+    width = max(len(path) for path in paths)
+    print("=" * (width + 44))
+    print(f"{'ride':<{width}} {'rmse (m)':>10} {'mean (m)':>10} {'median (m)':>11} {'max (m)':>10}")
+    print("-" * (width + 44))
+    for path in paths:
+        result = results.get(path)
+        if result is None:
+            print(f"{path:<{width}} {'failed':>10}")
+            continue
+        print(
+            f"{path:<{width}} {result['rmse']:>10.2f} {result['mean']:>10.2f} {result['median']:>11.2f} {result['max']:>10.2f}"
+        )
+    print("=" * (width + 44))
+
 
-    world = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres")).plot(
-        figsize=(10, 6)
+def report(result: dict):
+    Log.ok(f"RMSE = {result['rmse']}")
+    Log.ok(f"Minimum distance = {result['min']}")
+    Log.ok(f"Average distance = {result['mean']}")
+    Log.ok(f"Median distance = {result['median']}")
+    Log.ok(f"Maximum distance = {result['max']}")
+    Log.ok(
+        f"Projection error vs haversine: mean = {result['projection_error'][0]} m, max = {result['projection_error'][1]} m"
     )
+    if result["breakdown"] is not None:
+        print_off_time_errors(result["breakdown"])
+    if result["intervals"] is not None:
+        print_intervals(result["intervals"])
+
+
+# Tracks of a result that are kept as arrays, not in its JSON
+TRACKS = ("there", "back")
+
+
+def cache_result(store, key: str, result: dict):
+    arrays = {f"{name}_{axis}": result[name][axis] for name in TRACKS for axis in ("lat", "lon")}
+    store.put(key, {name: value for name, value in result.items() if name not in TRACKS}, arrays)
+
+
+def cached_result(store, key: str):
+    # A result cache_result() stored, or None
+    result = store.get(key)
+    arrays = store.get_arrays(key) if result is not None else None
+    if arrays is None:
+        return None
+    for name in TRACKS:
+        result[name] = {axis: arrays[f"{name}_{axis}"] for axis in ("lat", "lon")}
+    return result
+
+
+def plot(result: dict):
+    with span("plot"):
+        there = result["there"]
+        there_gdf = GeoDataFrame(geometry=gpd.points_from_xy(there["lon"], there["lat"]))
+        back = result["back"]
+        back_gdf = GeoDataFrame(geometry=gpd.points_from_xy(back["lon"], back["lat"]))
+
+        try:
+            world = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres")).plot(
+                figsize=(10, 6)
+            )
+        except AttributeError:
+            # geopandas 1.0 no longer ships the world map; plot without it
+            _, world = plt.subplots(figsize=(10, 6))
 
-    there_gdf.plot(ax=world, marker="o", color="red", markersize=15)
-    back_gdf.plot(ax=world, marker="o", color="blue", markersize=15)
-    plt.show()
+        there_gdf.plot(ax=world, marker="o", color="red", markersize=15)
+        back_gdf.plot(ax=world, marker="o", color="blue", markersize=15)
+        plt.show()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+import numpy as np
+
+# Backpointer directions, relative to cell (i, j)
+DIAG = 0  # came from (i-1, j-1)
+UP = 1  # came from (i-1, j)
+LEFT = 2  # came from (i, j-1)
+
+
+class Alignment:
+    """
+    A monotone pairing of query points with reference points. query and
+    reference are index arrays of equal length (one entry per aligned pair),
+    distances is the metric distance of each pair, and cost is the DTW sum
+    or the discrete Fréchet distance of the whole alignment.
+    """
+
+    __slots__ = ("query", "reference", "distances", "cost", "cells")
+
+    def __init__(self, query, reference, distances, cost, cells):
+        self.query = query
+        self.reference = reference
+        self.distances = distances
+        self.cost = cost
+        self.cells = cells
+
+
+def progress(times) -> np.ndarray:
+    # Fraction of the ride completed at each sample, 0 to 1. Falls back to the
+    # sample index when the timestamps are missing or don't advance.
+    times = np.maximum.accumulate(np.asarray(times, dtype=np.float64))
+    span = times[-1] - times[0] if len(times) else 0
+    if not span > 0:
+        return np.linspace(0, 1, len(times))
+    return (times - times[0]) / span
+
+
+def band(query_time, reference_time, width: float):
+    """
+    Sakoe-Chiba style band from the timestamps of both tracks. Each ride's
+    clock is normalized to its own duration so rides of different lengths
+    line up end to end, then query point i may only be paired with reference
+    points whose progress is within `width` seconds (of query time) of its own.
+
+    Returns (lo, hi): row i of the cost matrix spans columns [lo[i], hi[i]).
+    """
+    qp = progress(query_time)
+    rp = progress(reference_time)
+    duration = (query_time[-1] - query_time[0]) / 1000 if len(query_time) else 0
+    frac = width / duration if duration > 0 else 1.0
+    lo = np.minimum(np.searchsorted(rp, qp - frac, side="left"), len(rp) - 1)
+    hi = np.searchsorted(rp, qp + frac, side="right")
+    # The path has to start at (0, 0), finish at (n-1, m-1), and be able to
+    # step from every row to the next one.
+    lo[0] = 0
+    hi[-1] = len(rp)
+    hi = np.maximum(hi, lo + 1)
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    return lo, hi
+
+
+def align(qx, qy, rx, ry, lo, hi, metric: str = "dtw", limit: float = np.inf):
+    """
+    Align the query track to the reference track inside the band lo/hi.
+
+    metric is "dtw" (minimize the summed pair distance) or "frechet" (minimize
+    the largest pair distance). Time and memory are O(N*w) for a band w wide.
+    If every partial path in some row already costs more than `limit` the
+    alignment is abandoned and None is returned, which lets a caller trying
+    several candidates stop as soon as one can no longer win.
+    """
+    qx = np.asarray(qx, dtype=np.float64)
+    qy = np.asarray(qy, dtype=np.float64)
+    rx = np.asarray(rx, dtype=np.float64)
+    ry = np.asarray(ry, dtype=np.float64)
+    if metric not in ("dtw", "frechet"):
+        raise ValueError(f"Unknown alignment metric '{metric}'")
+
+    steps = []
+    prev, plo, phi = None, 0, 0
+    cells = 0
+    for i in range(len(qx)):
+        rlo, rhi = int(lo[i]), int(hi[i])
+        c = np.hypot(qx[i] - rx[rlo:rhi], qy[i] - ry[rlo:rhi])
+        cells += rhi - rlo
+
+        # ext[k] is the previous row's cost at column rlo - 1 + k
+        ext = np.full(rhi - rlo + 1, np.inf)
+        if prev is None:
+            ext[0] = 0.0  # virtual start just before (0, 0)
+        else:
+            a, b = max(plo, rlo - 1), min(phi, rhi)
+            if b > a:
+                ext[a - rlo + 1 : b - rlo + 1] = prev[a - plo : b - plo]
+        diag, up = ext[:-1], ext[1:]
+        best = np.minimum(diag, up)
+
+        if metric == "dtw":
+            # row[j] = c[j] + min(best[j], row[j-1]) unrolls to
+            # C[j] + min over k <= j of (best[k] - C[k-1]) with C = cumsum(c)
+            total = np.cumsum(c)
+            row = total + np.minimum.accumulate(best - (total - c))
+            left = np.zeros(len(c), dtype=bool)
+            left[1:] = row[:-1] < best[1:]
+        else:
+            # row[j] = max(c[j], min(best[j], row[j-1])). A max/min recurrence
+            # has no cumulative form like the sum above, so one scan left to
+            # right, O(w) per row.
+            row = np.empty(len(c))
+            last = np.inf
+            for j, (cost, came) in enumerate(zip(c.tolist(), best.tolist())):
+                last = max(cost, min(came, last))
+                row[j] = last
+            left = np.zeros(len(c), dtype=bool)
+            left[1:] = row[:-1] < best[1:]
+
+        if row.min() > limit:
+            return None
+
+        step = np.where(up < diag, UP, DIAG).astype(np.int8)
+        step[left] = LEFT
+        steps.append(step)
+        prev, plo, phi = row, rlo, rhi
+
+    cost = float(prev[-1])
+    if not np.isfinite(cost) or cost > limit:
+        return None
+
+    # Walk the backpointers from (n-1, m-1) to (0, 0)
+    i, j = len(qx) - 1, len(rx) - 1
+    qi, ri = [], []
+    while i >= 0:
+        qi.append(i)
+        ri.append(j)
+        step = steps[i][j - int(lo[i])]
+        if i == 0 and j == 0:
+            break
+        if step == LEFT:
+            j -= 1
+        elif step == UP:
+            i -= 1
+        else:
+            i -= 1
+            j -= 1
+    qi = np.array(qi[::-1], dtype=np.int64)
+    ri = np.array(ri[::-1], dtype=np.int64)
+    distances = np.hypot(qx[qi] - rx[ri], qy[qi] - ry[ri])
+    return Alignment(qi, ri, distances, cost, cells)
+
+
+def band_path_cost(qx, qy, rx, ry, lo, hi, metric: str = "dtw") -> float:
+    """
+    Cost of one particular path through the band lo/hi: down its middle,
+    from (0, 0) to (n-1, m-1). Any path's cost is an upper bound on the
+    optimal alignment's, so this is a bound to abandon align() against
+    before any alignment has been finished. Infinite if the middle doesn't
+    make a connected path inside the band.
+    """
+    n, m = len(qx), len(rx)
+    if not n or not m:
+        return np.inf
+    lo = np.asarray(lo, dtype=np.int64)
+    hi = np.asarray(hi, dtype=np.int64)
+    col = np.maximum.accumulate(lo + (hi - lo - 1) // 2)
+    col[-1] = m - 1
+    # Row i visits the columns after the previous row's up to its own
+    first = np.zeros(n, dtype=np.int64)
+    first[1:] = np.minimum(col[:-1] + 1, col[1:])
+    if (first < lo).any() or (col >= hi).any():
+        return np.inf
+    counts = col - first + 1
+    rows = np.repeat(np.arange(n), counts)
+    cols = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    c = np.hypot(np.asarray(qx, dtype=np.float64)[rows] - np.asarray(rx, dtype=np.float64)[cols],
+                 np.asarray(qy, dtype=np.float64)[rows] - np.asarray(ry, dtype=np.float64)[cols])
+    return float(c.sum() if metric == "dtw" else c.max())
+
+
+def synchronize(times, reference_time, rx, ry, max_gap: float):
+    """
+    As-of join of the reference track onto `times`: for each instant, the
+    reference position linearly interpolated between the last reference
+    sample at or before it and the next one after. One binary search per
+    instant, so O(n log m) overall.
+
+    Instants before the reference starts, after it ends, or inside a gap of
+    more than max_gap milliseconds between reference samples come back NaN.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    reference_time = np.asarray(reference_time, dtype=np.float64)
+    rx = np.asarray(rx, dtype=np.float64)
+    ry = np.asarray(ry, dtype=np.float64)
+    order = np.argsort(reference_time, kind="stable")
+    rt, rx, ry = reference_time[order], rx[order], ry[order]
+
+    x = np.full(len(times), np.nan)
+    y = np.full(len(times), np.nan)
+    if len(rt) == 0:
+        return x, y
+    after = np.searchsorted(rt, times, side="right")
+    before = after - 1
+    inside = (before >= 0) & (after < len(rt))
+    exact = (before >= 0) & (rt[np.maximum(before, 0)] == times)
+    b, a = before[inside], after[inside]
+    gap = rt[a] - rt[b]
+    ok = gap <= max_gap
+    frac = np.where(gap > 0, (times[inside] - rt[b]) / np.where(gap > 0, gap, 1), 0)
+    idx = np.flatnonzero(inside)[ok]
+    x[idx] = (rx[b] + (rx[a] - rx[b]) * frac)[ok]
+    y[idx] = (ry[b] + (ry[a] - ry[b]) * frac)[ok]
+    # An instant that lands exactly on the last sample is still covered
+    x[exact] = rx[before[exact]]
+    y[exact] = ry[before[exact]]
+    return x, y
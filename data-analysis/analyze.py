@@ -9,9 +9,14 @@ import numpy as np
 import argparse
 from sys import argv
 from scipy import signal
-import termcolor
 import time
 
+import instrument
+import log
+from instrument import span, count
+from log import Log
+from reader import Ride, Tail, read_ride
+
 arg_parser = argparse.ArgumentParser(
     description="Process collected location and sensor data from TrackCycle application.",
     usage="python analyze.py -i <input file path> [-d <debug level: integer>]",
@@ -28,122 +33,118 @@ arg_parser.add_argument(
     type=int,
     help="debug level (0=no debugging (default), 1=debugging on)",
 )
+arg_parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    help="number of processes used to parse large files (default: one per core)",
+)
+arg_parser.add_argument(
+    "-f",
+    "--follow",
+    type=float,
+    nargs="?",
+    const=2.0,
+    metavar="SECONDS",
+    help="live-plot the input file, picking up lines as they are appended (default refresh: 2 s)",
+)
+arg_parser.add_argument(
+    "-k",
+    "--keys",
+    type=str,
+    default="azimuth,gyroz,speed",
+    help="comma separated columns to live-plot with --follow (default: azimuth,gyroz,speed)",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
 args = None
 debug = False
-data_length = None
 
 
-class Log:
-    def error(msg: str):
-        level = termcolor.colored(f"ERROR", "red")
-        print(f"[ {level} ] {msg}")
+# Elliptic low-pass used to smooth the noisy IMU and orientation signals
+LOWPASS = signal.ellip(3, 2, 300, 0.01, output="sos", btype="lowpass")
 
-    def warning(msg: str):
-        level = termcolor.colored(f"WARNING", "yellow")
-        print(f"[ {level} ] {msg}")
 
-    def ok(msg: str):
-        level = termcolor.colored(f"OK", "green")
-        print(f"[ {level} ] {msg}")
+def lowpass(values):
+    return signal.sosfilt(LOWPASS, values)
 
-    def info(msg: str):
-        print(f"[ INFO ] {msg}")
 
+class Growing:
+    # Append-only float array with amortized O(1) appends, for live plots
+    def __init__(self):
+        self.data = np.empty(1024)
+        self.n = 0
 
-def parse_line(line: str, idx: int) -> dict:
-    global data_length
-    if line.startswith("--"):
-        Log.error("Attempting to parse marker line. How did we get here?")
-        return None
-    data = ()
-    dictionary = dict()
+    def extend(self, values):
+        need = self.n + len(values)
+        if need > len(self.data):
+            grown = np.empty(max(need, 2 * len(self.data)))
+            grown[: self.n] = self.data[: self.n]
+            self.data = grown
+        self.data[self.n : need] = values
+        self.n = need
 
-    try:
-        data = list(map(float, line.split(",")))
-        # 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16      17    18
-        # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current,capmah,engnwh
-        if len(data) <= 14:
-            dictionary = {
-                "lat": data[0],
-                "lon": data[1],
-                "alt": data[2],
-                "acc": data[3],
-                "speed": data[4],
-                "accelx": data[5],
-                "accely": data[6],
-                "accelz": data[7],
-                "gyrox": data[8],
-                "gyroy": data[9],
-                "gyroz": data[10],
-                "azimuth": data[11],
-                "pitch": data[12],
-                "roll": data[13],
-            }
-        elif len(data) <= 17:
-            dictionary = {
-                "lat": data[0],
-                "lon": data[1],
-                "alt": data[2],
-                "acc": data[3],
-                "speed": data[4],
-                "accelx": data[5],
-                "accely": data[6],
-                "accelz": data[7],
-                "gyrox": data[8],
-                "gyroy": data[9],
-                "gyroz": data[10],
-                "azimuth": data[11],
-                "pitch": data[12],
-                "roll": data[13],
-                "time": data[14],
-                "batpct": data[15],
-                "current": data[16],
-            }
-        elif len(data) > 18:
-            dictionary = {
-                "lat": data[0],
-                "lon": data[1],
-                "alt": data[2],
-                "acc": data[3],
-                "speed": data[4],
-                "accelx": data[5],
-                "accely": data[6],
-                "accelz": data[7],
-                "gyrox": data[8],
-                "gyroy": data[9],
-                "gyroz": data[10],
-                "azimuth": data[11],
-                "pitch": data[12],
-                "roll": data[13],
-                "time": data[14],
-                "batpct": data[15],
-                "current": data[16],
-                "capmah": data[17],
-                "engnwh": data[18],
-            }
-        if not data_length:
-            data_length = len(data)
-    except ValueError:
-        Log.error(f"Could not parse line {idx}: {line}")
-        return None
-    except IndexError:
-        if data:
-            Log.error(
-                f"Could not parse line {idx} due to insufficient length (len={len(data)}): {line}"
-            )
-        else:
-            Log.error(
-                f"Could not parse line {idx} due to insufficient length (data=None): {line}"
-            )
-        return None
+    def view(self):
+        return self.data[: self.n]
 
-    return dictionary
+
+def extract_markers(ride: Ride):
+    markers = dict()
+    marker_x = {
+        "GPS_STOP": [],
+        "GPS_START": [],
+        "MOTION": [],
+        "LEFT": [],
+        "RIGHT": [],
+        "STOP": [],
+    }
+
+    for idx, line in zip(ride.marker_lines.tolist(), ride.marker_labels.tolist()):
+        Log.trace("Line %d is a special marker", idx)
+
+        if line == "GPS STOPPED":
+            markers[idx] = "GPS STOPPED"
+            marker_x["GPS_STOP"].append(idx)
+        if line == "GPS STARTED":
+            markers[idx] = "GPS STARTED"
+            marker_x["GPS_START"].append(idx)
+        elif line == "SIGNIFICANT MOTION DETECTED":
+            markers[idx] = "MOTION DETECTED"
+            marker_x["MOTION"].append(idx)
+        elif line == "LEFT":
+            markers[idx] = "LEFT"
+            marker_x["LEFT"].append(idx)
+        elif line == "RIGHT":
+            markers[idx] = "RIGHT"
+            marker_x["RIGHT"].append(idx)
+        elif line == "STOP":
+            markers[idx] = "STOP"
+            marker_x["STOP"].append(idx)
+
+    count("markers", len(markers))
+    return markers, marker_x
+
+
+def parse_data(ride: Ride) -> pd.DataFrame:
+    # 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16      17    18
+    # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current,capmah,engnwh
+    data = ride.frame()
+    count("lines", len(data))
+    return data
+
+
+def load(path: str, workers: int = None):
+    # Everything the menu plots need from a log: its frame and marker lines
+    ride = read_ride(path, workers=workers)
+    _, marker_x = extract_markers(ride)
+    return parse_data(ride), marker_x
 
 
 def main():
     global args
     global debug
     args = arg_parser.parse_args()
+    instrument.configure(args)
 
     if args.input == None:
         arg_parser.print_help()
@@ -162,72 +163,28 @@ def main():
             )
         else:
             debug = args.debug == 1
+    log.configure(args, debug)
 
-    lines = []
-    with open(path, "r") as infile:
-        Log.info(f"Begins processing {path}.")
-        lines = infile.readlines()
-
-    markers = dict()
-    marker_x = {
-        "GPS_STOP": [],
-        "GPS_START": [],
-        "MOTION": [],
-        "LEFT": [],
-        "RIGHT": [],
-        "STOP": [],
-    }
-    data = pd.DataFrame()
+    if args.follow is not None:
+        follow(path, args.follow, args.keys.split(","))
+        return
 
+    Log.info(f"Begins processing {path}.")
     start = time.time()
 
-    for (idx, line) in enumerate(lines):
-        if idx == 0:
-            # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll
-            continue
-
-        if line.startswith("--"):
-            if debug:
-                Log.info(f"Line {idx} is a special marker")
-
-            # This is a special marker line
-            line = line.lstrip("--").rstrip("--\n")
-
-            if line == "GPS STOPPED":
-                markers[idx] = "GPS STOPPED"
-                marker_x["GPS_STOP"].append(idx)
-            if line == "GPS STARTED":
-                markers[idx] = "GPS STARTED"
-                marker_x["GPS_START"].append(idx)
-            elif line == "SIGNIFICANT MOTION DETECTED":
-                markers[idx] = "MOTION DETECTED"
-                marker_x["MOTION"].append(idx)
-            elif line == "LEFT":
-                markers[idx] = "LEFT"
-                marker_x["LEFT"].append(idx)
-            elif line == "RIGHT":
-                markers[idx] = "RIGHT"
-                marker_x["RIGHT"].append(idx)
-            elif line == "STOP":
-                markers[idx] = "STOP"
-                marker_x["STOP"].append(idx)
-        else:
-            if debug:
-                Log.info(f"Line {idx} is a data line. Parsing...")
-
-            # Normal data line, parse
-            data = pd.concat(
-                [data, pd.DataFrame([parse_line(line, idx)])], ignore_index=True
-            )
+    with span("parse"):
+        data, marker_x = load(path, args.workers)
 
     end = time.time()
 
     Log.ok(f"FINISHED PARSING IN {end-start} s")
 
     if debug:
+        Log.flush()
         print(data)
 
     while True:
+        Log.flush()
         # 0   1   2   3   4     5      6      7      8     9     10    11      12    13
         # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll
         choice = input(
@@ -410,8 +367,7 @@ def main():
                 key = data.keys()[key_num]
                 key_num += 1
                 axes[col].plot(data[key])
-                sos = signal.ellip(3, 2, 300, 0.01, output="sos", btype="lowpass")
-                axes[col].plot(signal.sosfilt(sos, data[key]), "k-")
+                axes[col].plot(lowpass(data[key]), "k-")
                 axes[col].title.set_text(str(key).capitalize())
                 axes[col].vlines(
                     marker_x["LEFT"],
@@ -450,8 +406,7 @@ def main():
                 key = data.keys()[key_num]
                 key_num += 1
                 axes[col].plot(data[key])
-                sos = signal.ellip(3, 2, 300, 0.01, output="sos", btype="lowpass")
-                axes[col].plot(signal.sosfilt(sos, data[key]), "k-")
+                axes[col].plot(lowpass(data[key]), "k-")
                 axes[col].title.set_text(str(key).capitalize())
                 axes[col].vlines(
                     marker_x["LEFT"],
@@ -490,8 +445,7 @@ def main():
                 key = data.keys()[key_num]
                 key_num += 1
                 axes[col].plot(data[key])
-                sos = signal.ellip(3, 2, 300, 0.01, output="sos", btype="lowpass")
-                axes[col].plot(signal.sosfilt(sos, data[key]), "k-")
+                axes[col].plot(lowpass(data[key]), "k-")
                 axes[col].title.set_text(str(key).capitalize())
                 axes[col].vlines(
                     marker_x["LEFT"],
@@ -519,8 +473,7 @@ def main():
             fig, axes = plt.subplots(nrows=1, ncols=1)
             key = "azimuth"
             axes.plot(data[key])
-            sos = signal.ellip(3, 2, 300, 0.01, output="sos", btype="lowpass")
-            axes.plot(signal.sosfilt(sos, data[key]), "k-")
+            axes.plot(lowpass(data[key]), "k-")
 
             axes.title.set_text(key.capitalize())
             axes.vlines(
@@ -580,7 +533,66 @@ def main():
         elif choice == 11:
             break
 
-        plt.show()
+        with span("plot"):
+            plt.show()
+
+
+def follow(path: str, interval: float, keys: list):
+    # Live version of the plots: each refresh only parses and filters the lines
+    # appended since the last one. Filter state is carried over between
+    # refreshes so the smoothed curve matches what a full run would draw.
+    # Unlike the menu plots, markers are drawn at the data row they precede.
+    marker_colors = {
+        "LEFT": "green",
+        "RIGHT": "orange",
+        "STOP": "red",
+        "GPS STARTED": "blue",
+        "GPS STOPPED": "purple",
+    }
+    tail = Tail(path)
+    plt.ion()
+    fig, axes = plt.subplots(nrows=len(keys), ncols=1, squeeze=False, sharex=True)
+    raw = {key: Growing() for key in keys}
+    smooth = {key: Growing() for key in keys}
+    state = {key: np.zeros((LOWPASS.shape[0], 2)) for key in keys}
+    plots = {}
+    for key, ax in zip(keys, axes[:, 0]):
+        ax.title.set_text(key.capitalize())
+        plots[key] = (ax.plot([], [])[0], ax.plot([], [], "k-")[0])
+
+    Log.info(f"Following {path}, refreshing every {interval} s (close the window to stop).")
+    try:
+        while plt.fignum_exists(fig.number):
+            with span("read"):
+                ride = tail.poll()
+            if tail.restarted:
+                Log.warning(f"File '{path}' shrank, plotting from the start again")
+                for key, ax in zip(keys, axes[:, 0]):
+                    raw[key], smooth[key] = Growing(), Growing()
+                    state[key][:] = 0
+                    for line in list(ax.lines)[2:]:
+                        line.remove()
+            if ride is not None and (len(ride) or len(ride.marker_rows)):
+                with span("plot"):
+                    for key, ax in zip(keys, axes[:, 0]):
+                        if key not in ride:
+                            continue
+                        filtered, state[key] = signal.sosfilt(LOWPASS, ride[key], zi=state[key])
+                        raw[key].extend(ride[key])
+                        smooth[key].extend(filtered)
+                        x = np.arange(raw[key].n)
+                        plots[key][0].set_data(x, raw[key].view())
+                        plots[key][1].set_data(x, smooth[key].view())
+                        for row, label in zip(ride.marker_rows.tolist(), ride.marker_labels.tolist()):
+                            if label in marker_colors:
+                                ax.axvline(ride.first_row + row, linestyle="dashed", color=marker_colors[label])
+                        ax.relim()
+                        ax.autoscale_view()
+                count("lines", ride.lines - ride.first_line)
+                Log.ok(f"Plotted {len(ride)} new rows ({tail.rows} total)")
+            plt.pause(interval)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
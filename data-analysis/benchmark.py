@@ -0,0 +1,347 @@
+import os
+import argparse
+import atexit
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import accuracy
+import analyze
+import instrument
+import log
+import policy
+import reader
+import sensitivity
+import turns
+from deadreckon import dead_reckon
+from log import Log
+from projection import LocalProjection, nearest
+
+arg_parser = argparse.ArgumentParser(
+    description="Time the analysis stages against the ride logs bundled in files/.",
+    usage="python benchmark.py [-o <output json>] [-c <baseline json>] [-k <filter>] [-r <rounds>]",
+)
+arg_parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default="benchmark.json",
+    help="path to write the results to as JSON (default: benchmark.json)",
+)
+arg_parser.add_argument(
+    "-c",
+    "--compare",
+    type=str,
+    help="previously saved results to compare this run against",
+)
+arg_parser.add_argument(
+    "-k",
+    "--filter",
+    type=str,
+    help="only run benchmarks whose name contains this substring",
+)
+arg_parser.add_argument(
+    "-r",
+    "--rounds",
+    type=int,
+    default=5,
+    help="number of timed rounds per benchmark (default: 5)",
+)
+arg_parser.add_argument(
+    "-t",
+    "--threshold",
+    type=float,
+    default=0.10,
+    help="relative slowdown against the baseline that counts as a regression (default: 0.10)",
+)
+arg_parser.add_argument(
+    "-l",
+    "--list",
+    action="store_true",
+    help="list the available benchmarks and exit",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
+
+# 4k.txt is the small 14-column log. Of the 17-column rides with real GPS
+# fixes in them, 12-10-48 is the largest; 13-53-58 is not the next largest
+# but the reference ride of PAIR, so the per-ride stages are also timed on
+# the file the accuracy stages use, from a second day of recording.
+SMALL = "4k.txt"
+LARGE = ["2022_30_7_12-10-48_fiftyfifty.txt", "2022_21_7_13-53-58.txt"]
+# Two rides of the same route for the accuracy stages
+PAIR = ("2022_21_7_13-53-58.txt", "2022_21_7_13-14-50.txt")
+
+BENCHMARKS = []
+
+
+def benchmark(name: str, *inputs):
+    # Register the decorated setup function once per input. Setup does all the
+    # untimed preparation and returns the zero-argument callable that gets timed.
+    def register(setup):
+        for inp in inputs:
+            label = inp if isinstance(inp, str) else "+".join(inp)
+            BENCHMARKS.append((f"{name}[{label}]", setup, inp))
+        return setup
+
+    return register
+
+
+def path_of(name: str) -> str:
+    return os.path.join(FILES, name)
+
+
+def read_lines(name: str) -> list:
+    with open(path_of(name), "r") as infile:
+        return infile.readlines()
+
+
+def read_column(name: str, column: int) -> np.ndarray:
+    rows = [line for line in read_lines(name)[1:] if not line.startswith("--")]
+    return np.array([float(line.split(",")[column]) for line in rows])
+
+
+def projected_ride(name: str, proj: LocalProjection = None):
+    points = accuracy.parse_file(path_of(name))
+    if proj is None:
+        proj = LocalProjection(points["lat"], points["lon"])
+    accuracy.project_points(points, proj)
+    return points, proj
+
+
+@benchmark("parse.reader", SMALL, *LARGE)
+def bench_parse_reader(name):
+    path = path_of(name)
+    return lambda: reader.read_ride(path, workers=1)
+
+
+@benchmark("parse.projected", SMALL, *LARGE)
+def bench_parse_projected(name):
+    path = path_of(name)
+    return lambda: reader.read_ride(path, workers=1, columns=sensitivity.SIMULATOR_COLUMNS)
+
+
+@benchmark("parse.store", SMALL, *LARGE)
+def bench_parse_store(name):
+    path = path_of(name)
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    reader.save_ride(reader.read_ride(path, workers=1), os.path.join(directory, "ride"))
+    return lambda: reader.load_ride(os.path.join(directory, "ride"), path, sensitivity.SIMULATOR_COLUMNS)
+
+
+@benchmark("parse.analyze", SMALL, *LARGE)
+def bench_parse_analyze(name):
+    path = path_of(name)
+    return lambda: analyze.parse_data(reader.read_ride(path))
+
+
+@benchmark("parse.accuracy", SMALL, *LARGE)
+def bench_parse_accuracy(name):
+    path = path_of(name)
+    return lambda: accuracy.parse_file(path)
+
+
+@benchmark("markers", SMALL, *LARGE)
+def bench_markers(name):
+    ride = reader.read_ride(path_of(name))
+    return lambda: analyze.extract_markers(ride)
+
+
+@benchmark("simulate", SMALL, *LARGE)
+def bench_simulate(name):
+    ride = reader.read_ride(path_of(name))
+    return lambda: sensitivity.simulate(ride)
+
+
+@benchmark("policies", SMALL, *LARGE)
+def bench_policies(name):
+    # Sixteen azimuth angles in one replay, to compare against "simulate"
+    ride = reader.read_ride(path_of(name))
+    specs = "azimuth:angle=" + "/".join(str(a) for a in range(10, 170, 10))
+
+    def replay():
+        rp = policy.Replay(policy.parse_policies(specs))
+        rp.feed(ride)
+        return rp.results()
+
+    return replay
+
+
+@benchmark("interpolate", *LARGE)
+def bench_interpolate(name):
+    points, proj = projected_ride(name)
+    return lambda: accuracy.interpolate_gaps(points, proj, keep_current=True)
+
+
+@benchmark("reckon", *LARGE)
+def bench_reckon(name):
+    ride = reader.read_ride(path_of(name))
+    _, proj = projected_ride(name)
+    return lambda: dead_reckon(ride, proj)
+
+
+@benchmark("nearest", PAIR)
+def bench_nearest(names):
+    there, proj = projected_ride(names[0])
+    back, _ = projected_ride(names[1], proj)
+    back = accuracy.interpolate_gaps(back, proj, keep_current=True)
+    qx, qy = there["x"], there["y"]
+    rx, ry = back["x"], back["y"]
+    return lambda: nearest(qx, qy, rx, ry)
+
+
+@benchmark("align", PAIR)
+def bench_align(names):
+    there, proj = projected_ride(names[0])
+    back, _ = projected_ride(names[1], proj)
+    there = accuracy.interpolate_gaps(there, proj, keep_current=False)
+    back = accuracy.interpolate_gaps(back, proj, keep_current=True)
+    return lambda: accuracy.align_rides(back, there, "dtw", 60.0)
+
+
+@benchmark("filter", *LARGE)
+def bench_filter(name):
+    # gyroz and azimuth are the signals the turn detection works from
+    gyroz = read_column(name, 10)
+    azimuth = read_column(name, 11)
+    return lambda: (analyze.lowpass(gyroz), analyze.lowpass(azimuth))
+
+
+@benchmark("turns", *LARGE)
+def bench_turns(name):
+    path = path_of(name)
+
+    def detect():
+        detector = turns.TurnDetector("gyroz")
+        for ride in reader.iter_ride(path):
+            detector.feed(ride)
+        return detector.events
+
+    return detect
+
+
+def run(setup, inp, rounds: int) -> dict:
+    fn = setup(inp)
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "rounds": rounds,
+        "min": min(times),
+        "max": max(times),
+        "mean": statistics.mean(times),
+        "median": statistics.median(times),
+        "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def machine_info() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit or None,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    # Print the medians side by side, then log every benchmark that moved by
+    # more than `threshold`. Returns how many got slower.
+    old = {bench["name"]: bench["stats"] for bench in baseline["benchmarks"]}
+    slower, faster = [], []
+    Log.flush()
+    print(f"{'benchmark':<60} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for bench in results["benchmarks"]:
+        name = bench["name"]
+        now = bench["stats"]["median"]
+        if name not in old:
+            print(f"{name:<60} {'-':>10} {now:>10.4f} {'new':>7}")
+            continue
+        before = old[name]["median"]
+        ratio = now / before if before else float("inf")
+        print(f"{name:<60} {before:>10.4f} {now:>10.4f} {ratio:>7.2f}")
+        if ratio > 1 + threshold:
+            slower.append((name, ratio))
+        elif ratio < 1 - threshold:
+            faster.append((name, ratio))
+    for name, ratio in faster:
+        Log.ok(f"{name}: {ratio:.2f}x the baseline")
+    for name, ratio in slower:
+        Log.error(f"{name}: {ratio:.2f}x the baseline")
+    return len(slower)
+
+
+def main():
+    args = arg_parser.parse_args()
+    instrument.configure(args)
+    log.configure(args, False)
+
+    selected = [
+        bench for bench in BENCHMARKS if not args.filter or args.filter in bench[0]
+    ]
+
+    if args.list:
+        for name, _, _ in selected:
+            print(name)
+        exit(0)
+
+    if args.rounds < 1:
+        Log.error(f"Expected at least one round, got {args.rounds}")
+        exit(1)
+
+    baseline = None
+    if args.compare:
+        if not os.path.exists(args.compare):
+            Log.error(f"Baseline '{args.compare}' was inaccessible or does not exist")
+            exit(2)
+        with open(args.compare, "r") as infile:
+            baseline = json.load(infile)
+
+    results = {
+        "datetime": datetime.now(timezone.utc).isoformat(),
+        "machine": machine_info(),
+        "benchmarks": [],
+    }
+
+    for name, setup, inp in selected:
+        Log.info(f"Running {name}")
+        with instrument.span(name):
+            stats = run(setup, inp, args.rounds)
+        Log.ok(f"{name}: median {stats['median']:.4f} s over {stats['rounds']} rounds")
+        results["benchmarks"].append({"name": name, "stats": stats})
+
+    with open(args.output, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+    Log.ok(f"Wrote results to '{args.output}'")
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            Log.warning(f"{regressions} benchmark(s) slower than the baseline")
+            exit(4)
+
+
+if __name__ == "__main__":
+    main()
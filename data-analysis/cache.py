@@ -0,0 +1,235 @@
+import os
+import hashlib
+import json
+import shutil
+import time
+
+import numpy as np
+
+import reader
+from log import Log
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+DEFAULT_SIZE = 256  # MB
+HASH_BLOCK = 1 << 20
+# Entries stored as directories rather than JSON files
+DIRECTORY_KINDS = ("ride-", "reference-")
+
+
+class Cache:
+    """
+    On-disk memo of analysis results. An entry is keyed by the content hash
+    of every input file, the full parameter set and a hash of the source of
+    the code that produced it, so editing a log or a script invalidates it
+    automatically. Entries are JSON files; a hit touches the file and the
+    least recently used entries are evicted once the directory passes
+    `max_bytes`. Parsed logs are kept the same way, as binary column stores
+    (see ride()).
+
+    Hashing a big log isn't free, so file hashes are remembered against
+    (path, size, mtime) in a small index alongside the entries.
+    """
+
+    def __init__(self, directory: str = DEFAULT_DIR, max_bytes: int = DEFAULT_SIZE << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(directory, "files.json")
+        self._index = None
+
+    def key(self, kind: str, inputs: list, params: dict, code: list) -> str:
+        digest = hashlib.sha256()
+        digest.update(kind.encode())
+        for path in inputs:
+            digest.update(self.file_hash(path).encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        for path in code:
+            digest.update(self.file_hash(path).encode())
+        return f"{kind}-{digest.hexdigest()[:32]}"
+
+    def get(self, key: str):
+        path = self._entry(key)
+        try:
+            with open(path, "r") as infile:
+                value = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        Log.debug("Cache hit for %s", key)
+        return value
+
+    def put(self, key: str, value, arrays: dict = None):
+        # `arrays` (name -> numpy array) are kept beside the JSON as an .npz
+        # rather than turned into lists; see get_arrays()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._entry(key)
+        if arrays is not None:
+            tmp = f"{path[:-5]}.{os.getpid()}.tmp.npz"
+            np.savez(tmp, **arrays)
+            os.replace(tmp, self._arrays(key))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as outfile:
+            json.dump(value, outfile)
+        os.replace(tmp, path)
+        self._save_index()
+        self.evict()
+
+    def get_arrays(self, key: str):
+        # The arrays put() stored with an entry, or None
+        try:
+            with np.load(self._arrays(key)) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+    def ride(self, path: str, columns: list = None, where=None, workers: int = None):
+        """
+        A parsed log, from its column store if there is one. On a miss the
+        whole log is parsed once and stored, then every later call, whatever
+        its projection, loads just the columns it asks for.
+        """
+        directory = self.entry_dir(self.key("ride", [path], {}, [reader.__file__]))
+        try:
+            ride = reader.load_ride(directory, path, columns, where)
+        except (OSError, ValueError):
+            pass
+        else:
+            Log.debug("Column store hit for '%s'", path)
+            now = time.time()
+            os.utime(directory, (now, now))
+            return ride
+        ride = reader.read_ride(path, workers)
+        self.put_dir(directory, lambda target: reader.save_ride(ride, target))
+        return reader.load_ride(directory, path, columns, where)
+
+    def entry_dir(self, key: str) -> str:
+        # Where an entry that is a directory of files (a column store, an
+        # indexed reference track) lives; its key should start with one of
+        # DIRECTORY_KINDS so evict() and clear() know it
+        return os.path.join(self.directory, key)
+
+    def put_dir(self, directory: str, save):
+        # save(directory) writes the entry
+        os.makedirs(self.directory, exist_ok=True)
+        save(directory)
+        self._save_index()
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.startswith(DIRECTORY_KINDS) and os.path.isdir(path):
+                    stat = os.stat(path)
+                    size = sum(entry.stat().st_size for entry in os.scandir(path))
+                elif name.endswith(".json") and name != "files.json":
+                    stat = os.stat(path)
+                    size = stat.st_size
+                    # An entry's arrays go with it
+                    arrays = f"{path[:-5]}.npz"
+                    if os.path.exists(arrays):
+                        size += os.path.getsize(arrays)
+                else:
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, path))
+            total += size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                    if os.path.exists(f"{path[:-5]}.npz"):
+                        os.remove(f"{path[:-5]}.npz")
+                total -= size
+                Log.debug("Evicted %s from the cache", os.path.basename(path))
+            except OSError:
+                pass
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(DIRECTORY_KINDS) and os.path.isdir(path):
+                shutil.rmtree(path)
+            elif name.endswith((".json", ".npz")):
+                os.remove(path)
+        self._index = {}
+
+    def file_hash(self, path: str) -> str:
+        index = self._load_index()
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = index.get(path)
+        if known and known[0] == stamp:
+            return known[1]
+        index[path] = [stamp, hash_file(path)]
+        return index[path][1]
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _arrays(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _load_index(self) -> dict:
+        if self._index is None:
+            try:
+                with open(self._index_path, "r") as infile:
+                    self._index = json.load(infile)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        tmp = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as outfile:
+            json.dump(self._load_index(), outfile)
+        os.replace(tmp, self._index_path)
+
+
+def hash_file(path: str) -> str:
+    # SHA-256 of a file's contents
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=DEFAULT_DIR,
+        help="directory for cached results (default: .cache next to the scripts)",
+    )
+    arg_parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=DEFAULT_SIZE,
+        help=f"size in MB the cache is trimmed back to, least recently used first (default: {DEFAULT_SIZE})",
+    )
+    arg_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always recompute, and don't store the result",
+    )
+
+
+def configure(args):
+    if args.no_cache:
+        return None
+    return Cache(args.cache_dir, int(args.cache_size * (1 << 20)))
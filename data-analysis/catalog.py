@@ -0,0 +1,468 @@
+import os
+import io
+import re
+import argparse
+import functools
+import math
+import sqlite3
+from collections import Counter
+from datetime import datetime, timezone
+
+import numpy as np
+
+import instrument
+import log
+from cache import hash_file
+from instrument import span, count
+from log import Log
+from reader import LINES_PER_SECOND, header_width, open_log, prefetch, read_ride
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.sqlite")
+# Bump whenever what summarize() records changes, so every log is redone
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rides (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    width INTEGER,
+    rows INTEGER,
+    fixes INTEGER,
+    start INTEGER,
+    duration REAL,
+    min_lat REAL,
+    max_lat REAL,
+    min_lon REAL,
+    max_lon REAL,
+    gps_on REAL
+);
+CREATE TABLE IF NOT EXISTS markers (
+    path TEXT NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (path, label)
+);
+"""
+# Columns of a ride's summary, after path / size / mtime / hash
+FIELDS = ("kind", "width", "rows", "fixes", "start", "duration", "min_lat", "max_lat", "min_lon", "max_lon", "gps_on")
+# What update() picks up when walking a directory
+LOG_SUFFIXES = tuple(f"{ext}{packed}" for ext in (".txt", ".csv") for packed in ("", ".gz", ".bz2", ".xz", ".zst"))
+METERS_PER_DEGREE = 111320.0
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+arg_parser = argparse.ArgumentParser(
+    description="Catalog of ride logs and what is in them, so batch runs can pick their inputs without opening every log.",
+    usage="python catalog.py update [<file or directory> ...] | query [<filters>] [-l]",
+)
+arg_parser.add_argument(
+    "command",
+    choices=["update", "query"],
+    help="update: summarize new and changed logs and drop deleted ones; query: print the logs matching the filters",
+)
+arg_parser.add_argument(
+    "targets",
+    nargs="*",
+    help="with update, logs or directories of logs (default: files); with query, filters such as "
+    "'width=19,duration>1200,near=40.44:-79.96:2000' (see parse_filters)",
+)
+arg_parser.add_argument(
+    "--catalog",
+    type=str,
+    default=DEFAULT_PATH,
+    help="catalog file (default: catalog.sqlite next to the scripts)",
+)
+arg_parser.add_argument(
+    "-l",
+    "--long",
+    action="store_true",
+    help="with query, print a summary line per log instead of just its path",
+)
+arg_parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    default=2,
+    help="with update, how many logs are summarized at once (default: 2)",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+
+
+def first_line(path: str) -> str:
+    with io.TextIOWrapper(open_log(path)) as infile:
+        return infile.readline()
+
+
+def bounds(lat: np.ndarray, lon: np.ndarray) -> dict:
+    if not len(lat):
+        return {}
+    return {
+        "min_lat": float(lat.min()),
+        "max_lat": float(lat.max()),
+        "min_lon": float(lon.min()),
+        "max_lon": float(lon.max()),
+    }
+
+
+def gps_on_ratio(ride, times: np.ndarray) -> float:
+    # Share of the ride between its first and last row that the GPS was on:
+    # it is off from each GPS STOPPED marker to the next GPS STARTED one (or
+    # the end of the ride). Logs without markers were always on.
+    n = len(times)
+    if n < 2 or times[-1] <= times[0]:
+        return 1.0
+    stops = np.sort(times[np.minimum(ride.markers("GPS STOPPED"), n - 1)])
+    if not len(stops):
+        return 1.0
+    starts = np.sort(times[np.minimum(ride.markers("GPS STARTED"), n - 1)])
+    ends = np.append(starts, times[-1])[np.searchsorted(starts, stops, side="left")]
+    # A second stop before the GPS came back doesn't count twice
+    ends = np.minimum(ends, np.append(stops[1:], times[-1]))
+    off = float(np.clip(ends - stops, 0, None).sum())
+    return 1.0 - off / float(times[-1] - times[0])
+
+
+def summarize(path: str, workers: int = None) -> dict:
+    """
+    Everything the catalog keeps about a log: whether it is a TrackCycle
+    log or a Strava export, its columns, rows and fixes (position changes),
+    when it started (epoch ms) and how long it ran (s), the bounding box of
+    its fixes, the share of the ride the GPS was on and how many of each
+    marker it has.
+    """
+    first = first_line(path)
+    if first.startswith("s") or first.startswith("ele,time"):
+        return summarize_strava(path)
+    ride = read_ride(path, workers, columns=["lat", "lon", "time"])
+    n = len(ride)
+    timed = "time" in ride and n > 0
+    times = ride["time"] if timed else np.arange(n) * 1000 / LINES_PER_SECOND
+    summary = {
+        "kind": "trackcycle",
+        "width": header_width(ride.header),
+        "rows": n,
+        "fixes": 0,
+        "start": int(times[0]) if timed else None,
+        "duration": float(times[-1] - times[0]) / 1000 if n else 0.0,
+        "gps_on": gps_on_ratio(ride, times),
+        "markers": dict(Counter(ride.marker_labels.tolist())),
+    }
+    if "lat" in ride and "lon" in ride and n:
+        lat, lon = ride["lat"], ride["lon"]
+        valid = (lat != 0) | (lon != 0)
+        changed = np.ones(n, dtype=bool)
+        changed[1:] = (lat[1:] != lat[:-1]) | (lon[1:] != lon[:-1])
+        summary["fixes"] = int((valid & changed).sum())
+        summary.update(bounds(lat[valid], lon[valid]))
+    return summary
+
+
+def summarize_strava(path: str) -> dict:
+    # A Strava export, read the way accuracy.py reads it; it has no markers
+    # and its GPS never goes off
+    from accuracy import parse_file
+
+    fixes = parse_file(path)
+    with io.TextIOWrapper(open_log(path)) as infile:
+        rows = sum(1 for line in infile if line[:1].isdigit() or line[:1] == "-")
+    times = fixes["time"]
+    summary = {
+        "kind": "strava",
+        "width": 4,
+        "rows": rows,
+        "fixes": len(fixes),
+        "start": int(times[0]) if len(times) else None,
+        "duration": float(times[-1] - times[0]) / 1000 if len(times) else 0.0,
+        "gps_on": 1.0,
+        "markers": {},
+    }
+    summary.update(bounds(fixes["lat"], fixes["lon"]))
+    return summary
+
+
+def log_files(targets: list) -> list:
+    # The logs named, and every log under the directories named
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            for root, dirs, files in os.walk(target):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(LOG_SUFFIXES))
+        else:
+            paths.append(target)
+    return [os.path.abspath(path) for path in paths]
+
+
+class Catalog:
+    """
+    SQLite file with one row of summary figures per log (see summarize())
+    and its marker counts, keyed by absolute path. A log is summarized again
+    only when its size or mtime changed and then only if its content hash
+    did too, so keeping a corpus up to date costs a stat per log. Queries
+    only ever read the catalog.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.executescript("DROP TABLE IF EXISTS rides; DROP TABLE IF EXISTS markers;")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, targets: list, workers: int = 2) -> Counter:
+        # Bring the logs in `targets` up to date and forget the ones that
+        # were under a target directory but are gone. Returns how many logs
+        # were added, redone, touched (same content), unchanged and removed.
+        outcome = Counter()
+        paths = log_files(targets)
+        known = {row["path"]: row for row in self.db.execute("SELECT path, size, mtime, hash FROM rides")}
+        pending = []
+        for path in paths:
+            stat = os.stat(path)
+            row = known.get(path)
+            if row is not None and (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime_ns):
+                outcome["unchanged"] += 1
+                continue
+            digest = hash_file(path)
+            if row is not None and row["hash"] == digest:
+                self.db.execute(
+                    "UPDATE rides SET size = ?, mtime = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, path)
+                )
+                outcome["touched"] += 1
+                continue
+            pending.append((path, stat, digest, row is None))
+
+        # One log at a time on its own parses in parallel; several at once
+        # each parse in their own process
+        load = functools.partial(summarize, workers=1 if workers > 1 else None)
+        names = [path for path, _, _, _ in pending]
+        with span("summarize"):
+            for (path, stat, digest, new), loaded in zip(pending, prefetch(names, load, workers if workers > 1 else 0)):
+                try:
+                    summary = loaded.result()
+                except (ValueError, OSError) as err:
+                    # Recorded anyway, so it isn't tried again until it changes
+                    Log.warning(f"Could not read '{path}': {err}")
+                    summary = {"kind": "unreadable", "markers": {}}
+                self._store(path, stat, digest, summary)
+                outcome["added" if new else "refreshed"] += 1
+        count("logs summarized", len(pending))
+
+        listed = set(paths)
+        roots = [os.path.abspath(target) + os.sep for target in targets if os.path.isdir(target)]
+        gone = [path for path in known if path not in listed and path.startswith(tuple(roots))]
+        gone += [path for path in known if path in listed and not os.path.exists(path)]
+        for path in gone:
+            self.db.execute("DELETE FROM rides WHERE path = ?", (path,))
+            self.db.execute("DELETE FROM markers WHERE path = ?", (path,))
+        outcome["removed"] = len(gone)
+        self.db.commit()
+        return outcome
+
+    def _store(self, path: str, stat, digest: str, summary: dict):
+        values = [summary.get(name) for name in FIELDS]
+        self.db.execute(
+            f"INSERT OR REPLACE INTO rides (path, size, mtime, hash, {', '.join(FIELDS)}) "
+            f"VALUES ({', '.join('?' * (len(FIELDS) + 4))})",
+            [path, stat.st_size, stat.st_mtime_ns, digest] + values,
+        )
+        self.db.execute("DELETE FROM markers WHERE path = ?", (path,))
+        self.db.executemany(
+            "INSERT INTO markers (path, label, count) VALUES (?, ?, ?)",
+            [(path, label, n) for label, n in summary["markers"].items()],
+        )
+
+    def select(self, filters: list) -> list:
+        # Rows of every log matching all of `filters` (see parse_filters),
+        # in path order
+        clauses, params = [], []
+        for clause, values in filters:
+            clauses.append(clause)
+            params.extend(values)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self.db.execute(f"SELECT * FROM rides {where} ORDER BY path", params).fetchall()
+
+
+FILTER = re.compile(r"^\s*(.+?)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*$")
+NUMERIC = ("width", "rows", "fixes", "duration", "gps_on", "size")
+
+
+def parse_filters(spec: str) -> list:
+    """
+    SQL conditions from a command line spec of comma-separated filters,
+    all of which have to hold:
+
+      width=19, rows>100000, fixes>=500, duration>1200 (s), gps_on<1, size<1e6
+      kind=trackcycle / strava
+      path=*fiftyfifty*            glob on the file path
+      date>=2022-07-21             when the ride started (UTC); date=2022-07-30
+                                   is any time that day
+      near=40.44:-79.96:2000       bounding box within 2000 m of the point
+      marker:GPS STOPPED>=3        how many of a marker the log has
+
+    Returns a list of (clause, parameters).
+    """
+    filters = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        match = FILTER.match(item)
+        if not match:
+            raise ValueError(f"Bad filter '{item}', expected <name><op><value>")
+        name, op, value = match.groups()
+        if name in NUMERIC:
+            filters.append((f"{name} {op} ?", [number(item, value)]))
+        elif name == "kind":
+            filters.append((f"kind {op} ?", [value]))
+        elif name == "path" and op in ("=", "!="):
+            filters.append((f"path {'NOT ' if op == '!=' else ''}GLOB ?", [value]))
+        elif name == "date":
+            try:
+                when = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            except ValueError:
+                raise ValueError(f"Bad date in filter '{item}', expected YYYY-MM-DD")
+            # A date is the whole day [day, next day): rides start part way
+            # through it, so = and != are range checks and > / <= compare
+            # against the end of the day
+            day = int(when.timestamp() * 1000)
+            end = day + MS_PER_DAY
+            if op == "=":
+                filters.append(("start >= ? AND start < ?", [day, end]))
+            elif op == "!=":
+                filters.append(("NOT (start >= ? AND start < ?)", [day, end]))
+            elif op in (">", "<="):
+                filters.append((f"start {'>=' if op == '>' else '<'} ?", [end]))
+            else:
+                filters.append((f"start {op} ?", [day]))
+        elif name == "near" and op == "=":
+            parts = value.split(":")
+            if len(parts) != 3:
+                raise ValueError(f"Bad filter '{item}', expected near=<lat>:<lon>:<meters>")
+            lat, lon, meters = (number(item, part) for part in parts)
+            dlat = meters / METERS_PER_DEGREE
+            dlon = meters / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+            filters.append(
+                (
+                    "min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?",
+                    [lat + dlat, lat - dlat, lon + dlon, lon - dlon],
+                )
+            )
+        elif name.startswith("marker:"):
+            filters.append(
+                (
+                    f"COALESCE((SELECT count FROM markers WHERE markers.path = rides.path AND label = ?), 0) {op} ?",
+                    [name[len("marker:"):].strip(), number(item, value)],
+                )
+            )
+        else:
+            raise ValueError(f"Unknown filter '{item}'")
+    return filters
+
+
+def number(item: str, value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Bad filter '{item}', '{value}' is not a number")
+
+
+def add_arguments(arg_parser, what: str = "inputs"):
+    # --select for scripts that take a list of logs
+    arg_parser.add_argument(
+        "--select",
+        type=str,
+        help=f"add every log in the catalog matching these filters to the {what}, e.g. "
+        "'width=19,duration>1200,near=40.44:-79.96:2000' (see catalog.py; build it with `python catalog.py update`)",
+    )
+    arg_parser.add_argument(
+        "--catalog",
+        type=str,
+        default=DEFAULT_PATH,
+        help="catalog --select reads (default: catalog.sqlite next to the scripts)",
+    )
+
+
+def selected(args, cwd: str = None) -> list:
+    # Paths --select picks out, relative to the working directory (or `cwd`)
+    # where that is shorter; [] without --select. Raises ValueError on a bad
+    # filter.
+    if not args.select:
+        return []
+    path = os.path.join(cwd or "", args.catalog)
+    if not os.path.exists(path):
+        raise ValueError(f"No catalog at '{path}', run `python catalog.py update` first")
+    with Catalog(path) as catalog:
+        rows = catalog.select(parse_filters(args.select))
+    Log.info(f"--select matched {len(rows)} logs in the catalog")
+    return [display_path(row["path"], cwd) for row in rows]
+
+
+def display_path(path: str, cwd: str = None) -> str:
+    relative = os.path.relpath(path, cwd)
+    return relative if len(relative) < len(path) else path
+
+
+def print_rows(rows: list):
+    Log.flush()
+    width = max([len(display_path(row["path"])) for row in rows] + [4])
+    print(
+        f"{'path':<{width}} {'kind':<10} {'cols':>4} {'rows':>9} {'fixes':>6} {'minutes':>8} {'gps on':>7} "
+        f"{'started (UTC)':<16}"
+    )
+    for row in rows:
+        started = "-"
+        if row["start"] is not None:
+            started = datetime.fromtimestamp(row["start"] / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M")
+        minutes = "-" if row["duration"] is None else f"{row['duration'] / 60:.1f}"
+        gps_on = "-" if row["gps_on"] is None else f"{row['gps_on'] * 100:.0f}%"
+        print(
+            f"{display_path(row['path']):<{width}} {row['kind']:<10} {row['width'] or 0:>4} {row['rows'] or 0:>9} "
+            f"{row['fixes'] or 0:>6} {minutes:>8} {gps_on:>7} {started:<16}"
+        )
+
+
+def main():
+    # Options may come before, between or after the targets
+    args = arg_parser.parse_intermixed_args()
+    instrument.configure(args)
+    log.configure(args, False)
+
+    with Catalog(args.catalog) as catalog:
+        if args.command == "update":
+            targets = args.targets or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")]
+            for target in targets:
+                if not os.path.exists(target):
+                    Log.error(f"'{target}' was inaccessible or does not exist")
+                    exit(2)
+            outcome = catalog.update(targets, args.workers)
+            Log.ok(
+                f"{outcome['added']} added, {outcome['refreshed']} refreshed, {outcome['touched']} touched, "
+                f"{outcome['unchanged']} unchanged, {outcome['removed']} removed"
+            )
+            return
+        try:
+            rows = catalog.select(parse_filters(",".join(args.targets)))
+        except ValueError as err:
+            Log.error(str(err))
+            exit(1)
+    if args.long:
+        print_rows(rows)
+    else:
+        Log.flush()
+        for row in rows:
+            print(display_path(row["path"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import numpy as np
+
+from projection import LocalProjection
+from reader import LINES_PER_SECOND
+
+# Log columns dead_reckon reads
+RECKON_COLUMNS = ["lat", "lon", "speed", "azimuth", "accely", "time"]
+
+
+def row_times(time) -> np.ndarray:
+    # The log's timestamps only tick once a second. Spread the rows that share
+    # a second evenly across it so the integration has a usable dt per row.
+    time = np.asarray(time, dtype=np.float64)
+    if not len(time):
+        return time
+    _, starts, counts = np.unique(time, return_index=True, return_counts=True)
+    rank = np.arange(len(time)) - np.repeat(starts, counts)
+    return time + rank / np.repeat(counts, counts) * 1000
+
+
+def smooth(values: np.ndarray, width: int) -> np.ndarray:
+    # Centred moving average via a cumulative sum, edges use what is available
+    if width <= 1 or len(values) == 0:
+        return values
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(len(values))
+    lo = np.maximum(idx - width // 2, 0)
+    hi = np.minimum(idx + width - width // 2, len(values))
+    return (csum[hi] - csum[lo]) / (hi - lo)
+
+
+class Track:
+    """
+    A dead-reckoned position for every sensor row between the first and last
+    GPS fix of a ride, in the frame of `proj`. At fix rows the position is
+    the fix itself; in between it is rebuilt from heading, speed and forward
+    acceleration and then adjusted so it lands exactly on the next fix.
+    """
+
+    __slots__ = ("time", "x", "y", "fixes")
+
+    def __init__(self, time, x, y, fixes):
+        self.time = time
+        self.x = x
+        self.y = y
+        self.fixes = fixes
+
+    def at(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        return np.interp(times, self.time, self.x), np.interp(times, self.time, self.y)
+
+
+def dead_reckon(ride, proj: LocalProjection, smoothing: int = LINES_PER_SECOND) -> Track:
+    """
+    Rebuild the path of a ride through every gap between fixes in one pass
+    over the whole arrays.
+
+    Between two consecutive fixes the speed starts at the GPS speed of the
+    first, is integrated forward with the accelerometer, and is then corrected
+    linearly so it ends at the GPS speed of the second. Heading comes from the
+    (smoothed) azimuth. The integrated displacement's miss at the far fix is
+    spread back over the gap in proportion to distance travelled, so the
+    estimate is anchored to the fixes at both ends.
+    """
+    for name in RECKON_COLUMNS:
+        if name not in ride:
+            raise ValueError(f"Dead reckoning needs the '{name}' column")
+
+    lat, lon = ride["lat"], ride["lon"]
+    t = row_times(ride["time"])
+    valid = (lat != 0) | (lon != 0)
+    changed = np.ones(len(lat), dtype=bool)
+    changed[1:] = (lat[1:] != lat[:-1]) | (lon[1:] != lon[:-1])
+    fixes = np.flatnonzero(valid & changed)
+    if len(fixes) < 2:
+        raise ValueError("Dead reckoning needs at least two GPS fixes")
+
+    first, last = fixes[0], fixes[-1]
+    rows = np.arange(first, last + 1)
+    t = t[rows]
+    # Segment k runs from fix k up to (not including) fix k+1
+    starts = fixes - first
+    seg = np.searchsorted(starts, rows - first, side="right") - 1
+    seg = np.minimum(seg, len(fixes) - 2)
+    t0 = t[starts[seg]]
+    t1 = t[starts[seg + 1]]
+    span = np.where(t1 > t0, t1 - t0, 1.0)
+    frac_t = (t - t0) / span
+
+    dt = np.zeros(len(rows))
+    dt[1:] = np.diff(t) / 1000
+    # Running sums restart at each start fix. The step into fix k+1 is the
+    # last step of segment k, so segment k's total is read at fix k+1's row.
+    here, there = starts[:-1], starts[1:]
+
+    # Speed: integrate forward acceleration (device y axis, phone mounted
+    # upright facing the direction of travel) from the GPS speed at the start
+    # fix, then remove the linear drift that makes it miss the end fix's speed.
+    fix_speed = ride["speed"][fixes]
+    accel = np.cumsum(ride["accely"][rows] * dt)
+    v = fix_speed[seg] + accel - accel[starts[seg]]
+    v_end = fix_speed[:-1] + accel[there] - accel[here]
+    v -= (v_end - fix_speed[1:])[seg] * frac_t
+    v = np.maximum(v, 0.0)
+
+    # Heading: average the unit vectors rather than the angles so the
+    # wrap-around at +-180 degrees doesn't produce garbage
+    theta = np.radians(ride["azimuth"][rows])
+    east = smooth(np.sin(theta), smoothing)
+    north = smooth(np.cos(theta), smoothing)
+    norm = np.hypot(east, north)
+    norm[norm == 0] = 1.0
+    step = v * dt
+    cx = np.cumsum(step * east / norm)
+    cy = np.cumsum(step * north / norm)
+    cs = np.cumsum(step)
+    dx = cx - cx[starts[seg]]
+    dy = cy - cy[starts[seg]]
+    travelled = cs - cs[starts[seg]]
+
+    # How far the integration misses the next fix, spread back over the gap
+    fx, fy = proj.forward(lat[fixes], lon[fixes])
+    miss_x = (cx[there] - cx[here]) - (fx[1:] - fx[:-1])
+    miss_y = (cy[there] - cy[here]) - (fy[1:] - fy[:-1])
+    total = (cs[there] - cs[here])[seg]
+    frac = np.where(total > 0, travelled / np.where(total > 0, total, 1.0), frac_t)
+    x = fx[seg] + dx - miss_x[seg] * frac
+    y = fy[seg] + dy - miss_y[seg] * frac
+    x[starts] = fx
+    y[starts] = fy
+    return Track(t, x, y, fixes)
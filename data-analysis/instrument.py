@@ -0,0 +1,239 @@
+import os
+import sys
+import atexit
+import cProfile
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Span:
+    """
+    One named stage of a run. Re-entering a span with the same name under the
+    same parent accumulates into the existing node, so spans inside loops
+    show up once with a call count rather than once per iteration.
+    """
+
+    __slots__ = ("name", "wall", "cpu", "calls", "peak_memory", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.peak_memory = None
+        self.children = {}
+
+    def child(self, name: str) -> "Span":
+        if name not in self.children:
+            self.children[name] = Span(name)
+        return self.children[name]
+
+    def to_dict(self) -> dict:
+        ret = {
+            "name": self.name,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "calls": self.calls,
+        }
+        if self.peak_memory is not None:
+            ret["peak_memory"] = self.peak_memory
+        if self.children:
+            ret["children"] = [c.to_dict() for c in self.children.values()]
+        return ret
+
+
+class Sampler:
+    """
+    Minimal sampling profiler: a background thread periodically records the
+    main thread's stack. Much cheaper than cProfile on tight per-line loops.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.target = threading.main_thread().ident
+        self.leaves = Counter()
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.samples += 1
+            self.leaves[stack[0]] += 1
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def to_dict(self, top: int) -> dict:
+        return {
+            "type": "sample",
+            "interval": self.interval,
+            "samples": self.samples,
+            "top": [{"frame": f, "samples": n} for f, n in self.leaves.most_common(top)],
+            "stacks": [{"stack": s, "samples": n} for s, n in self.stacks.most_common(top)],
+        }
+
+
+class Profile:
+    def __init__(self):
+        self.root = Span("total")
+        self.stack = [self.root]
+        self.counters = Counter()
+        self.trace_memory = False
+        self.profiler = None
+        self.started = None
+        self.path = None
+
+    def enable(self, path: str, profiler: str = None, trace_memory: bool = False):
+        self.path = path
+        self.started = datetime.now(timezone.utc).isoformat()
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+        if profiler == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profiler == "sample":
+            self.profiler = Sampler()
+            self.profiler.start()
+        self._root_start = (time.perf_counter(), time.process_time())
+        atexit.register(self.dump)
+
+    @contextmanager
+    def span(self, name: str):
+        node = self.stack[-1].child(name)
+        self.stack.append(node)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield node
+        finally:
+            node.wall += time.perf_counter() - wall
+            node.cpu += time.process_time() - cpu
+            node.calls += 1
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                node.peak_memory = max(node.peak_memory or 0, peak)
+            self.stack.pop()
+            if self.trace_memory and len(self.stack) > 1:
+                # Let the enclosing span see the peak of its children
+                parent = self.stack[-1]
+                parent.peak_memory = max(parent.peak_memory or 0, node.peak_memory)
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def report(self, top: int = 30) -> dict:
+        if self.started is not None:
+            self.root.wall = time.perf_counter() - self._root_start[0]
+            self.root.cpu = time.process_time() - self._root_start[1]
+            self.root.calls = 1
+        ret = {
+            "argv": sys.argv,
+            "started": self.started,
+            "spans": self.root.to_dict(),
+            "counters": dict(self.counters),
+            "peak_rss_kb": peak_rss_kb(),
+        }
+        if self.trace_memory:
+            ret["peak_traced_memory"] = tracemalloc.get_traced_memory()[1]
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.disable()
+            ret["profile"] = cprofile_summary(self.profiler, top)
+        elif isinstance(self.profiler, Sampler):
+            self.profiler.stop()
+            ret["profile"] = self.profiler.to_dict(top)
+        return ret
+
+    def dump(self):
+        if not self.path:
+            return
+        path = self.path
+        # Only ever dump once, even if called explicitly and again at exit
+        self.path = None
+        with open(path, "w") as outfile:
+            json.dump(self.report(), outfile, indent=2)
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def cprofile_summary(profiler: cProfile.Profile, top: int) -> dict:
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, _) in stats.stats.items():
+        rows.append(
+            {
+                "function": f"{os.path.basename(filename)}:{func}:{line}",
+                "calls": nc,
+                "primitive_calls": cc,
+                "tottime": tt,
+                "cumtime": ct,
+            }
+        )
+    rows.sort(key=lambda row: row["cumtime"], reverse=True)
+    return {"type": "cprofile", "top": rows[:top]}
+
+
+# Process-wide profile. Spans and counters are cheap enough to leave in
+# place permanently; nothing is written unless --profile was given.
+PROFILE = Profile()
+span = PROFILE.span
+count = PROFILE.count
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="OUT.json",
+        help="write stage timings, counters and peak memory to this JSON file",
+    )
+    arg_parser.add_argument(
+        "--profiler",
+        type=str,
+        choices=["cprofile", "sample"],
+        help="also record a function-level profile in the --profile output",
+    )
+    arg_parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="track per-stage peak Python memory with tracemalloc in the --profile output (slow)",
+    )
+
+
+def configure(args):
+    if getattr(args, "profile", None):
+        PROFILE.enable(args.profile, args.profiler, args.trace_memory)
@@ -0,0 +1,177 @@
+import sys
+import atexit
+import time
+import termcolor
+
+DEBUG = 10
+INFO = 20
+OK = 25
+WARNING = 30
+ERROR = 40
+
+# Messages are buffered and written out in batches of roughly this many bytes.
+# Anything at INFO or above flushes immediately so normal runs look the same.
+FLUSH_BYTES = 1 << 16
+
+
+class Log:
+    """
+    Level-filtered, buffered logging shared by all of the analysis scripts.
+
+    error/warning/ok/info behave as they always have. debug and trace are
+    only formatted and written when the level is DEBUG; their arguments are
+    %-formatted lazily, so a filtered-out call costs one comparison. trace
+    is for per-line / per-point messages and is additionally subject to
+    sampling (every Nth message) and a per-message rate limit.
+    """
+
+    _level = INFO
+    _every = 1
+    _rate = None
+    _file = None
+    _buffer = []
+    _buffered = 0
+    _seen = {}
+    _window = {}
+    _suppressed = {}
+    _labels = {
+        ERROR: f"[ {termcolor.colored('ERROR', 'red')} ] ",
+        WARNING: f"[ {termcolor.colored('WARNING', 'yellow')} ] ",
+        OK: f"[ {termcolor.colored('OK', 'green')} ] ",
+        INFO: "[ INFO ] ",
+        DEBUG: "[ DEBUG ] ",
+    }
+    _plain = {
+        ERROR: "[ ERROR ] ",
+        WARNING: "[ WARNING ] ",
+        OK: "[ OK ] ",
+        INFO: "[ INFO ] ",
+        DEBUG: "[ DEBUG ] ",
+    }
+
+    @staticmethod
+    def configure(level: int = INFO, file: str = None, every: int = 1, rate: float = None):
+        Log.flush()
+        Log._level = level
+        Log._every = max(1, every or 1)
+        Log._rate = rate
+        if Log._file:
+            Log._file.close()
+            Log._file = None
+        if file:
+            Log._file = open(file, "w", buffering=FLUSH_BYTES)
+
+    @staticmethod
+    def enabled(level: int = DEBUG) -> bool:
+        return level >= Log._level
+
+    @staticmethod
+    def error(msg: str, *args):
+        Log._emit(ERROR, msg, args)
+
+    @staticmethod
+    def warning(msg: str, *args):
+        Log._emit(WARNING, msg, args)
+
+    @staticmethod
+    def ok(msg: str, *args):
+        Log._emit(OK, msg, args)
+
+    @staticmethod
+    def info(msg: str, *args):
+        Log._emit(INFO, msg, args)
+
+    @staticmethod
+    def debug(msg: str, *args):
+        if Log._level > DEBUG:
+            return
+        Log._emit(DEBUG, msg, args)
+
+    @staticmethod
+    def trace(msg: str, *args):
+        if Log._level > DEBUG:
+            return
+        # Sampling and rate limiting are tracked per format string, so every
+        # distinct per-item message gets its own budget.
+        seen = Log._seen.get(msg, 0) + 1
+        Log._seen[msg] = seen
+        if seen % Log._every and seen != 1:
+            Log._suppressed[msg] = Log._suppressed.get(msg, 0) + 1
+            return
+        if Log._rate:
+            now = time.monotonic()
+            start, emitted = Log._window.get(msg, (now, 0))
+            if now - start >= 1.0:
+                start, emitted = now, 0
+            if emitted >= Log._rate:
+                Log._window[msg] = (start, emitted)
+                Log._suppressed[msg] = Log._suppressed.get(msg, 0) + 1
+                return
+            Log._window[msg] = (start, emitted + 1)
+        Log._emit(DEBUG, msg, args)
+
+    @staticmethod
+    def _emit(level: int, msg: str, args: tuple):
+        if level < Log._level:
+            return
+        if args:
+            msg = msg % args
+        if Log._file:
+            Log._file.write(Log._plain[level] + msg + "\n")
+            if level <= DEBUG:
+                # Keep the terminal for results when debug output goes to a file
+                return
+        line = Log._labels[level] + msg + "\n"
+        Log._buffer.append(line)
+        Log._buffered += len(line)
+        if level >= INFO or Log._buffered >= FLUSH_BYTES:
+            Log.flush()
+
+    @staticmethod
+    def flush():
+        if Log._buffer:
+            sys.stdout.write("".join(Log._buffer))
+            Log._buffer.clear()
+            Log._buffered = 0
+        sys.stdout.flush()
+        if Log._file:
+            Log._file.flush()
+
+    @staticmethod
+    def close():
+        if Log._suppressed and Log._level <= DEBUG:
+            total = sum(Log._suppressed.values())
+            Log._suppressed = {}
+            Log._emit(DEBUG, "%d per-item message(s) were sampled out or rate limited", (total,))
+        Log.flush()
+
+
+atexit.register(Log.close)
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument(
+        "--log-file",
+        type=str,
+        help="also write log output to this file (debug output then goes only to the file)",
+    )
+    arg_parser.add_argument(
+        "--log-every",
+        type=int,
+        default=1,
+        help="with debugging on, only show every Nth per-line/per-point message (default: 1)",
+    )
+    arg_parser.add_argument(
+        "--log-rate",
+        type=float,
+        help="with debugging on, show at most this many of each per-line/per-point message per second",
+    )
+
+
+def configure(args, debug: bool):
+    Log.configure(
+        level=DEBUG if debug else INFO,
+        file=args.log_file,
+        every=args.log_every,
+        rate=args.log_rate,
+    )
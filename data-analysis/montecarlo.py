@@ -0,0 +1,111 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrument import count
+from policy import Replay
+
+# What every trial reports, per policy
+METRICS = ("time_off", "points", "energy")
+
+
+class Trials:
+    # How a Monte Carlo run draws its start times; the defaults are
+    # sensitivity.py's command line's
+    __slots__ = ("trials", "ttfs", "latency", "seed", "confidence")
+
+    def __init__(
+        self,
+        trials: int = 0,
+        ttfs: str = "uniform:1000,15000",
+        latency: str = "const:11000",
+        seed: int = 0,
+        confidence: float = 0.95,
+    ):
+        self.trials = trials
+        self.ttfs = ttfs
+        self.latency = latency
+        self.seed = seed
+        self.confidence = confidence
+
+    @staticmethod
+    def from_args(args) -> "Trials":
+        return Trials(**{name: getattr(args, name) for name in Trials.__slots__})
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in Trials.__slots__}
+
+
+def parse_distribution(spec: str):
+    """
+    A sampler from a command line spec: "const:V", "uniform:LO,HI",
+    "normal:MEAN,SD" or "triangular:LO,MODE,HI", all in ms. Normal draws are
+    clipped at 0. Returns a function (rng, n) -> array of n samples.
+    """
+    name, _, rest = spec.partition(":")
+    try:
+        values = [float(v) for v in rest.split(",") if v.strip()]
+    except ValueError:
+        raise ValueError(f"Bad distribution '{spec}', parameters should be numbers")
+    shapes = {
+        "const": (1, lambda rng, n, v: np.full(n, v)),
+        "uniform": (2, lambda rng, n, lo, hi: rng.uniform(lo, hi, n)),
+        "normal": (2, lambda rng, n, mean, sd: np.maximum(rng.normal(mean, sd, n), 0.0)),
+        "triangular": (3, lambda rng, n, lo, mode, hi: rng.triangular(lo, mode, hi, n)),
+    }
+    if name not in shapes:
+        raise ValueError(f"Unknown distribution '{name}', expected one of {', '.join(shapes)}")
+    arity, draw = shapes[name]
+    if len(values) != arity:
+        raise ValueError(f"Distribution '{name}' takes {arity} parameter(s), got {len(values)}")
+    return lambda rng, n: draw(rng, n, *values)
+
+
+def run_trials(ride, policies: list, starts: np.ndarray, receiver) -> dict:
+    """
+    Replay `ride` once per start time for every policy. All trials go
+    through a single Replay, one lane each, so the ride's features are
+    computed once and a trial only costs its own switching. Returns
+    (trials, policies) arrays of time off (s), points collected and the
+    receiver's energy (mAh).
+    """
+    lanes = [policy.started(float(start)) for start in starts for policy in policies]
+    replay = Replay(lanes)
+    replay.feed(ride)
+    count("trials", len(starts))
+    results = replay.results()
+    shape = (len(starts), len(policies))
+    time_on = np.array([r["time_on"] for r in results]).reshape(shape)
+    time_off = np.array([r["time_off"] for r in results]).reshape(shape)
+    starts_on = np.array([r["on_cycles"] for r in results]).reshape(shape)
+    points = np.array([r["points_collected"][1] for r in results]).reshape(shape)
+    return {
+        "time_off": time_off,
+        "points": points,
+        "energy": receiver.drain(time_on, time_off, starts_on),
+    }
+
+
+def simulate(ride, policies: list, starts: np.ndarray, receiver, workers: int = 1) -> dict:
+    # run_trials with the trials split evenly over a process pool
+    workers = max(1, min(workers or 1, len(starts)))
+    if workers == 1:
+        return run_trials(ride, policies, starts, receiver)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = [
+            pool.submit(run_trials, ride, policies, chunk, receiver)
+            for chunk in np.array_split(starts, workers)
+        ]
+        parts = [part.result() for part in parts]
+    return {name: np.concatenate([part[name] for part in parts]) for name in METRICS}
+
+
+def summarize(trials: dict, confidence: float = 0.95) -> dict:
+    # Mean and central `confidence` interval of each metric, per policy
+    tail = (1 - confidence) / 2 * 100
+    summary = {}
+    for name in METRICS:
+        values = trials[name]
+        lo, hi = np.percentile(values, [tail, 100 - tail], axis=0)
+        summary[name] = {"mean": values.mean(axis=0).tolist(), "lo": lo.tolist(), "hi": hi.tolist()}
+    return summary
@@ -0,0 +1,221 @@
+import numpy as np
+
+import deadreckon
+import projection
+import reader
+from deadreckon import row_times
+from projection import LocalProjection
+from reader import LINES_PER_SECOND
+
+# Log columns segment() reads
+MOTION_COLUMNS = ["lat", "lon", "speed", "accelx", "accely", "accelz", "time"]
+
+MIN_SPEED = 1.0  # m/s; walking the bike or slower counts as stopped
+BASELINE = 10.0  # s over which GPS displacement is measured, so jitter doesn't add up
+STALE_FIX = 5.0  # s after a fix that the GPS is still trusted over the accelerometer
+ACCEL_VARIANCE = 0.03  # (m/s^2)^2 of linear acceleration over a second
+MIN_MOVE = 3.0  # s; shorter movement between two stops is noise
+MIN_STOP = 10.0  # s; shorter stops are just slowing down
+
+
+class Segments:
+    """
+    Interval index of where a ride was moving. Rows [start[k], end[k]) form
+    interval k, which is moving or stationary as a whole; consecutive
+    intervals alternate. start_time / end_time are the times (ms) of each
+    interval's first and last row. Lookups are binary searches over the
+    interval starts.
+    """
+
+    __slots__ = ("start", "end", "moving", "start_time", "end_time")
+
+    def __init__(self, start, end, moving, start_time, end_time):
+        self.start = start
+        self.end = end
+        self.moving = moving
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    @staticmethod
+    def from_mask(moving: np.ndarray, times: np.ndarray) -> "Segments":
+        moving = np.asarray(moving, dtype=bool)
+        times = np.asarray(times, dtype=np.float64)
+        cuts = np.flatnonzero(moving[1:] != moving[:-1]) + 1
+        start = np.concatenate(([0], cuts)) if len(moving) else np.empty(0, dtype=np.int64)
+        end = np.concatenate((cuts, [len(moving)])) if len(moving) else np.empty(0, dtype=np.int64)
+        return Segments(start, end, moving[start], times[start], times[end - 1])
+
+    @staticmethod
+    def from_dict(data: dict) -> "Segments":
+        return Segments(
+            np.array(data["start"], dtype=np.int64),
+            np.array(data["end"], dtype=np.int64),
+            np.array(data["moving"], dtype=bool),
+            np.array(data["start_time"], dtype=np.float64),
+            np.array(data["end_time"], dtype=np.float64),
+        )
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name).tolist() for name in self.__slots__}
+
+    def find(self, rows) -> np.ndarray:
+        # Interval holding each row
+        return np.searchsorted(self.start, rows, side="right") - 1
+
+    def find_time(self, times) -> np.ndarray:
+        # Interval holding each time; times before the ride go to the first
+        return np.maximum(np.searchsorted(self.start_time, times, side="right") - 1, 0)
+
+    def mask(self) -> np.ndarray:
+        # Per row: was the ride moving
+        return np.repeat(self.moving, self.end - self.start)
+
+    def collapsed(self) -> np.ndarray:
+        # Rows to keep when every stop is collapsed to its first row
+        keep = self.mask()
+        keep[self.start[~self.moving]] = True
+        return np.flatnonzero(keep)
+
+    def durations(self) -> np.ndarray:
+        # Seconds from each interval's start to the next one's
+        ends = np.append(self.start_time[1:], self.end_time[-1:])
+        return (ends - self.start_time) / 1000
+
+    def seconds(self):
+        # (seconds moving, seconds stationary)
+        durations = self.durations()
+        return float(durations[self.moving].sum()), float(durations[~self.moving].sum())
+
+
+def settle(moving: np.ndarray, times: np.ndarray, min_move: float = MIN_MOVE, min_stop: float = MIN_STOP) -> np.ndarray:
+    # Fold runs too short to count into their neighbours: first blips of
+    # movement inside a stop, then brief stops inside movement
+    for state, shortest in ((True, min_move), (False, min_stop)):
+        segments = Segments.from_mask(moving, times)
+        flip = (segments.moving == state) & (segments.durations() < shortest)
+        moving = np.repeat(segments.moving ^ flip, segments.end - segments.start)
+    return moving
+
+
+def displacement_speed(times: np.ndarray, x: np.ndarray, y: np.ndarray, baseline: float = BASELINE) -> np.ndarray:
+    # Net speed (m/s) of each point over the last `baseline` seconds. GPS
+    # jitter while stopped moves the fix around but doesn't go anywhere.
+    k = np.arange(len(times))
+    j = np.searchsorted(times, times - baseline * 1000, side="left")
+    j = np.minimum(j, np.maximum(k - 1, 0))
+    elapsed = (times - times[j]) / 1000
+    distance = np.hypot(x - x[j], y - y[j])
+    return np.where(elapsed > 0, distance / np.where(elapsed > 0, elapsed, 1.0), 0.0)
+
+
+def rolling_variance(values: np.ndarray, window: int) -> np.ndarray:
+    # Variance of up to the last `window` values at each row
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    csq = np.concatenate(([0.0], np.cumsum(values * values)))
+    hi = np.arange(1, len(values) + 1)
+    lo = np.maximum(hi - window, 0)
+    n = hi - lo
+    mean = (csum[hi] - csum[lo]) / n
+    return np.maximum((csq[hi] - csq[lo]) / n - mean * mean, 0.0)
+
+
+def segment(
+    ride,
+    min_speed: float = MIN_SPEED,
+    accel_variance: float = ACCEL_VARIANCE,
+    min_move: float = MIN_MOVE,
+    min_stop: float = MIN_STOP,
+) -> Segments:
+    """
+    Tag every row of a ride as moving or stationary. While there has been a
+    GPS fix in the last few seconds the GPS decides: the ride is moving if
+    either the reported speed or the net displacement over the last
+    BASELINE seconds is at least `min_speed`. With the GPS off or stale, the
+    ride is moving while the variance of the linear acceleration over the
+    last second is at least `accel_variance`. Runs too short to be real are
+    then folded into their neighbours.
+    """
+    n = len(ride)
+    if "time" in ride:
+        times = row_times(ride["time"])
+    else:
+        times = np.arange(n) * 1000 / LINES_PER_SECOND
+
+    gps = np.zeros(n, dtype=bool)
+    fresh = np.zeros(n, dtype=bool)
+    if "lat" in ride and "lon" in ride and n:
+        lat, lon = ride["lat"], ride["lon"]
+        valid = (lat != 0) | (lon != 0)
+        changed = np.ones(n, dtype=bool)
+        changed[1:] = (lat[1:] != lat[:-1]) | (lon[1:] != lon[:-1])
+        fixes = np.flatnonzero(valid & changed)
+        if len(fixes):
+            last = np.searchsorted(fixes, np.arange(n), side="right") - 1
+            seen = last >= 0
+            fix = fixes[np.maximum(last, 0)]
+            fresh = seen & (times - times[fix] <= STALE_FIX * 1000)
+            proj = LocalProjection(lat[fixes], lon[fixes], mode="enu")
+            x, y = proj.forward(lat[fixes], lon[fixes])
+            travelled = displacement_speed(times[fixes], x, y)
+            gps = seen & (travelled[np.maximum(last, 0)] >= min_speed)
+    if "speed" in ride:
+        gps |= ride["speed"] >= min_speed
+
+    shaking = np.zeros(n, dtype=bool)
+    if all(name in ride for name in ("accelx", "accely", "accelz")) and n:
+        magnitude = np.sqrt(ride["accelx"] ** 2 + ride["accely"] ** 2 + ride["accelz"] ** 2)
+        shaking = rolling_variance(magnitude, LINES_PER_SECOND) >= accel_variance
+
+    moving = np.where(fresh, gps, shaking)
+    return Segments.from_mask(settle(moving, times, min_move, min_stop), times)
+
+
+def segment_track(
+    times,
+    x,
+    y,
+    min_speed: float = MIN_SPEED,
+    min_move: float = MIN_MOVE,
+    min_stop: float = MIN_STOP,
+) -> Segments:
+    # Same idea for a bare track of projected points (a Strava export, or a
+    # ride's fixes), where displacement is the only evidence there is
+    times = np.asarray(times, dtype=np.float64)
+    moving = displacement_speed(times, np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)) >= min_speed
+    return Segments.from_mask(settle(moving, times, min_move, min_stop), times)
+
+
+def thresholds() -> dict:
+    # What segment() decides with, for cache keys
+    return {
+        "lines_per_second": LINES_PER_SECOND,
+        "min_speed": MIN_SPEED,
+        "baseline": BASELINE,
+        "stale_fix": STALE_FIX,
+        "accel_variance": ACCEL_VARIANCE,
+        "min_move": MIN_MOVE,
+        "min_stop": MIN_STOP,
+    }
+
+
+def code_files() -> list:
+    # Source segments are computed by, parsing included, for cache keys
+    return [__file__, deadreckon.__file__, projection.__file__, reader.__file__]
+
+
+def ride_segments(path: str, ride, store=None) -> Segments:
+    # Segments of a log, kept in the cache next to its parsed columns so a
+    # ride is only segmented once
+    key = None
+    if store:
+        key = store.key("motion", [path], thresholds(), code_files())
+        data = store.get(key)
+        if data is not None:
+            return Segments.from_dict(data)
+    segments = segment(ride)
+    if store:
+        store.put(key, segments.to_dict())
+    return segments
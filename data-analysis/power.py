@@ -0,0 +1,88 @@
+import numpy as np
+
+# Python side of sim-rust/src/battery.rs and gps.rs. Charge is in mAh,
+# current in mA and time in seconds throughout.
+
+SECONDS_PER_HOUR = 3600.0
+
+
+class Battery:
+    """
+    A battery that only knows its capacity. Where the Rust Battery trait
+    keeps a running charge, here the charge drawn is passed in, so the same
+    profile can be evaluated for any number of simulated rides at once.
+    """
+
+    __slots__ = ("name", "capacity")
+
+    def __init__(self, name: str, capacity: float):
+        self.name = name
+        self.capacity = capacity
+
+    def life(self, drained, seconds) -> np.ndarray:
+        # Hours a full battery lasts at the average rate `drained` mAh were
+        # used over `seconds`; infinite if nothing was drawn
+        drained = np.asarray(drained, dtype=np.float64)
+        hours = np.asarray(seconds, dtype=np.float64) / SECONDS_PER_HOUR
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(drained > 0, self.capacity * hours / drained, np.inf)
+
+
+class Receiver:
+    """
+    A GPS receiver's draw as a step function of whether it is on: `on` mA
+    while on (acquiring or tracking), `off` mA while off, plus `start` mAh
+    every time it is switched back on, for receivers whose cold start costs
+    more than tracking does. gps.rs charges the NEO-7M a flat 35 per fix
+    with a TODO to make it time * current; this is that.
+    """
+
+    __slots__ = ("name", "on", "off", "start")
+
+    def __init__(self, name: str, on: float, off: float = 0.0, start: float = 0.0):
+        self.name = name
+        self.on = on
+        self.off = off
+        self.start = start
+
+    def drain(self, time_on, time_off, starts=0) -> np.ndarray:
+        # mAh used over a timeline summed up as seconds on, seconds off and
+        # the number of times the receiver came back on. Broadcasts, so a
+        # whole sweep of policies is one call.
+        time_on = np.asarray(time_on, dtype=np.float64)
+        time_off = np.asarray(time_off, dtype=np.float64)
+        return (self.on * time_on + self.off * time_off) / SECONDS_PER_HOUR + self.start * np.asarray(starts)
+
+
+BATTERIES = {
+    battery.name: battery
+    for battery in (
+        Battery("10kmAh", 10000.0),
+        Battery("4kmAh", 4500.0),
+    )
+}
+
+RECEIVERS = {
+    receiver.name: receiver
+    for receiver in (
+        Receiver("NEO7M", 35.0),
+    )
+}
+
+
+def project(results: list, batteries: list, receivers: list) -> np.ndarray:
+    """
+    Projected battery life in hours of every (result, receiver, battery),
+    as an array of that shape. A result is anything with the time_on,
+    time_off and on_cycles of a simulation (Simulator.result(),
+    Replay.results()).
+    """
+    time_on = np.array([r["time_on"] for r in results], dtype=np.float64)
+    time_off = np.array([r["time_off"] for r in results], dtype=np.float64)
+    starts = np.array([r["on_cycles"] for r in results], dtype=np.float64)
+    life = np.empty((len(results), len(receivers), len(batteries)))
+    for j, receiver in enumerate(receivers):
+        drained = receiver.drain(time_on, time_off, starts)
+        for k, battery in enumerate(batteries):
+            life[:, j, k] = battery.life(drained, time_on + time_off)
+    return life
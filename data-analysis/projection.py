@@ -0,0 +1,102 @@
+import numpy as np
+from pyproj import CRS, Transformer
+
+# Approximate average Earth radius
+EARTH_RADIUS = 6372800
+
+WGS84 = CRS.from_epsg(4326)
+
+
+def utm_crs(lat: float, lon: float) -> CRS:
+    # UTM zones are 6 degrees wide starting at 180W, EPSG 326xx north / 327xx south
+    zone = int((lon + 180) // 6) % 60 + 1
+    if lat >= 0:
+        return CRS.from_epsg(32600 + zone)
+    return CRS.from_epsg(32700 + zone)
+
+
+def enu_crs(lat: float, lon: float) -> CRS:
+    # Azimuthal equidistant centred on the ride is a good stand-in for a local
+    # east/north plane: distances from the origin are exact, and everything a
+    # bike ride covers stays well within the region where distortion is negligible.
+    return CRS.from_proj4(
+        f"+proj=aeqd +lat_0={lat} +lon_0={lon} +x_0=0 +y_0=0 +ellps=WGS84 +units=m"
+    )
+
+
+class LocalProjection:
+    """
+    Projects WGS84 latitude/longitude into a local metric (x=east, y=north) frame
+    so that distances can be taken with plain Euclidean arithmetic.
+
+    mode is either "utm" (zone picked from the centre of the data) or "enu"
+    (a plane tangent to the centre of the data).
+    """
+
+    def __init__(self, lat, lon, mode: str = "utm"):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        valid = (lat != 0) | (lon != 0)
+        if not valid.any():
+            raise ValueError("Cannot choose a projection without any valid fixes")
+        self.origin = (
+            float((lat[valid].min() + lat[valid].max()) / 2),
+            float((lon[valid].min() + lon[valid].max()) / 2),
+        )
+        self.mode = mode
+        if mode == "utm":
+            self.crs = utm_crs(*self.origin)
+        elif mode == "enu":
+            self.crs = enu_crs(*self.origin)
+        else:
+            raise ValueError(f"Unknown projection mode '{mode}'")
+        self._forward = Transformer.from_crs(WGS84, self.crs, always_xy=True)
+        self._inverse = Transformer.from_crs(self.crs, WGS84, always_xy=True)
+
+    def forward(self, lat, lon):
+        x, y = self._forward.transform(
+            np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        )
+        return np.asarray(x), np.asarray(y)
+
+    def inverse(self, x, y):
+        lon, lat = self._inverse.transform(
+            np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        )
+        return np.asarray(lat), np.asarray(lon)
+
+    def __repr__(self):
+        return f"LocalProjection(mode={self.mode!r}, origin={self.origin}, crs={self.crs.name!r})"
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great-circle distance in meters, elementwise
+    # Formula source: https://en.wikipedia.org/wiki/Haversine_formula#Formulation
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    alph = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(alph), np.sqrt(1 - alph))
+
+
+def nearest(qx, qy, rx, ry, block: int = 4_000_000):
+    """
+    For every query point (qx, qy) find the closest reference point (rx, ry).
+    Returns (distances, indices). Queries are handled in chunks so that no more
+    than roughly `block` squared distances are held in memory at once.
+    """
+    qx = np.asarray(qx, dtype=np.float64)
+    qy = np.asarray(qy, dtype=np.float64)
+    rx = np.asarray(rx, dtype=np.float64)
+    ry = np.asarray(ry, dtype=np.float64)
+    distances = np.empty(len(qx))
+    indices = np.empty(len(qx), dtype=np.int64)
+    chunk = max(1, block // max(len(rx), 1))
+    for lo in range(0, len(qx), chunk):
+        hi = min(lo + chunk, len(qx))
+        d2 = (qx[lo:hi, None] - rx[None, :]) ** 2 + (qy[lo:hi, None] - ry[None, :]) ** 2
+        idx = d2.argmin(axis=1)
+        indices[lo:hi] = idx
+        distances[lo:hi] = np.sqrt(d2[np.arange(hi - lo), idx])
+    return distances, indices
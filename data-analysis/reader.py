@@ -0,0 +1,689 @@
+import os
+import io
+import json
+import shutil
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from log import Log
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16      17    18
+# lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current,capmah,engnwh
+COLUMNS = [
+    "lat",
+    "lon",
+    "alt",
+    "acc",
+    "speed",
+    "accelx",
+    "accely",
+    "accelz",
+    "gyrox",
+    "gyroy",
+    "gyroz",
+    "azimuth",
+    "pitch",
+    "roll",
+    "time",
+    "batpct",
+    "current",
+    "capmah",
+    "engnwh",
+]
+
+# Roughly how many rows the app writes per second
+LINES_PER_SECOND = 90  # It is around this number, not exactly 90
+
+# Below this size a single range parsed in-process beats paying for the pool
+PARALLEL_THRESHOLD = 8 << 20
+MIN_CHUNK = 4 << 20
+# Decompressed blocks allowed to queue up ahead of the parser
+INFLATE_DEPTH = 2
+
+
+class Chunk:
+    """
+    Everything parsed out of one byte range of a log. Row and line numbers
+    are local to the range until Ride.stitch offsets them. `names` are the
+    columns of `values`; `row_lines` is only set when rows were dropped (by a
+    row predicate, or because they didn't parse), since the line of each row
+    can't be worked out afterwards.
+    """
+
+    __slots__ = ("values", "names", "marker_rows", "marker_lines", "marker_labels", "lines", "row_lines")
+
+    def __init__(self, values, names, marker_rows, marker_lines, marker_labels, lines, row_lines=None):
+        self.values = values
+        self.names = names
+        self.marker_rows = marker_rows
+        self.marker_lines = marker_lines
+        self.marker_labels = marker_labels
+        self.lines = lines
+        self.row_lines = row_lines
+
+
+class Ride:
+    """
+    A parsed TrackCycle log held as one float64 array per column.
+
+    Markers are kept as three parallel arrays: the text between the dashes,
+    the file line the marker was on, and the number of data rows that came
+    before it (i.e. the row it sits in front of).
+
+    A Ride can also be just the part of a log appended since the last Tail
+    poll, in which case first_row / first_line say where it starts in the file.
+    Either way lines is the line just past its end; `dropped` counts the rows
+    in between that select() left out.
+    """
+
+    def __init__(self, path: str, header: str, columns: dict, marker_rows, marker_lines, marker_labels, lines: int, first_row: int = 0, first_line: int = 1, line_numbers=None, dropped: int = 0):
+        self.path = path
+        self.header = header
+        self.columns = columns
+        self.marker_rows = marker_rows
+        self.marker_lines = marker_lines
+        self.marker_labels = marker_labels
+        self.lines = lines
+        self.first_row = first_row
+        self.first_line = first_line
+        self.line_numbers = line_numbers
+        self.dropped = dropped
+
+    @property
+    def width(self) -> int:
+        return len(self.columns)
+
+    def __len__(self) -> int:
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.columns, copy=False)
+
+    def markers(self, label: str) -> np.ndarray:
+        # Row positions of every marker with the given text
+        return self.marker_rows[self.marker_labels == label]
+
+    def line_count(self) -> int:
+        # Lines of the file this ride covers, less the rows select() dropped,
+        # so per-line averages cover only the rows that are kept
+        return self.lines - self.first_line - self.dropped
+
+    def select(self, keep) -> "Ride":
+        # Just the given rows (indices or a mask); a marker in front of a
+        # dropped row moves onto the next row that's kept. The ride still
+        # spans the same lines of the file.
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            keep = np.flatnonzero(keep)
+        return Ride(
+            self.path,
+            self.header,
+            {name: values[keep] for name, values in self.columns.items()},
+            np.searchsorted(keep, self.marker_rows),
+            self.marker_lines,
+            self.marker_labels,
+            self.lines,
+            self.first_row,
+            self.first_line,
+            line_numbers=self.row_lines()[keep],
+            dropped=self.dropped + len(self) - len(keep),
+        )
+
+    def row_lines(self) -> np.ndarray:
+        # File line number of every data row
+        if self.line_numbers is not None:
+            return self.line_numbers
+        rows = np.arange(len(self))
+        return self.first_line + rows + np.searchsorted(self.marker_rows, rows, side="right")
+
+    @staticmethod
+    def stitch(path: str, header: str, chunks: list, header_lines: int = 1, first_row: int = 0) -> "Ride":
+        row_offset = 0
+        line_offset = header_lines
+        rows, lines, row_lines = [], [], []
+        for chunk in chunks:
+            rows.append(chunk.marker_rows + row_offset)
+            lines.append(chunk.marker_lines + line_offset)
+            row_lines.append(None if chunk.row_lines is None else chunk.row_lines + line_offset)
+            row_offset += len(chunk.values)
+            line_offset += chunk.lines
+        filled = [chunk for chunk in chunks if len(chunk.values)]
+        columns = {}
+        for name in COLUMNS:
+            if not any(name in chunk.names for chunk in filled):
+                continue
+            # A range that only saw short rows is padded so the ranges line up
+            columns[name] = np.concatenate(
+                [
+                    chunk.values[:, chunk.names.index(name)]
+                    if name in chunk.names
+                    else np.full(len(chunk.values), np.nan)
+                    for chunk in filled
+                ]
+            )
+        return Ride(
+            path,
+            header,
+            columns,
+            np.concatenate(rows) if rows else np.empty(0, dtype=np.int64),
+            np.concatenate(lines) if lines else np.empty(0, dtype=np.int64),
+            np.concatenate([chunk.marker_labels for chunk in chunks]) if chunks else np.empty(0, dtype=object),
+            line_offset,
+            first_row,
+            header_lines,
+            Ride.join_row_lines(chunks, row_lines, header_lines),
+        )
+
+    @staticmethod
+    def join_row_lines(chunks: list, row_lines: list, line_offset: int):
+        # Line of every row across the chunks, or None if no chunk had to
+        # record its own (the lines then follow from the markers)
+        if all(lines is None for lines in row_lines):
+            return None
+        for k, chunk in enumerate(chunks):
+            if row_lines[k] is None:
+                rows = np.arange(len(chunk.values))
+                row_lines[k] = line_offset + rows + np.searchsorted(chunk.marker_rows, rows, side="right")
+            line_offset += chunk.lines
+        return np.concatenate(row_lines)
+
+
+def header_width(header: str) -> int:
+    # How many columns the log has, going by its header row. Anything that
+    # isn't a TrackCycle header is assumed to be as wide as they come.
+    names = [name.strip() for name in header.split(",")]
+    if names and names == COLUMNS[: len(names)]:
+        return len(names)
+    return len(COLUMNS)
+
+
+def has_fix(columns: dict) -> np.ndarray:
+    # Row predicate: the row carries a GPS position (0.0/0.0 means no fix yet)
+    return (columns["lat"] != 0) | (columns["lon"] != 0)
+
+
+def parse_values(text: bytes, columns: list = None, width: int = len(COLUMNS)):
+    # (values, names) for the data rows in `text`
+    if columns is not None:
+        wanted = sorted({COLUMNS.index(name) for name in columns if COLUMNS.index(name) < width})
+        try:
+            # Only the wanted fields are converted; the rest are just skipped over
+            values = pd.read_csv(
+                io.BytesIO(text),
+                header=None,
+                names=range(width),
+                usecols=wanted,
+                dtype=np.float64,
+                engine="c",
+            ).to_numpy()
+            return values, [COLUMNS[i] for i in wanted]
+        except pd.errors.ParserError:
+            # Rows wider than the header; parse everything and pick after
+            values, names = parse_values(text)
+            keep = [i for i in wanted if i < len(names)]
+            return values[:, keep], [COLUMNS[i] for i in keep]
+    # Naming all 19 columns lets short rows come back NaN-padded instead
+    # of failing the parse; unused trailing columns are dropped after.
+    # The default float parser can be one ulp off float(); round_trip
+    # would fix that but makes the whole parse ~2.5x slower.
+    values = pd.read_csv(
+        io.BytesIO(text),
+        header=None,
+        names=range(len(COLUMNS)),
+        dtype=np.float64,
+        engine="c",
+    ).to_numpy()
+    used = np.flatnonzero(~np.isnan(values).all(axis=0))
+    values = values[:, : used[-1] + 1 if len(used) else 0]
+    return values, COLUMNS[: values.shape[1]]
+
+
+# Every byte a row of numbers can be made of; "nan" and "inf" aren't, so
+# they are let through one row at a time
+NUMBER_BYTES = b"0123456789.,+-eE \t\r\n"
+
+
+def parses(row: bytes) -> bool:
+    # Whether a data row is all numbers (or empty fields), and no wider than
+    # a log can be
+    fields = row.split(b",")
+    if len(fields) > len(COLUMNS):
+        return False
+    for field in fields:
+        if field.strip():
+            try:
+                float(field)
+            except ValueError:
+                return False
+    return True
+
+
+def parse_bytes(data: bytes, columns: list = None, where=None, width: int = len(COLUMNS)) -> Chunk:
+    """
+    Parse a run of complete log lines. `columns` limits the parse to those
+    columns (of the `width` the log has); `where` is a row predicate, called
+    with the parsed columns by name, and rows it rejects are dropped with
+    markers moved onto the next row that's kept. Predicates used with a
+    process pool have to be module-level functions.
+    """
+    lines = data.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    rows, row_lines = [], []
+    marker_rows, marker_lines, marker_labels = [], [], []
+    for idx, line in enumerate(lines):
+        if line.startswith(b"--"):
+            marker_rows.append(len(rows))
+            marker_lines.append(idx)
+            marker_labels.append(line.rstrip(b"\r").lstrip(b"-").rstrip(b"-").decode())
+        elif line.strip():
+            rows.append(line)
+            row_lines.append(idx)
+    marker_rows = np.array(marker_rows, dtype=np.int64)
+    kept_lines = None
+    text = b"\n".join(rows)
+    values = None
+    if not text.translate(None, NUMBER_BYTES):
+        try:
+            values, names = parse_values(text, columns, width) if rows else (np.empty((0, 0)), [])
+        except ValueError:
+            pass
+    if values is None:
+        # Something in the block isn't a number (a log cut off by a crashed
+        # phone, say). Drop just those rows, as if they were never written;
+        # checking here rather than trusting the parse also catches junk in
+        # columns the parse skips over.
+        good = np.array([k for k, row in enumerate(rows) if parses(row)], dtype=np.int64)
+        for k in sorted(set(range(len(rows))) - set(good.tolist())):
+            Log.warning(f"Dropping a row that isn't all numbers: '{rows[k].decode(errors='replace').strip()}'")
+        marker_rows = np.searchsorted(good, marker_rows)
+        rows = [rows[k] for k in good]
+        row_lines = [row_lines[k] for k in good]
+        kept_lines = np.array(row_lines, dtype=np.int64)
+        values, names = parse_values(b"\n".join(rows), columns, width) if rows else (np.empty((0, 0)), [])
+    if where is not None:
+        keep = np.flatnonzero(where(dict(zip(names, values.T)))) if len(values) else np.empty(0, dtype=np.int64)
+        values = values[keep]
+        # A marker now sits in front of the first kept row after it
+        marker_rows = np.searchsorted(keep, marker_rows)
+        kept_lines = np.array(row_lines, dtype=np.int64)[keep]
+    return Chunk(
+        values,
+        names,
+        marker_rows,
+        np.array(marker_lines, dtype=np.int64),
+        np.array(marker_labels, dtype=object),
+        len(lines),
+        kept_lines,
+    )
+
+
+def parse_range(path: str, start: int, end: int, columns: list = None, where=None, width: int = len(COLUMNS)) -> Chunk:
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        return parse_bytes(infile.read(end - start), columns, where, width)
+
+
+def split_ranges(path: str, start: int, parts: int) -> list:
+    # Cut [start, size) into roughly equal pieces, moving each cut forward to
+    # just past the next newline so no line is split between two ranges.
+    size = os.path.getsize(path)
+    step = max((size - start) // parts, 1)
+    cuts = [start]
+    with open(path, "rb") as infile:
+        for k in range(1, parts):
+            pos = start + k * step
+            if pos <= cuts[-1]:
+                continue
+            infile.seek(pos)
+            infile.readline()
+            pos = infile.tell()
+            if pos >= size:
+                break
+            cuts.append(pos)
+    cuts.append(size)
+    return [(cuts[k], cuts[k + 1]) for k in range(len(cuts) - 1) if cuts[k + 1] > cuts[k]]
+
+
+def open_zstd(path: str):
+    if zstandard is None:
+        raise ValueError(f"Reading '{path}' needs the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+# Compressed log formats, by extension
+OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+    ".zst": open_zstd,
+}
+
+
+def is_compressed(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in OPENERS
+
+
+def open_log(path: str):
+    # Binary file object over the log's text, decompressing on the fly
+    opener = OPENERS.get(os.path.splitext(path)[1].lower())
+    return opener(path) if opener else open(path, "rb")
+
+
+def read_ahead(items, depth: int = INFLATE_DEPTH, name: str = "read ahead"):
+    """
+    Run an iterator on a background thread, yielding its items in order.
+    Up to `depth` items are produced ahead of the caller and wait in memory;
+    the thread then blocks until the caller takes one. Whatever the iterator
+    raises is raised to the caller.
+    """
+    queued = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer has gone away rather than block forever
+        while not stop.is_set():
+            try:
+                queued.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                put(item)
+            put(done)
+        except Exception as err:
+            put(err)
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queued.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def inflate(path: str, block_size: int = MIN_CHUNK, depth: int = INFLATE_DEPTH):
+    """
+    Decompress a log on a background thread, yielding blocks of up to
+    `block_size` bytes. The decompressors release the GIL, so the next block
+    is inflated while the caller parses this one. At most `depth` blocks wait
+    in memory and nothing is written to disk.
+    """
+    def blocks():
+        with open_log(path) as infile:
+            while True:
+                block = infile.read(block_size)
+                if not block:
+                    return
+                yield block
+
+    return read_ahead(blocks(), depth, name=f"inflate {os.path.basename(path)}")
+
+
+def line_blocks(path: str, block_size: int = MIN_CHUNK):
+    # (header, data) for each newline-aligned block of a compressed log. The
+    # first item is always yielded, even for an empty log, so the header is
+    # known.
+    header, carry, sent = None, b"", False
+    for block in inflate(path, block_size):
+        data = carry + block
+        if header is None:
+            cut = data.find(b"\n")
+            if cut < 0:
+                carry = data
+                continue
+            header = data[:cut].decode().strip()
+            data = data[cut + 1 :]
+        cut = data.rfind(b"\n")
+        carry = data[cut + 1 :]
+        if cut >= 0:
+            sent = True
+            yield header, data[: cut + 1]
+    if header is None:
+        header, carry = carry.decode().strip(), b""
+    if carry or not sent:
+        yield header, carry
+
+
+def read_header(path: str):
+    with open_log(path) as infile:
+        header = infile.readline()
+        return header.decode().strip(), infile.tell()
+
+
+def read_ride(path: str, workers: int = None, columns: list = None, where=None) -> Ride:
+    """
+    Parse a TrackCycle log. Large files are split into newline-aligned byte
+    ranges that are parsed on a process pool and stitched back together in
+    order. workers=1 forces a single in-process pass.
+
+    Compressed logs (.gz, .bz2, .xz, .zst) can't be split up front; they are
+    inflated on a background thread and parsed block by block as they arrive.
+
+    `columns` and `where` project and filter the rows as in parse_bytes.
+    """
+    if is_compressed(path):
+        header, chunks = None, []
+        for header, data in line_blocks(path):
+            chunks.append(parse_bytes(data, columns, where, header_width(header)))
+        return Ride.stitch(path, header, chunks)
+    header, start = read_header(path)
+    width = header_width(header)
+    size = os.path.getsize(path)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, (size - start) // MIN_CHUNK + 1))
+    if workers == 1 or size < PARALLEL_THRESHOLD:
+        return Ride.stitch(path, header, [parse_range(path, start, size, columns, where, width)])
+
+    ranges = split_ranges(path, start, workers)
+    n = len(ranges)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = list(
+            pool.map(parse_range, [path] * n, *zip(*ranges), [columns] * n, [where] * n, [width] * n)
+        )
+    return Ride.stitch(path, header, chunks)
+
+
+def iter_ride(path: str, chunk_bytes: int = MIN_CHUNK, columns: list = None, where=None):
+    """
+    Parse a log a newline-aligned byte range at a time, yielding each range
+    as a Ride positioned at the right row/line of the file. Only one range
+    is held in memory at once. Compressed logs are inflated a block of
+    `chunk_bytes` at a time on a background thread.
+    """
+    if is_compressed(path):
+        chunks = (
+            (header, parse_bytes(data, columns, where, header_width(header)))
+            for header, data in line_blocks(path, max(chunk_bytes, 1))
+        )
+    else:
+        header, start = read_header(path)
+        width = header_width(header)
+        size = os.path.getsize(path)
+        parts = max(1, (size - start) // max(chunk_bytes, 1))
+        chunks = (
+            (header, parse_range(path, lo, hi, columns, where, width))
+            for lo, hi in split_ranges(path, start, parts)
+        )
+    rows, lines = 0, 1
+    for header, chunk in chunks:
+        yield Ride.stitch(path, header, [chunk], lines, rows)
+        rows += len(chunk.values)
+        lines += chunk.lines
+
+
+class Loaded:
+    # A load that ran in-process, with the same result() as a pool future
+    __slots__ = ("_value", "_error")
+
+    def __init__(self, load, path: str):
+        self._value = self._error = None
+        try:
+            self._value = load(path)
+        except Exception as err:
+            self._error = err
+
+    def result(self):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+def prefetch(paths: list, load=read_ride, depth: int = 2):
+    """
+    Load a list of files in order, keeping up to `depth` of the next ones
+    loading on a process pool while the caller works on the current one.
+    Yields one future per path, in order; its result() is the loaded file
+    (or raises whatever the load raised), and waits only if the file isn't
+    ready yet. Nothing more is submitted until the caller asks for the next
+    file, so at most `depth` loaded files are ever waiting in memory.
+
+    `load` has to be picklable (a module-level function or a partial of
+    one). depth=0 loads each file in-process when it's asked for.
+    """
+    if depth <= 0 or len(paths) <= 1:
+        for path in paths:
+            yield Loaded(load, path)
+        return
+    pool = ProcessPoolExecutor(max_workers=depth)
+    try:
+        pending = [pool.submit(load, path) for path in paths[:depth]]
+        for k in range(len(paths)):
+            if k + depth < len(paths):
+                pending.append(pool.submit(load, paths[k + depth]))
+            yield pending[k]
+            pending[k] = None
+    finally:
+        # Don't keep loading files nobody is going to ask for
+        pool.shutdown(cancel_futures=True)
+
+
+def save_ride(ride: Ride, directory: str):
+    """
+    Write a parsed ride out as a binary column store: one .npy file per
+    column plus the markers, so a later load only maps the columns it needs
+    instead of parsing the text again. The store is built beside `directory`
+    and renamed into place, so a reader never sees half of one.
+    """
+    if ride.line_numbers is not None:
+        raise ValueError("Only whole rides can be stored, not filtered ones")
+    tmp = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(tmp, exist_ok=True)
+    for name, values in ride.columns.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), values)
+    np.save(os.path.join(tmp, "marker_rows.npy"), ride.marker_rows)
+    np.save(os.path.join(tmp, "marker_lines.npy"), ride.marker_lines)
+    np.save(os.path.join(tmp, "marker_labels.npy"), ride.marker_labels.astype(str))
+    meta = {"header": ride.header, "columns": list(ride.columns), "lines": ride.lines}
+    with open(os.path.join(tmp, "ride.json"), "w") as outfile:
+        json.dump(meta, outfile)
+    try:
+        os.rename(tmp, directory)
+    except OSError:
+        # Someone else stored it first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_ride(directory: str, path: str, columns: list = None, where=None) -> Ride:
+    # Ride from a column store written by save_ride. Only the requested
+    # columns are opened, memory-mapped, so the rest are never read.
+    with open(os.path.join(directory, "ride.json"), "r") as infile:
+        meta = json.load(infile)
+    names = [name for name in meta["columns"] if columns is None or name in columns]
+    data = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in names}
+    ride = Ride(
+        path,
+        meta["header"],
+        data,
+        np.load(os.path.join(directory, "marker_rows.npy")),
+        np.load(os.path.join(directory, "marker_lines.npy")),
+        np.load(os.path.join(directory, "marker_labels.npy")).astype(object),
+        meta["lines"],
+    )
+    if where is None:
+        return ride
+    return ride.select(where(data) if len(ride) else np.empty(0, dtype=np.int64))
+
+
+class Tail:
+    """
+    Follows a log that is still being written. Each poll parses only the
+    complete lines appended since the previous poll and returns them as a
+    Ride positioned at the right row/line of the file, or None if nothing new
+    has arrived. If the file shrinks (the device restarted the log) the tail
+    starts over from the top and sets `restarted`.
+    """
+
+    def __init__(self, path: str):
+        if is_compressed(path):
+            raise ValueError(f"Can't follow '{path}', it is compressed")
+        self.path = path
+        self.header = None
+        self.offset = 0
+        self.rows = 0
+        self.lines = 0
+        self.restarted = False
+
+    def poll(self):
+        self.restarted = False
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            self.header = None
+            self.offset = self.rows = self.lines = 0
+            self.restarted = True
+        with open(self.path, "rb") as infile:
+            if self.header is None:
+                header = infile.readline()
+                if not header.endswith(b"\n"):
+                    return None
+                self.header = header.decode().strip()
+                self.offset = infile.tell()
+                self.lines = 1
+            infile.seek(self.offset)
+            data = infile.read()
+        cut = data.rfind(b"\n")
+        if cut < 0:
+            return None
+        self.offset += cut + 1
+        chunk = parse_bytes(data[: cut + 1])
+        ride = Ride.stitch(self.path, self.header, [chunk], self.lines, self.rows)
+        self.rows += len(chunk.values)
+        self.lines += chunk.lines
+        return ride
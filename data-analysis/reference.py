@@ -0,0 +1,79 @@
+import os
+import json
+import pickle
+import shutil
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from align import synchronize
+from projection import LocalProjection
+
+
+class ReferenceTrack:
+    """
+    An always-on ride set up once to be compared against many others: its
+    fixes projected into a frame of its own, with a k-d tree over the
+    projected positions. A nearest-point query then costs O(log m) per
+    candidate point instead of a scan of the whole reference, and a saved
+    track is memory-mapped back in, so any number of processes can share it
+    without parsing or projecting it again.
+    """
+
+    __slots__ = ("path", "points", "proj", "tree")
+
+    def __init__(self, path: str, points: np.ndarray, proj: LocalProjection, tree: cKDTree = None):
+        self.path = path
+        self.points = points
+        self.proj = proj
+        if tree is None:
+            tree = cKDTree(np.column_stack((points["x"], points["y"])))
+        self.tree = tree
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    @staticmethod
+    def build(path: str, fixes: np.ndarray, mode: str = "utm") -> "ReferenceTrack":
+        # From parsed fixes (accuracy.fix_dtype), which are left as they are
+        proj = LocalProjection(fixes["lat"], fixes["lon"], mode=mode)
+        points = fixes.copy()
+        points["x"], points["y"] = proj.forward(points["lat"], points["lon"])
+        return ReferenceTrack(path, points, proj)
+
+    def nearest(self, x, y):
+        # (distances, indices) of the closest reference point to each (x, y)
+        distances, indices = self.tree.query(np.column_stack((x, y)))
+        return distances, indices.astype(np.int64)
+
+    def at(self, times, max_gap: float):
+        # Where the reference was at each time (ms), see align.synchronize
+        return synchronize(times, self.points["time"], self.points["x"], self.points["y"], max_gap)
+
+    def save(self, directory: str):
+        # Same layout rules as reader.save_ride: built beside `directory`
+        # and renamed into place
+        tmp = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, "points.npy"), self.points)
+        with open(os.path.join(tmp, "tree.pickle"), "wb") as outfile:
+            pickle.dump(self.tree, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        meta = {"path": self.path, "mode": self.proj.mode, "origin": list(self.proj.origin)}
+        with open(os.path.join(tmp, "reference.json"), "w") as outfile:
+            json.dump(meta, outfile)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @staticmethod
+    def load(directory: str) -> "ReferenceTrack":
+        with open(os.path.join(directory, "reference.json"), "r") as infile:
+            meta = json.load(infile)
+        points = np.load(os.path.join(directory, "points.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "tree.pickle"), "rb") as infile:
+            tree = pickle.load(infile)
+        # A projection fitted to its own origin alone comes out the same
+        lat, lon = meta["origin"]
+        proj = LocalProjection([lat], [lon], mode=meta["mode"])
+        return ReferenceTrack(meta["path"], points, proj, tree)
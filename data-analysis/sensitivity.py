@@ -3,20 +3,50 @@
 # https://github.com/Elsklivet
 
 import os
+import sys
 import argparse
-import termcolor
 import time
 from collections import deque
+from functools import partial
+
+import numpy as np
+
+import cache
+import catalog
+import montecarlo
+import motion
+import instrument
+import log
+import policy
+import power
+import reader
+from instrument import span, count
+from log import Log
+from montecarlo import Trials
+from motion import MOTION_COLUMNS, ride_segments
+from policy import (
+    GPS_CYCLE_OFF_TIME,
+    GPS_CYCLE_SAVE_THRESHOLD,
+    GPS_START_TIME,
+    NUM_PTS_TO_AVG,
+    TTFS,
+    AzimuthPolicy,
+    Replay,
+    parse_policies,
+)
+from power import BATTERIES, RECEIVERS, project
+from reader import LINES_PER_SECOND, Ride, Tail, prefetch, read_ride
 
 arg_parser = argparse.ArgumentParser(
     description="Commit sensitivit analysis about the azimuth-trigger parameter for TrackCycle.",
-    usage="python sensitivity.py -i <input file path> [-a <trigger angle> -d <debug level: integer>]",
+    usage="python sensitivity.py -i <input file path> [<input file path> ...] [-a <trigger angle> -d <debug level: integer>]",
 )
 arg_parser.add_argument(
     "-i",
     "--input",
     type=str,
-    help="input file path from which to read sensor data (note: sensor data should be in a CSV style file)",
+    nargs="+",
+    help="input file path(s) from which to read sensor data (note: sensor data should be in a CSV style file)",
 )
 arg_parser.add_argument(
     "-a",
@@ -30,6 +60,91 @@ arg_parser.add_argument(
     type=int,
     help="debug level (0=no debugging (default), 1=debugging on)",
 )
+arg_parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    help="number of processes used to parse large files (default: one per core)",
+)
+arg_parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=2,
+    help="with several inputs, how many of the next files to parse in the background while one is simulated (default: 2)",
+)
+arg_parser.add_argument(
+    "--skip-stationary",
+    action="store_true",
+    help="leave out the stretches where the ride was stopped (see motion.py)",
+)
+arg_parser.add_argument(
+    "-f",
+    "--follow",
+    type=float,
+    nargs="?",
+    const=2.0,
+    metavar="SECONDS",
+    help="keep watching the input file and re-simulate whenever lines are appended (default refresh: 2 s)",
+)
+arg_parser.add_argument(
+    "-p",
+    "--policy",
+    type=str,
+    action="append",
+    help="replay a duty-cycling policy instead of the azimuth trigger, e.g. 'azimuth:angle=15/30/45', "
+    "'time:on=24,off=10', 'gyro:energy=0.01', 'speed:angle=45,speed=2'; repeat to compare several in one pass",
+)
+arg_parser.add_argument(
+    "--battery",
+    type=str,
+    action="append",
+    choices=list(BATTERIES),
+    help="project how long this battery would power the GPS receiver under each simulated duty cycle; repeat for several",
+)
+arg_parser.add_argument(
+    "--receiver",
+    type=str,
+    action="append",
+    choices=list(RECEIVERS),
+    help=f"GPS receiver to project battery life for, with --battery; repeat for several (default: {next(iter(RECEIVERS))})",
+)
+arg_parser.add_argument(
+    "--trials",
+    type=int,
+    default=0,
+    help="Monte Carlo mode: replay the ride this many times with a random time to first fix and start latency, "
+    "and report confidence intervals for time off, points collected and receiver energy",
+)
+arg_parser.add_argument(
+    "--ttfs",
+    type=str,
+    default="uniform:1000,15000",
+    help="with --trials, distribution of the time to first fix in ms: const:V, uniform:LO,HI, normal:MEAN,SD "
+    "or triangular:LO,MODE,HI (default: uniform:1000,15000)",
+)
+arg_parser.add_argument(
+    "--latency",
+    type=str,
+    default="const:11000",
+    help="with --trials, distribution of the ms from switching the GPS on to it starting to search, same forms as "
+    "--ttfs (default: const:11000, so the defaults' 3000 ms TTFS gives the usual GPS_START_TIME)",
+)
+arg_parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help="with --trials, seed for the random draws (default: 0)",
+)
+arg_parser.add_argument(
+    "--confidence",
+    type=float,
+    default=0.95,
+    help="with --trials, coverage of the reported intervals (default: 0.95)",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+cache.add_arguments(arg_parser)
+catalog.add_arguments(arg_parser)
 
 args = None
 debug = False
@@ -51,216 +166,164 @@ debug = False
 # 180 |  3.141593 (pi)
 
 ANGLE = 45.0
-TTFS = 3000  # This actually could be anywhere from 1000 to 15000 :)
-GPS_START_TIME = 14000
-GPS_CYCLE_SAVE_THRESHOLD = 10000
-GPS_CYCLE_OFF_TIME = GPS_START_TIME + GPS_CYCLE_SAVE_THRESHOLD
-LINES_PER_SECOND = 90  # It is around this number, not exactly 90
-NUM_PTS_TO_AVG = 500
-
-
-class Log:
-    def error(msg: str):
-        level = termcolor.colored(f"ERROR", "red")
-        print(f"[ {level} ] {msg}")
-
-    def warning(msg: str):
-        level = termcolor.colored(f"WARNING", "yellow")
-        print(f"[ {level} ] {msg}")
-
-    def ok(msg: str):
-        level = termcolor.colored(f"OK", "green")
-        print(f"[ {level} ] {msg}")
-
-    def info(msg: str):
-        print(f"[ INFO ] {msg}")
-
-
-def parse_line(line: str):
-    # 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16      17     18
-    # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current,capmah,engnwh
-    vals = line.split(",")
-    ret = None
-    
-    if len(vals) == 17:
-        ret = {
-            "lat": float(vals[0]),
-            "lon": float(vals[1]),
-            "azimuth": float(vals[11]),
-            "time": int(vals[14]),
-            "curr": int(vals[16]),
-        }
-    elif len(vals) == 19:
-        ret = {
-            "lat": float(vals[0]),
-            "lon": float(vals[1]),
-            "azimuth": float(vals[11]),
-            "time": int(vals[14]),
-            "curr": int(vals[16]),
-            "capmah": int(vals[17]),
-            "engnwh": int(vals[18])
-        }
-    else:
-        ret = {
-            "lat": float(vals[0]), 
-            "lon": float(vals[1]), 
-            "azimuth": float(vals[11])
-        }
-        
-    if not ret:
-        raise Exception("Returned a none value from parse")
-    return ret
-
-
-def main():
-    global args
-    global debug
-    global ANGLE
-    global TTFS
-    global GPS_START_TIME
-    global GPS_CYCLE_SAVE_THRESHOLD
-    global GPS_CYCLE_OFF_TIME
-    global LINES_PER_SECOND
-    global NUM_PTS_TO_AVG
-
-    args = arg_parser.parse_args()
-
-    if not args.input:
-        arg_parser.print_help()
-        exit(1)
-
-    path = args.input
-
-    if not os.path.exists(path):
-        Log.error(f"File '{path}' was inaccessible or does not exist")
-        exit(2)
-
-    if args.debug:
-        if args.debug != 0 and args.debug != 1:
-            Log.warning(
-                f"Expected debug level 0 or 1, got '{args.debug}'. Defaulting to 0."
-            )
-        else:
-            debug = args.debug == 1
-
-    if args.angle == None:
-        while True:
-            try:
-                ANGLE = int(
-                    input(
-                        "Enter an angle about which to perform sensitivity analysis: "
-                    )
-                )
+# The only columns Simulator.feed reads
+SIMULATOR_COLUMNS = ["azimuth", "time", "current", "capmah", "engnwh"]
+
+
+class Simulator:
+    """
+    Will run through each line and track azimuth. Determine if GPS would be on or off
+    at the time. It takes about three seconds to get first fix. Factor in delays and what not
+    to then note when the GPS would turn off and how many --GPS LOCATION CHANGED-- would be picked up by
+    an always on versus with azimuth trigger angle.
+
+    State is carried between calls to feed(), so a ride can be simulated in
+    one go or piece by piece as a log is being written. The settings default
+    to the module constants; off_time defaults to start_time + save_threshold.
+    """
+
+    def __init__(
+        self,
+        angle: float = ANGLE,
+        start_time: float = GPS_START_TIME,
+        save_threshold: float = GPS_CYCLE_SAVE_THRESHOLD,
+        off_time: float = None,
+        window: int = NUM_PTS_TO_AVG,
+        rate: float = LINES_PER_SECOND,
+    ):
+        self.angle = angle
+        self.start_time = start_time
+        self.save_threshold = save_threshold
+        self.off_time = start_time + save_threshold if off_time is None else off_time
+        self.window = window
+        self.rate = rate
+
+        self.total = 1  # header line
+        self.markers = 0
+
+        self.last_X_azimuth = deque(maxlen=window)
+        self.last_trigger_azimuth = 0
+        self.last_trigger_time = 0
+        self.last_measured_time = 0
+
+        self.points_collected = [0, 0]
+        self.gps_on = True
+        self.off_cycles = 0
+        self.on_cycles = 0
+        self.time_off = 0
+        self.time_on = 0
+
+        self.current = 0
+        self.capmah_start = None
+        self.engnwh_start = None
+        # Readings from the last line if it was a data line with the GPS on;
+        # those become the end readings if the log ends there.
+        self.capmah_tail = None
+        self.engnwh_tail = None
+
+    def feed(self, ride: Ride):
+        # 0   1   2   3   4     5      6      7      8     9     10    11      12    13   14   15     16      17     18
+        # lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current,capmah,engnwh
+        rows = len(ride)
+        azimuths = ride["azimuth"].tolist() if rows else []
+        with np.errstate(invalid="ignore"):
+            if "time" in ride and "current" in ride:
+                times = ride["time"].astype(np.int64).tolist()
+                currs = ride["current"].astype(np.int64).tolist()
+            else:
+                # Older logs have no clock; estimate it from the line number
+                times = ((ride.row_lines() // self.rate) * 1000).tolist()
+                currs = None
+            if "capmah" in ride and "engnwh" in ride:
+                capmahs = ride["capmah"].astype(np.int64).tolist()
+                engnwhs = ride["engnwh"].astype(np.int64).tolist()
+            else:
+                capmahs = engnwhs = None
+
+        # Which markers sit in front of each row
+        changed = (ride.marker_labels == "GPS LOCATION CHANGED").tolist()
+        angle = self.angle
+        start_time = self.start_time
+        save_threshold = self.save_threshold
+        off_time = self.off_time
+        window = self.window
+        marker_rows = ride.marker_rows.tolist()
+        m = 0
+
+        last_X_azimuth = self.last_X_azimuth
+        last_trigger_azimuth = self.last_trigger_azimuth
+        last_trigger_time = self.last_trigger_time
+        last_measured_time = self.last_measured_time
+        points_collected = self.points_collected
+        gps_on = self.gps_on
+        off_cycles = self.off_cycles
+        on_cycles = self.on_cycles
+        time_off = self.time_off
+        time_on = self.time_on
+        current = self.current
+        capmah_start = self.capmah_start
+        engnwh_start = self.engnwh_start
+        capmah_tail = self.capmah_tail
+        engnwh_tail = self.engnwh_tail
+
+        for row in range(rows + 1):
+            # Marker lines
+            while m < len(marker_rows) and marker_rows[m] <= row:
+                capmah_tail = engnwh_tail = None
+                if changed[m]:
+                    # New GPS location
+                    points_collected[0] += 1
+                    time_diff = last_measured_time - last_trigger_time
+                    # It is important to consider that points are not collected
+                    # for TTFS milliseconds after GPS is initially turned on
+                    if gps_on:
+                        if (
+                            time_diff >= start_time
+                        ):  # CHANGE THIS LINE (>= start_time) IF YOU WANT POINTS DRAWN TO MAP AND NOT JUST POINTS COLLECTED
+                            points_collected[1] += 1
+                        elif off_cycles == 0:
+                            points_collected[1] += 1
+                m += 1
+            if row == rows:
                 break
-            except ValueError:
-                Log.error("Invald input, please only enter a floating point value.")
-    else:
-        ANGLE = args.angle
-
-    # Simulate
-
-    # Will run through each line and track azimuth. Determine if GPS would be on or off
-    # at the time. It takes about three seconds to get first fix. Factor in delays and what not
-    # to then note when the GPS would turn off and how many --GPS LOCATION CHANGED-- would be picked up by
-    # an always on versus with azimuth trigger angle.
-
-    start = time.time()
-
-    lines = []
-    with open(path, "r") as infile:
-        Log.info(f"Begins processing {path}.")
-        lines = infile.readlines()
-
-    total = len(lines)
-
-    last_X_azimuth = deque(maxlen=NUM_PTS_TO_AVG)
-    last_trigger_azimuth = 0
-    last_trigger_time = 0
-    last_measured_time = 0
-
-    points_collected = [0, 0]
-    points = [[], []]
-    # RMSE = sqrt( ( sum( (predicted - actual)^2 ) ) / n )
-    rmse = 0
-    gps_on = True
-    off_cycles = 0
-    on_cycles = 0
-    time_off = 0
-    time_on = 0
-
-    current = 0
-    capmah_start = None
-    capmah_end = None
-    engnwh_start = None
-    engnwh_end = None
-
-    # Should be feasible in a single pass
-    for (idx, line) in enumerate(lines):
-        if idx == 0:
-            continue
-
-        # Marker lines
-        if line.startswith("--"):
-            if line.startswith("--GPS LOCATION CHANGED--"):
-                # New GPS location
-                points_collected[0] += 1
-                time_diff = last_measured_time - last_trigger_time
-                # It is important to consider that points are not collected
-                # for TTFS milliseconds after GPS is initially turned on
-                if gps_on:
-                    if (
-                        time_diff >= GPS_START_TIME
-                    ):  # CHANGE THIS LINE (>= GPS_START_TIME) IF YOU WANT POINTS DRAWN TO MAP AND NOT JUST POINTS COLLECTED
-                        points_collected[1] += 1
-                    elif off_cycles == 0:
-                        points_collected[1] += 1
-        # Normal numerical lines
-        else:
-            try:
-                data = parse_line(line)
-            except Exception:
-                Log.error(f"Line number {idx} got a None from parse: '{line}'")
 
+            # Normal numerical lines
             # Get "current time"
-            if "time" in data:
-                now = data["time"]
-            else:
-                now = (idx // LINES_PER_SECOND) * 1000
-
+            now = times[row]
             last_measured_time = now
 
-            points[0].append({"lat": data["lat"], "lon": data["lon"]})
-
             if gps_on:
-                points[1].append({"lat": data["lat"], "lon": data["lon"]})
-                
-                if "curr" in data:
+                if currs is not None:
                     #  Don't throw off averages with base readings
-                    if data["curr"] != 0:
-                        current += abs(data["curr"])
+                    if currs[row] != 0:
+                        current += abs(currs[row])
 
-                if "capmah" in data:
+                if capmahs is not None:
                     # Energy readings tend to start at 0 before events are read
-                    if data["capmah"] != 0 and not capmah_start:
-                        capmah_start = data["capmah"]
-                    elif idx == total-1 and data["capmah"] != 0 and not capmah_end:
-                        capmah_end = data["capmah"]
-                
-                if "engnwh" in data:
-                    if data["engnwh"] != 0 and not engnwh_start:
-                        engnwh_start = data["engnwh"]
-                    elif idx == total-1 and data["engnwh"] != 0 and not engnwh_end:
-                        engnwh_end = data["engnwh"]
-                
+                    capmah = capmahs[row]
+                    capmah_tail = None
+                    if capmah != 0 and not capmah_start:
+                        capmah_start = capmah
+                    elif capmah != 0:
+                        capmah_tail = capmah
+
+                    engnwh = engnwhs[row]
+                    engnwh_tail = None
+                    if engnwh != 0 and not engnwh_start:
+                        engnwh_start = engnwh
+                    elif engnwh != 0:
+                        engnwh_tail = engnwh
+
                 time_on += 1
             else:
+                capmah_tail = engnwh_tail = None
                 time_off += 1
 
             # Collect azimuth, popping off the left side
             # if we need to make space.
-            if len(last_X_azimuth) == NUM_PTS_TO_AVG:
+            if len(last_X_azimuth) == window:
                 last_X_azimuth.popleft()
-            last_X_azimuth.append(data["azimuth"])
+            last_X_azimuth.append(azimuths[row])
 
             # Trigger azimuth will actually be the current average of
             # last (up to) 100 azimuth measurements
@@ -272,45 +335,116 @@ def main():
             # Simulate duty cycle
             if (
                 not gps_on
-                and time_diff >= GPS_CYCLE_SAVE_THRESHOLD
-                and angle_diff >= ANGLE
+                and time_diff >= save_threshold
+                and angle_diff >= angle
             ):
                 on_cycles += 1
                 gps_on = True
                 last_trigger_time = now
             if (
                 gps_on
-                and (now - last_trigger_time) >= GPS_CYCLE_OFF_TIME
-                and angle_diff < ANGLE
+                and (now - last_trigger_time) >= off_time
+                and angle_diff < angle
             ):
                 off_cycles += 1
                 gps_on = False
                 last_trigger_time = now
 
-    time_off = time_off / LINES_PER_SECOND
-    time_on = time_on / LINES_PER_SECOND
-    
-    if capmah_end and capmah_start:
-        change_capmah = capmah_end - capmah_start
-    else:
-        change_capmah = None
-        
-    if engnwh_end and engnwh_start:
-        change_engnwh = engnwh_end - engnwh_start
-    else:
-        change_engnwh = None
-    
-    end = time.time()
-    Log.ok(f"Finished simulation in {(end-start)} seconds")
+        self.last_trigger_azimuth = last_trigger_azimuth
+        self.last_trigger_time = last_trigger_time
+        self.last_measured_time = last_measured_time
+        self.gps_on = gps_on
+        self.off_cycles = off_cycles
+        self.on_cycles = on_cycles
+        self.time_off = time_off
+        self.time_on = time_on
+        self.current = current
+        self.capmah_start = capmah_start
+        self.engnwh_start = engnwh_start
+        self.capmah_tail = capmah_tail
+        self.engnwh_tail = engnwh_tail
+
+        self.total += ride.line_count()
+        self.markers += len(marker_rows)
+        count("lines", ride.line_count())
+        count("markers", len(marker_rows))
+
+    def result(self) -> dict:
+        capmah_end = self.capmah_tail
+        engnwh_end = self.engnwh_tail
+
+        if capmah_end and self.capmah_start:
+            change_capmah = capmah_end - self.capmah_start
+        else:
+            change_capmah = None
+
+        if engnwh_end and self.engnwh_start:
+            change_engnwh = engnwh_end - self.engnwh_start
+        else:
+            change_engnwh = None
+
+        return {
+            "off_cycles": self.off_cycles,
+            "on_cycles": self.on_cycles,
+            "time_on": self.time_on / self.rate,
+            "time_off": self.time_off / self.rate,
+            "current": self.current,
+            "total": self.total,
+            "change_capmah": change_capmah,
+            "change_engnwh": change_engnwh,
+            "points_collected": list(self.points_collected),
+            "settings": {
+                "ANGLE": self.angle,
+                "GPS_START_TIME": self.start_time,
+                "GPS_CYCLE_SAVE_THRESHOLD": self.save_threshold,
+                "GPS_CYCLE_OFF_TIME": self.off_time,
+                "LINES_PER_SECOND": self.rate,
+                "NUM_PTS_TO_AVG": self.window,
+            },
+        }
+
+
+def simulate(ride: Ride, **settings) -> dict:
+    # Simulate a whole ride; settings are Simulator's keyword arguments
+    sim = Simulator(**settings)
+    sim.feed(ride)
+    count("fixes", sim.points_collected[0])
+    return sim.result()
+
+
+def settings() -> dict:
+    # The Simulator settings the command line asked for
+    return {
+        "angle": ANGLE,
+        "start_time": GPS_START_TIME,
+        "save_threshold": GPS_CYCLE_SAVE_THRESHOLD,
+        "off_time": GPS_CYCLE_OFF_TIME,
+        "window": NUM_PTS_TO_AVG,
+        "rate": LINES_PER_SECOND,
+    }
+
+
+def print_summary(result: dict, batteries: list = None, receivers: list = None):
+    Log.flush()
+    used = result["settings"]
+    off_cycles = result["off_cycles"]
+    on_cycles = result["on_cycles"]
+    time_on = result["time_on"]
+    time_off = result["time_off"]
+    current = result["current"]
+    total = result["total"]
+    change_capmah = result["change_capmah"]
+    change_engnwh = result["change_engnwh"]
+    points_collected = result["points_collected"]
     print(
         f"""========================================================================
-{ANGLE=}
+ANGLE={used["ANGLE"]!r}
 {TTFS=}
-{GPS_START_TIME=}
-{GPS_CYCLE_SAVE_THRESHOLD=}
-{GPS_CYCLE_OFF_TIME=}
-{LINES_PER_SECOND=}
-{NUM_PTS_TO_AVG=}
+GPS_START_TIME={used["GPS_START_TIME"]!r}
+GPS_CYCLE_SAVE_THRESHOLD={used["GPS_CYCLE_SAVE_THRESHOLD"]!r}
+GPS_CYCLE_OFF_TIME={used["GPS_CYCLE_OFF_TIME"]!r}
+LINES_PER_SECOND={used["LINES_PER_SECOND"]!r}
+NUM_PTS_TO_AVG={used["NUM_PTS_TO_AVG"]!r}
 ------------------------------------------------------------------------
 GPS cycled off:                  {off_cycles} times
 GPS cycled back on:              {on_cycles} times
@@ -324,6 +458,393 @@ Points collected always on:      {points_collected[0]}
 Points collected duty cycled:    {points_collected[1]}
 ========================================================================"""
     )
+    if batteries:
+        print_power([dict(result, policy=f"azimuth:angle={used['ANGLE']:g}")], batteries, receivers)
+
+
+def main():
+    global args
+    global debug
+    global ANGLE
+
+    args = arg_parser.parse_args()
+    instrument.configure(args)
+
+    try:
+        args.input = (args.input or []) + catalog.selected(args)
+    except ValueError as err:
+        Log.error(str(err))
+        exit(1)
+
+    if not args.input:
+        arg_parser.print_help()
+        exit(1)
+
+    paths = args.input
+
+    for path in paths:
+        if not os.path.exists(path):
+            Log.error(f"File '{path}' was inaccessible or does not exist")
+            exit(2)
+
+    if args.debug:
+        if args.debug != 0 and args.debug != 1:
+            Log.warning(
+                f"Expected debug level 0 or 1, got '{args.debug}'. Defaulting to 0."
+            )
+        else:
+            debug = args.debug == 1
+    log.configure(args, debug)
+
+    store = None if args.follow is not None else cache.configure(args)
+
+    if args.follow is not None and len(paths) > 1:
+        Log.error("Only one file can be followed at a time")
+        exit(1)
+
+    if args.policy and args.trials:
+        try:
+            policies = [p for spec in args.policy for p in parse_policies(spec)]
+        except ValueError as err:
+            Log.error(str(err))
+            exit(1)
+        monte_carlo(
+            paths, policies, Trials.from_args(args), args.receiver, store, args.workers, args.prefetch,
+            args.skip_stationary,
+        )
+        return
+
+    if args.policy:
+        compare_policies(
+            paths, args.policy, args.workers, store, args.prefetch, args.skip_stationary, args.battery, args.receiver
+        )
+        return
+
+    if args.angle == None:
+        while True:
+            try:
+                ANGLE = int(
+                    input(
+                        "Enter an angle about which to perform sensitivity analysis: "
+                    )
+                )
+                break
+            except ValueError:
+                Log.error("Invald input, please only enter a floating point value.")
+    else:
+        ANGLE = args.angle
+
+    if args.follow is not None:
+        follow(paths[0], args.follow, args.battery, args.receiver)
+        return
+
+    if args.trials:
+        monte_carlo(
+            paths, [AzimuthPolicy(angle=ANGLE)], Trials.from_args(args), args.receiver, store, args.workers,
+            args.prefetch, args.skip_stationary,
+        )
+        return
+
+    # Simulate
+    keys, results = {}, {}
+    if store:
+        with span("cache"):
+            for path in paths:
+                params, code = cache_inputs(parameters(args.skip_stationary), [__file__, reader.__file__], args.skip_stationary)
+                keys[path] = store.key("sensitivity", [path], params, code)
+                results[path] = store.get(keys[path])
+    pending = [path for path in paths if results.get(path) is None]
+    columns = SIMULATOR_COLUMNS
+    if args.skip_stationary:
+        columns = sorted(set(columns) | set(MOTION_COLUMNS))
+    loads = load_rides(pending, columns, store, args.workers, args.prefetch)
+
+    for path in paths:
+        result = results.get(path)
+        if result is not None:
+            Log.ok(f"Using the cached simulation of {path}")
+            print_summary(result, args.battery, args.receiver)
+            continue
+
+        start = time.time()
+        with span("read"):
+            Log.info(f"Begins processing {path}.")
+            ride = next(loads).result()
+        if args.skip_stationary:
+            ride = skip_stationary(path, ride, store)
+
+        with span("simulate"):
+            result = simulate(ride, **settings())
+        if store:
+            store.put(keys[path], result)
+
+        end = time.time()
+        Log.ok(f"Finished simulation in {(end-start)} seconds")
+        print_summary(result, args.battery, args.receiver)
+
+
+def skip_stationary(path: str, ride: Ride, store) -> Ride:
+    with span("segment"):
+        segments = ride_segments(path, ride, store)
+        moving = segments.mask()
+    Log.info(
+        f"Skipping {len(ride) - int(moving.sum())} stationary rows of {len(ride)} "
+        f"({int((~segments.moving).sum())} stops)"
+    )
+    return ride.select(moving)
+
+
+def load_ride(path: str, columns: list, store, workers: int) -> Ride:
+    # One log, through the column store when there is one
+    if store:
+        return store.ride(path, columns, workers=workers)
+    return read_ride(path, workers=workers, columns=columns)
+
+
+def load_rides(paths: list, columns: list, store, workers: int, depth: int):
+    # Futures for each log in order. A lone file is parsed in-process with
+    # the full worker pool; with several, the next `depth` are parsed in the
+    # background (one process each) while the current one is worked on.
+    if len(paths) <= 1:
+        return prefetch(paths, partial(load_ride, columns=columns, store=store, workers=workers), depth=0)
+    return prefetch(paths, partial(load_ride, columns=columns, store=store, workers=1), depth=depth)
+
+
+def cache_inputs(params: dict, code: list, skip: bool):
+    # (params, code) of a cache key. Skipping stationary stretches makes a
+    # result depend on how motion.py segments the ride as well.
+    if skip:
+        return dict(params, segmentation=motion.thresholds()), code + motion.code_files()
+    return params, code
+
+
+def parameters(skip: bool = False) -> dict:
+    # Everything a simulation result depends on besides the log itself
+    return {
+        "ANGLE": ANGLE,
+        "TTFS": TTFS,
+        "GPS_START_TIME": GPS_START_TIME,
+        "GPS_CYCLE_SAVE_THRESHOLD": GPS_CYCLE_SAVE_THRESHOLD,
+        "GPS_CYCLE_OFF_TIME": GPS_CYCLE_OFF_TIME,
+        "LINES_PER_SECOND": LINES_PER_SECOND,
+        "NUM_PTS_TO_AVG": NUM_PTS_TO_AVG,
+        "skip_stationary": skip,
+    }
+
+
+def compare_policies(
+    paths: list,
+    specs: list,
+    workers: int,
+    store=None,
+    depth: int = 2,
+    skip: bool = False,
+    batteries: list = None,
+    receivers: list = None,
+):
+    try:
+        policies = [p for spec in specs for p in parse_policies(spec)]
+    except ValueError as err:
+        Log.error(str(err))
+        exit(1)
+
+    keys, cached = {}, {}
+    if store:
+        with span("cache"):
+            labels = [p.label() for p in policies]
+            for path in paths:
+                params, code = cache_inputs(
+                    {"policies": labels, "skip_stationary": skip}, [policy.__file__, reader.__file__], skip
+                )
+                keys[path] = store.key("policies", [path], params, code)
+                cached[path] = store.get(keys[path])
+    pending = [path for path in paths if cached.get(path) is None]
+    columns = Replay(policies).columns()
+    if skip:
+        columns = sorted(set(columns) | set(MOTION_COLUMNS))
+    loads = load_rides(pending, columns, store, workers, depth)
+
+    for path in paths:
+        results = cached.get(path)
+        if results is not None:
+            Log.ok(f"Using the cached replay of {path}")
+        else:
+            start = time.time()
+            replay = Replay(policies)
+            with span("read"):
+                Log.info(f"Begins processing {path}.")
+                ride = next(loads).result()
+            if skip:
+                ride = skip_stationary(path, ride, store)
+            with span("replay"):
+                try:
+                    replay.feed(ride)
+                except ValueError as err:
+                    Log.error(str(err))
+                    exit(3)
+            results = replay.results()
+            if store:
+                store.put(keys[path], results)
+            end = time.time()
+            Log.ok(f"Replayed {len(policies)} policies in {(end-start)} seconds")
+        print_policies(path if len(paths) > 1 else None, results, batteries, receivers)
+
+
+def print_policies(path: str, results: list, batteries: list = None, receivers: list = None):
+    Log.flush()
+    if path:
+        print(path)
+    print("=" * 96)
+    print(f"{'policy':<44} {'off':>4} {'on':>4} {'s on':>8} {'s off':>8} {'% off':>7} {'mA':>8} {'points':>7}")
+    print("-" * 96)
+    for result in results:
+        time_on, time_off = result["time_on"], result["time_off"]
+        total = time_on + time_off
+        print(
+            f"{result['policy']:<44} {result['off_cycles']:>4} {result['on_cycles']:>4} {time_on:>8.1f} {time_off:>8.1f} "
+            f"{(time_off / total * 100 if total else 0):>7.1f} {result['current'] / result['total']:>8.0f} "
+            f"{result['points_collected'][1]:>3}/{result['points_collected'][0]:<3}"
+        )
+    print("=" * 96)
+    if batteries:
+        print_power(results, batteries, receivers)
+
+
+def print_power(results: list, batteries: list, receivers: list = None):
+    # Projected life of each battery powering each receiver (by name), under
+    # every simulated duty cycle and with the receiver left on for the whole ride
+    batteries = [BATTERIES[name] for name in dict.fromkeys(batteries)]
+    receivers = [RECEIVERS[name] for name in dict.fromkeys(receivers or [next(iter(RECEIVERS))])]
+    total = results[0]["time_on"] + results[0]["time_off"]
+    always = {"policy": "always on", "time_on": total, "time_off": 0.0, "on_cycles": 0}
+    rows = [always] + list(results)
+    with span("power"):
+        life = project(rows, batteries, receivers)
+    width = 44 + 10 * len(batteries)
+    for j, receiver in enumerate(receivers):
+        print("=" * width)
+        header = "".join(f"{battery.name + ' h':>10}" for battery in batteries)
+        print(f"{receiver.name + ' battery life':<44}{header}")
+        print("-" * width)
+        for result, hours in zip(rows, life[:, j]):
+            print(f"{result['policy']:<44}" + "".join(f"{h:>10.1f}" for h in hours))
+    print("=" * width)
+
+
+def monte_carlo(
+    paths: list,
+    policies: list,
+    trials: Trials,
+    receivers: list = None,
+    store=None,
+    workers: int = None,
+    depth: int = 2,
+    skip: bool = False,
+):
+    # Each ride is read once and replayed trials.trials times per policy,
+    # with GPS_START_TIME drawn as start latency + time to first fix per
+    # trial. Only the first of `receivers` is priced.
+    if not 0 < trials.confidence < 1:
+        Log.error("The confidence should be between 0 and 1")
+        exit(1)
+    try:
+        ttfs = montecarlo.parse_distribution(trials.ttfs)
+        latency = montecarlo.parse_distribution(trials.latency)
+    except ValueError as err:
+        Log.error(str(err))
+        exit(1)
+    receiver = RECEIVERS[(receivers or [next(iter(RECEIVERS))])[0]]
+
+    keys, cached = {}, {}
+    if store:
+        with span("cache"):
+            params = dict(
+                trials.to_dict(),
+                policies=[p.label() for p in policies],
+                receiver=receiver.name,
+                skip_stationary=skip,
+            )
+            code = [montecarlo.__file__, policy.__file__, power.__file__, reader.__file__]
+            params, code = cache_inputs(params, code, skip)
+            for path in paths:
+                keys[path] = store.key("montecarlo", [path], params, code)
+                cached[path] = store.get(keys[path])
+    pending = [path for path in paths if cached.get(path) is None]
+    columns = Replay(policies).columns()
+    if skip:
+        columns = sorted(set(columns) | set(MOTION_COLUMNS))
+    loads = load_rides(pending, columns, store, workers, depth)
+
+    for path in paths:
+        summary = cached.get(path)
+        if summary is not None:
+            Log.ok(f"Using the cached Monte Carlo run of {path}")
+        else:
+            start = time.time()
+            with span("read"):
+                Log.info(f"Begins processing {path}.")
+                ride = next(loads).result()
+            if skip:
+                ride = skip_stationary(path, ride, store)
+            # Same draws for every ride, so rides are compared like for like
+            rng = np.random.default_rng(trials.seed)
+            starts = latency(rng, trials.trials) + ttfs(rng, trials.trials)
+            with span("montecarlo"):
+                runs = montecarlo.simulate(ride, policies, starts, receiver, workers or os.cpu_count() or 1)
+            summary = montecarlo.summarize(runs, trials.confidence)
+            summary["policies"] = [p.label() for p in policies]
+            if store:
+                store.put(keys[path], summary)
+            end = time.time()
+            Log.ok(f"Ran {trials.trials} trials of {len(policies)} policies in {(end-start)} seconds")
+        print_monte_carlo(path if len(paths) > 1 else None, summary, receiver.name, trials)
+
+
+def print_monte_carlo(path: str, summary: dict, receiver: str, trials: Trials):
+    Log.flush()
+    if path:
+        print(path)
+    interval = f"{trials.confidence * 100:g}% interval"
+    print("=" * 110)
+    print(f"{trials.trials} trials, TTFS {trials.ttfs}, latency {trials.latency}; mean [{interval}]")
+    print(f"{'policy':<40} {'s off':>22} {'points':>22} {receiver + ' mAh':>22}")
+    print("-" * 110)
+    for k, label in enumerate(summary["policies"]):
+        cells = []
+        for name in montecarlo.METRICS:
+            stats = summary[name]
+            cells.append(f"{stats['mean'][k]:.1f} [{stats['lo'][k]:.1f}, {stats['hi'][k]:.1f}]")
+        print(f"{label:<40} " + " ".join(f"{cell:>22}" for cell in cells))
+    print("=" * 110)
+
+
+def follow(path: str, interval: float, batteries: list = None, receivers: list = None):
+    # Keep simulating a log that is still being pulled off a device, only
+    # parsing and simulating whatever was appended since the last refresh.
+    tail = Tail(path)
+    sim = Simulator(**settings())
+    Log.info(f"Following {path}, refreshing every {interval} s (Ctrl+C to stop).")
+    try:
+        while True:
+            with span("read"):
+                ride = tail.poll()
+            if tail.restarted:
+                Log.warning(f"File '{path}' shrank, starting the simulation over")
+                sim = Simulator(**settings())
+            if ride is not None and ride.lines > ride.first_line:
+                start = time.time()
+                with span("simulate"):
+                    sim.feed(ride)
+                end = time.time()
+                Log.ok(
+                    f"Simulated {ride.lines - ride.first_line} new lines ({tail.lines} total) in {(end-start)} seconds"
+                )
+                print_summary(sim.result(), batteries, receivers)
+                # stdout is block buffered when piped; show each refresh now
+                sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        count("fixes", sim.points_collected[0])
 
 
 if __name__ == "__main__":
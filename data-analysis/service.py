@@ -0,0 +1,337 @@
+import os
+import sys
+import argparse
+import contextlib
+import io
+import json
+import socket
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib import request
+
+import instrument
+import log
+from instrument import span, count
+from log import Log
+
+# Only the standard library and log/instrument are imported up here, so the
+# client starts in a few milliseconds; numpy, pandas and the analysis
+# scripts are imported by whichever side ends up doing the work.
+
+arg_parser = argparse.ArgumentParser(
+    description="Local analysis service that keeps parsed rides in memory between runs, and its client.",
+    usage="python service.py [--port <port>] serve | stop | simulate <sensitivity.py args> | accuracy <accuracy.py args> | summary -i <file> [<file> ...]",
+)
+arg_parser.add_argument(
+    "--host",
+    type=str,
+    default="127.0.0.1",
+    help="address the service listens on / the client connects to (default: 127.0.0.1)",
+)
+arg_parser.add_argument(
+    "--port",
+    type=int,
+    default=8765,
+    help="port the service listens on / the client connects to (default: 8765)",
+)
+arg_parser.add_argument(
+    "--memory",
+    type=float,
+    default=512,
+    help="with serve, MB of parsed rides kept in memory, least recently used dropped first (default: 512)",
+)
+arg_parser.add_argument(
+    "--local",
+    action="store_true",
+    help="don't try the service, run in this process",
+)
+arg_parser.add_argument(
+    "command",
+    choices=["serve", "stop", "simulate", "accuracy", "summary"],
+    help="serve: run the service; stop: shut it down; simulate / accuracy: run sensitivity.py / accuracy.py "
+    "with the remaining arguments; summary: print an overview of each -i log",
+)
+arg_parser.add_argument(
+    "argv",
+    nargs=argparse.REMAINDER,
+    help="arguments for the command, as the script itself takes them",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+
+CONNECT_TIMEOUT = 0.5  # s to wait for the service before running locally
+
+
+class Warm:
+    """
+    Parsed logs kept in memory, keyed by path and the kind of parse (whole
+    ride, accuracy fixes, motion segments). An entry is dropped when its
+    file's size or mtime changes, and the least recently used entries go
+    once their arrays add up to more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+
+    def get(self, kind: str, path: str, load):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        key = (kind, path)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.entries.move_to_end(key)
+            count("warm hits", 1)
+            return entry[1]
+        if entry is not None:
+            self._drop(key)
+        with span(f"load {kind}"):
+            value = load(path)
+        size = nbytes(value)
+        self.entries[key] = (stamp, value, size)
+        self.total += size
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            self._drop(next(iter(self.entries)))
+        return value
+
+    def _drop(self, key):
+        _, _, size = self.entries.pop(key)
+        self.total -= size
+        Log.debug("Dropped %s of '%s' from memory", *key)
+
+    def ride(self, path: str):
+        from reader import read_ride
+
+        return self.get("ride", path, read_ride)
+
+    def segments(self, path: str):
+        from motion import segment
+
+        return self.get("segments", path, lambda p: segment(self.ride(p)))
+
+    def fixes(self, path: str, sensor):
+        from accuracy import parse_file, fix_dtype
+
+        return self.get(f"fixes {sensor.__name__}", path, lambda p: parse_file(p, fix_dtype(sensor)))
+
+
+def nbytes(value) -> int:
+    # Memory held by a parsed value's arrays
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "columns"):
+        arrays = list(value.columns.values()) + [value.marker_rows, value.marker_lines, value.marker_labels]
+    else:
+        arrays = [getattr(value, name) for name in value.__slots__]
+    return sum(int(getattr(array, "nbytes", 0)) for array in arrays)
+
+
+def resolve(cwd: str, path: str) -> str:
+    # A path as the client gave it, relative to the client's working
+    # directory; the service never changes its own
+    return os.path.join(cwd, path)
+
+
+def simulate(warm: Warm, argv: list, cwd: str):
+    # sensitivity.py's simulation and policy comparison over warm rides
+    import catalog
+    import sensitivity
+    from policy import Replay, parse_policies
+
+    args = sensitivity.arg_parser.parse_args(argv)
+    args.input = (args.input or []) + catalog.selected(args, cwd)
+    if not args.input:
+        raise ValueError("simulate needs -i <input file path>")
+    if args.follow is not None or args.trials:
+        raise ValueError("--follow and --trials are only supported by sensitivity.py itself")
+    settings = sensitivity.settings()
+    if args.angle is not None:
+        settings["angle"] = args.angle
+    policies = [p for spec in args.policy or [] for p in parse_policies(spec)]
+    for path in args.input:
+        ride = warm.ride(resolve(cwd, path))
+        if args.skip_stationary:
+            ride = ride.select(warm.segments(resolve(cwd, path)).mask())
+        if policies:
+            replay = Replay(policies)
+            with span("replay"):
+                replay.feed(ride)
+            sensitivity.print_policies(
+                path if len(args.input) > 1 else None, replay.results(), args.battery, args.receiver
+            )
+        else:
+            with span("simulate"):
+                result = sensitivity.simulate(ride, **settings)
+            sensitivity.print_summary(result, args.battery, args.receiver)
+
+
+def accuracy(warm: Warm, argv: list, cwd: str):
+    # accuracy.py's comparison over warm fixes; there is no map to show
+    import numpy as np
+    import accuracy as script
+    import catalog
+
+    args = script.arg_parser.parse_args(argv)
+    args.back = (args.back or []) + catalog.selected(args, cwd)
+    if not args.there or not args.back:
+        raise ValueError("accuracy needs -t <always on file> and -b <duty cycled file>")
+    sensor = np.float32 if args.float32 else np.float64
+    options = script.Options.from_args(args)
+    there = warm.fixes(resolve(cwd, args.there), sensor)
+    results = {}
+    for path in args.back:
+        back = warm.fixes(resolve(cwd, path), sensor)
+        if not len(there) or not len(back):
+            raise ValueError("One of the rides had no fixes")
+        start = time.time()
+        # evaluate() writes projected coordinates into the arrays it gets
+        result = script.evaluate(there.copy(), back.copy(), resolve(cwd, path), options)
+        end = time.time()
+        Log.ok(f"Finished processing in {end-start} seconds")
+        if len(args.back) > 1:
+            Log.flush()
+            print(f"{path}:")
+        script.report(result)
+        results[path] = result
+    if len(args.back) > 1 and options.intervals:
+        script.print_interval_summary(results, args.back, options.bin)
+
+
+def summary(warm: Warm, argv: list, cwd: str):
+    # Size, length, fixes, markers and time spent stopped of each log
+    parser = argparse.ArgumentParser(prog="service.py summary")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True)
+    args = parser.parse_args(argv)
+    for path in args.input:
+        ride = warm.ride(resolve(cwd, path))
+        segments = warm.segments(resolve(cwd, path))
+        moving, stopped = segments.seconds()
+        labels = Counter(ride.marker_labels.tolist())
+        Log.flush()
+        print("=" * 72)
+        print(path)
+        print("-" * 72)
+        print(f"Rows:                            {len(ride)}")
+        print(f"Columns:                         {', '.join(ride.columns)}")
+        print(f"Seconds moving / stopped:        {moving:.0f} / {stopped:.0f} ({int((~segments.moving).sum())} stops)")
+        for label, n in labels.most_common():
+            print(f"{label + ':':<33}{n}")
+        print("=" * 72)
+
+
+COMMANDS = {"simulate": simulate, "accuracy": accuracy, "summary": summary}
+
+
+def run(warm: Warm, command: str, argv: list, cwd: str) -> tuple:
+    # (succeeded, everything the command printed, what went wrong or None)
+    output = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            COMMANDS[command](warm, argv, cwd)
+        except (ValueError, OSError) as err:
+            error = str(err)
+        except SystemExit:
+            # argparse rejected the arguments; its message went to stderr
+            error = f"Bad arguments for {command}"
+        except Exception as err:
+            # A bug rather than bad input; the service carries on regardless
+            error = f"{command} failed: {type(err).__name__}: {err}"
+            Log.debug("%s", traceback.format_exc())
+        Log.flush()
+    return error is None, output.getvalue(), error
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            command = body["command"]
+        except (ValueError, KeyError):
+            self.send_error(400, "Expected a JSON body with a command")
+            return
+        if command == "stop":
+            reply = {"ok": True, "output": "Service stopped\n"}
+            threading.Thread(target=self.server.shutdown).start()
+        elif command in COMMANDS:
+            # Requests are handled one at a time, so the scripts' module
+            # settings can be changed per request
+            start = time.time()
+            ok, output, error = run(self.server.warm, command, body.get("argv", []), body.get("cwd", os.getcwd()))
+            Log.info(f"{command} answered in {(time.time() - start) * 1000:.1f} ms")
+            if error is not None:
+                Log.error(error)
+            reply = {"ok": ok, "output": output, "error": error}
+        else:
+            self.send_error(400, f"Unknown command '{command}'")
+            return
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        Log.debug("%s %s", self.address_string(), format % args)
+
+
+def serve(host: str, port: int, max_bytes: int):
+    server = HTTPServer((host, port), Handler)
+    server.warm = Warm(max_bytes)
+    Log.ok(f"Serving on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def ask(host: str, port: int, command: str, argv: list):
+    # The service's reply, or None if it isn't running
+    data = json.dumps({"command": command, "argv": argv, "cwd": os.getcwd()}).encode()
+    req = request.Request(f"http://{host}:{port}/", data=data, headers={"Content-Type": "application/json"})
+    try:
+        socket.create_connection((host, port), timeout=CONNECT_TIMEOUT).close()
+    except OSError:
+        return None
+    # Connected; a cold parse can take a while, so no timeout from here on
+    try:
+        with request.urlopen(req) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError) as err:
+        return {"ok": False, "output": "", "error": f"The service on {host}:{port} didn't answer: {err}"}
+
+
+def main():
+    args = arg_parser.parse_args()
+    instrument.configure(args)
+    log.configure(args, False)
+
+    if args.command == "serve":
+        serve(args.host, args.port, int(args.memory * (1 << 20)))
+        return
+
+    reply = None if args.local else ask(args.host, args.port, args.command, args.argv)
+    if reply is None:
+        if args.command == "stop":
+            Log.error(f"No service is running on {args.host}:{args.port}")
+            exit(1)
+        Log.debug("No service on %s:%d, running locally", args.host, args.port)
+        ok, output, error = run(Warm(int(args.memory * (1 << 20))), args.command, args.argv, os.getcwd())
+        reply = {"ok": ok, "output": output, "error": error}
+    sys.stdout.write(reply["output"])
+    if reply.get("error"):
+        Log.error(reply["error"])
+    if not reply["ok"]:
+        exit(3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+import os
+import argparse
+import io
+import math
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import instrument
+import log
+from instrument import span, count
+from log import Log
+
+arg_parser = argparse.ArgumentParser(
+    description="Generate synthetic TrackCycle-format ride logs (plus a matching reference track) for scaling tests.",
+    usage="python synthesize.py -o <output file path> -n <number of lines> [-c <14|17|19> -r <reference output path>]",
+)
+arg_parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    help="path of the TrackCycle-format log to write",
+)
+arg_parser.add_argument(
+    "-n",
+    "--lines",
+    type=int,
+    default=10_000,
+    help="total number of lines to write, markers and header included (default: 10000)",
+)
+arg_parser.add_argument(
+    "-c",
+    "--columns",
+    type=int,
+    choices=[14, 17, 19],
+    default=17,
+    help="schema width of the log (default: 17)",
+)
+arg_parser.add_argument(
+    "-r",
+    "--reference",
+    type=str,
+    help="optional path to write the true track to, in the Strava CSV format accuracy.py reads",
+)
+arg_parser.add_argument(
+    "--rate",
+    type=int,
+    default=90,
+    help="sensor lines per second (default: 90)",
+)
+arg_parser.add_argument(
+    "--fix-rate",
+    type=float,
+    default=1.0,
+    help="GPS fixes per second while the GPS is on and locked (default: 1.0)",
+)
+arg_parser.add_argument(
+    "--on",
+    type=float,
+    default=30.0,
+    help="seconds the GPS stays on per duty cycle (default: 30)",
+)
+arg_parser.add_argument(
+    "--off",
+    type=float,
+    default=0.0,
+    help="seconds the GPS stays off per duty cycle, 0 for always on (default: 0)",
+)
+arg_parser.add_argument(
+    "--ttff",
+    type=float,
+    default=3.0,
+    help="seconds from GPS start to first fix (default: 3)",
+)
+arg_parser.add_argument(
+    "--origin",
+    type=float,
+    nargs=2,
+    default=[40.4443, -79.9608],
+    metavar=("LAT", "LON"),
+    help="starting latitude and longitude (default: Pittsburgh)",
+)
+arg_parser.add_argument(
+    "--start",
+    type=int,
+    default=1659182400000,
+    help="epoch milliseconds of the first sample (default: 2022-07-30 12:00 UTC)",
+)
+arg_parser.add_argument(
+    "-s",
+    "--seed",
+    type=int,
+    default=0,
+    help="random seed, the same seed and options always produce the same files (default: 0)",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+
+HEADER = "lat,lon,alt,acc,speed,accelx,accely,accelz,gyrox,gyroy,gyroz,azimuth,pitch,roll,time,batpct,current,capmah,engnwh"
+FORMATS = "%.8f,%.8f,%.4f,%.4f,%.2f,%.6f,%.6f,%.6f,%.6f,%.6f,%.6f,%.5f,%.5f,%.5f,%d,%.1f,%d,%d,%d".split(",")
+
+EARTH_RADIUS = 6372800
+SECONDS_PER_BLOCK = 600
+TURN_SECONDS = 4
+TURN_EVERY = 60  # mean seconds between turns
+STOP_SECONDS = 30
+STOP_EVERY = 300  # mean seconds between stops at lights etc.
+CRUISE_SPEED = 6.0  # m/s
+# Long.MIN_VALUE, what the app writes when the energy counter is unsupported
+ENERGY_UNSUPPORTED = -9223372036854775808
+
+
+class Ride:
+    """
+    Second-by-second kinematic state of the synthetic rider, advanced one
+    block at a time so arbitrarily long rides never need to fit in memory.
+    """
+
+    def __init__(self, rng: np.random.Generator, origin: tuple):
+        self.rng = rng
+        self.lat0, self.lon0 = origin
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = float(rng.uniform(-180, 180))
+        self.speed = CRUISE_SPEED
+        self.alt = 300.0
+        # Turns and stops that started near the end of the previous block
+        self.turn_carry = np.zeros(TURN_SECONDS - 1)
+        self.stop_carry = np.zeros(STOP_SECONDS - 1)
+
+    def advance(self, seconds: int) -> dict:
+        rng = self.rng
+
+        # Turns: +/-90 degrees spread over TURN_SECONDS, negative is a left turn
+        starts = rng.random(seconds) < 1 / TURN_EVERY
+        turn = np.where(starts, rng.choice([-90.0, 90.0], seconds), 0.0)
+        rate = np.convolve(turn / TURN_SECONDS, np.ones(TURN_SECONDS))
+        rate[: TURN_SECONDS - 1] += self.turn_carry
+        self.turn_carry = rate[seconds:].copy()
+        rate = rate[:seconds]
+
+        # Stops at lights: speed drops to zero for STOP_SECONDS
+        stop_starts = rng.random(seconds) < 1 / STOP_EVERY
+        stopped = np.convolve(stop_starts.astype(float), np.ones(STOP_SECONDS))
+        stopped[: STOP_SECONDS - 1] += self.stop_carry
+        self.stop_carry = stopped[seconds:].copy()
+        stopped = stopped[:seconds] > 0
+
+        # Smoothly varying cruising speed
+        drift = np.cumsum(rng.normal(0, 0.15, seconds))
+        speed = np.clip(self.speed + drift - drift.mean() * 0.5, 2.0, 12.0)
+        self.speed = float(speed[-1])
+        speed = np.where(stopped, 0.0, speed)
+        rate = np.where(stopped, 0.0, rate)
+
+        heading = self.heading + np.cumsum(rate)
+        self.heading = float(heading[-1])
+        rad = np.radians(heading)
+        x = self.x + np.cumsum(speed * np.sin(rad))
+        y = self.y + np.cumsum(speed * np.cos(rad))
+        alt = self.alt + np.cumsum(rng.normal(0, 0.1, seconds))
+
+        # Positions at the start of each second, plus the end of the block
+        xs = np.concatenate(([self.x], x))
+        ys = np.concatenate(([self.y], y))
+        self.x, self.y, self.alt = float(x[-1]), float(y[-1]), float(alt[-1])
+
+        lat = self.lat0 + np.degrees(ys / EARTH_RADIUS)
+        lon = self.lon0 + np.degrees(xs / (EARTH_RADIUS * math.cos(math.radians(self.lat0))))
+        return {
+            "lat": lat,
+            "lon": lon,
+            "alt": np.concatenate(([alt[0]], alt)),
+            "speed": speed,
+            "heading": heading,
+            "rate": rate,
+            "turns": turn,
+            "stops": stop_starts,
+        }
+
+
+def wrap_degrees(deg):
+    return (deg + 180.0) % 360.0 - 180.0
+
+
+class Writer:
+    def __init__(self, args, outfile, reffile):
+        self.args = args
+        self.outfile = outfile
+        self.reffile = reffile
+        self.rng = np.random.default_rng(args.seed)
+        self.ride = Ride(self.rng, tuple(args.origin))
+        self.columns = args.columns
+        self.rate = args.rate
+        self.fix_every = max(1, round(args.rate / args.fix_rate))
+        self.cycle = args.on + args.off
+        self.second = 0
+        self.row = 0
+        self.written = 0
+        self.seconds_written = 0.0
+        self.fix = (0.0, 0.0, 0.0, 0.0, 0.0)  # lat, lon, alt, acc, speed
+        self.locked = False
+        self.gps_on = None
+        self.battery = 100.0
+        self.charge = 4_500_000.0  # uAh left in the phone battery
+
+    def write_header(self):
+        self.outfile.write(",".join(HEADER.split(",")[: self.columns]) + "\n")
+        self.written += 1
+        if self.reffile:
+            self.reffile.write("s\nele,time,_lat,_lon\n")
+
+    def gps_state(self, t):
+        # Returns (on, locked) for an array of times in seconds
+        if self.args.off <= 0:
+            phase = t
+        else:
+            phase = np.mod(t, self.cycle)
+        on = (phase < self.args.on) if self.args.off > 0 else np.ones(len(t), dtype=bool)
+        locked = on & (phase >= self.args.ttff)
+        return on, locked
+
+    def block(self, limit: int) -> int:
+        rng = self.rng
+        rate = self.rate
+        seconds = SECONDS_PER_BLOCK
+        state = self.ride.advance(seconds)
+        n = seconds * rate
+
+        row = self.row + np.arange(n)
+        t = self.second + np.arange(n) / rate
+        sec = np.repeat(np.arange(seconds), rate)
+        frac = (np.arange(n) % rate) / rate
+
+        true_lat = state["lat"][sec] + (state["lat"][sec + 1] - state["lat"][sec]) * frac
+        true_lon = state["lon"][sec] + (state["lon"][sec + 1] - state["lon"][sec]) * frac
+        true_alt = state["alt"][sec]
+        speed = state["speed"][sec]
+
+        on, locked = self.gps_state(t)
+        fixes = locked & (row % self.fix_every == 0)
+
+        # GPS columns hold the last fix until the next one arrives
+        acc = rng.uniform(3.0, 6.0, n)
+        last = np.maximum.accumulate(np.where(fixes, np.arange(n), -1))
+        held = last >= 0
+        gps = np.empty((5, n))
+        for k, source in enumerate((true_lat, true_lon, true_alt, acc, speed)):
+            gps[k] = np.where(held, source[np.maximum(last, 0)], self.fix[k])
+        if fixes.any():
+            i = np.flatnonzero(fixes)[-1]
+            self.fix = tuple(float(gps[k][i]) for k in range(5))
+
+        # IMU: gyroz follows the heading rate (positive is counter-clockwise, i.e. left)
+        gyroz = -np.radians(state["rate"][sec]) + rng.normal(0, 0.02, n)
+        azimuth = wrap_degrees(state["heading"][sec] + rng.normal(0, 3.0, n))
+        forward = np.diff(state["speed"], prepend=state["speed"][0])[sec]
+
+        data = np.empty((n, 19))
+        data[:, 0:5] = gps.T
+        data[:, 5] = rng.normal(0, 0.3, n)
+        data[:, 6] = forward + rng.normal(0, 0.3, n)
+        data[:, 7] = rng.normal(0, 0.5, n)
+        data[:, 8] = rng.normal(0, 0.05, n)
+        data[:, 9] = rng.normal(0, 0.05, n)
+        data[:, 10] = gyroz
+        data[:, 11] = azimuth
+        data[:, 12] = rng.normal(-10, 2, n)
+        data[:, 13] = rng.normal(0, 2, n)
+        data[:, 14] = self.args.start + np.floor(t) * 1000
+        current = np.where(on, -620.0, -180.0) + rng.normal(0, 20, n).round()
+        drain = np.cumsum(-current / rate / 3600)  # mAh
+        data[:, 15] = np.floor(self.battery - drain / (self.charge / 1000) * 100)
+        if self.columns == 19:
+            # The newer app versions log current in uA and charge in uAh
+            data[:, 16] = current * 1000
+            data[:, 17] = self.charge - drain * 1000
+            data[:, 18] = ENERGY_UNSUPPORTED
+        else:
+            data[:, 16] = current
+        self.battery -= drain[-1] / (self.charge / 1000) * 100
+        self.charge -= drain[-1] * 1000
+
+        buffer = io.StringIO()
+        np.savetxt(buffer, data[:, : self.columns], fmt=FORMATS[: self.columns], delimiter=",")
+        rows = buffer.getvalue().splitlines()
+
+        # Markers go on their own line in front of the row they belong to
+        markers = {}
+
+        def mark(idx, text):
+            markers.setdefault(int(idx), []).append(f"--{text}--")
+
+        previous_on = self.gps_on if self.gps_on is not None else not on[0]
+        toggles = np.flatnonzero(np.diff(np.concatenate(([previous_on], on)).astype(np.int8)))
+        for idx in toggles:
+            mark(idx, "GPS STARTED" if on[idx] else "GPS STOPPED")
+            if on[idx]:
+                self.locked = False
+        self.gps_on = bool(on[-1])
+        for idx in np.flatnonzero(fixes):
+            # As in the app's logs, the first fix after a start is announced
+            # just before the location change it brings
+            if not self.locked:
+                mark(idx, "GPS FIRST FIX LOCKED")
+                self.locked = True
+            mark(idx, "GPS LOCATION CHANGED")
+        for s in np.flatnonzero(state["turns"]):
+            mark(s * rate, "LEFT" if state["turns"][s] < 0 else "RIGHT")
+        for s in np.flatnonzero(state["stops"]):
+            mark(s * rate, "STOP")
+
+        out = []
+        prev = 0
+        for idx in sorted(markers):
+            out.extend(rows[prev:idx])
+            out.extend(markers[idx])
+            prev = idx
+        out.extend(rows[prev:])
+
+        truncated = len(out) > limit
+        out = out[:limit]
+        self.outfile.write("\n".join(out) + "\n")
+        self.written += len(out)
+        data_rows = n
+        if truncated:
+            data_rows = sum(1 for line in out if not line.startswith("--"))
+        self.seconds_written += data_rows / rate
+
+        if self.reffile:
+            # The reference track is the true position once per second
+            # Only as far as the log got
+            secs = min(seconds, math.ceil(data_rows / rate))
+            stamps = [
+                datetime.fromtimestamp((self.args.start / 1000) + self.second + s, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+                for s in range(secs)
+            ]
+            self.reffile.write(
+                "".join(
+                    f"{state['alt'][s]:.1f},{stamps[s]},{state['lat'][s]:.7f},{state['lon'][s]:.7f}\n"
+                    for s in range(secs)
+                )
+            )
+
+        self.row += n
+        self.second += seconds
+        return len(out)
+
+
+def main():
+    args = arg_parser.parse_args()
+    instrument.configure(args)
+    log.configure(args, False)
+
+    if not args.output:
+        arg_parser.print_help()
+        exit(1)
+
+    if args.lines < 2:
+        Log.error(f"Expected at least 2 lines, got {args.lines}")
+        exit(1)
+
+    if args.rate < 1 or args.fix_rate <= 0:
+        Log.error("Sample rate and fix rate must be positive")
+        exit(1)
+
+    out_dir = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.isdir(out_dir):
+        Log.error(f"Directory '{out_dir}' was inaccessible or does not exist")
+        exit(2)
+
+    start = time.time()
+    Log.info(f"Begins writing {args.lines} lines to '{args.output}'")
+
+    reffile = open(args.reference, "w") if args.reference else None
+    try:
+        with open(args.output, "w") as outfile:
+            writer = Writer(args, outfile, reffile)
+            writer.write_header()
+            while writer.written < args.lines:
+                with span("write"):
+                    writer.block(args.lines - writer.written)
+    finally:
+        if reffile:
+            reffile.close()
+
+    count("lines", writer.written)
+    end = time.time()
+    Log.ok(
+        f"Finished writing {writer.written} lines ({writer.seconds_written:.0f} s of riding) in {end-start} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main()
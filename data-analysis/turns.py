@@ -0,0 +1,319 @@
+import os
+import argparse
+import itertools
+import time
+
+import numpy as np
+from scipy import signal
+
+import instrument
+import log
+from instrument import span, count
+from log import Log
+from reader import LINES_PER_SECOND, MIN_CHUNK, iter_ride, read_ahead
+
+arg_parser = argparse.ArgumentParser(
+    description="Replay turn detection over TrackCycle logs and score it against the app's LEFT/RIGHT markers.",
+    usage="python turns.py -i <input file path> [<input file path> ...] [-s gyroz|azimuth] [-t <thresholds>] [-a <angles>]",
+)
+arg_parser.add_argument(
+    "-i",
+    "--input",
+    type=str,
+    nargs="+",
+    help="input file paths from which to read sensor data",
+)
+arg_parser.add_argument(
+    "-s",
+    "--signal",
+    type=str,
+    choices=["gyroz", "azimuth"],
+    default="gyroz",
+    help="detect turns from the integrated gyroscope yaw rate or from the change in azimuth (default: gyroz)",
+)
+arg_parser.add_argument(
+    "-t",
+    "--threshold",
+    type=str,
+    default="0.15",
+    help="comma separated yaw rates in rad/s above which a gyroz turn can start (default: 0.15)",
+)
+arg_parser.add_argument(
+    "-a",
+    "--angle",
+    type=str,
+    default="45",
+    help="comma separated heading changes in degrees that count as a turn (default: 45)",
+)
+arg_parser.add_argument(
+    "-c",
+    "--cutoff",
+    type=str,
+    default="0.01",
+    help="comma separated low-pass cutoffs, as a fraction of the Nyquist rate (default: 0.01)",
+)
+arg_parser.add_argument(
+    "--window",
+    type=float,
+    default=3.0,
+    help="with -s azimuth, seconds over which the heading change is measured (default: 3)",
+)
+arg_parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=5.0,
+    help="seconds a detected turn may be from an app marker and still count as the same turn (default: 5)",
+)
+arg_parser.add_argument(
+    "-d",
+    "--debug",
+    type=int,
+    help="debug level (0=no debugging (default), 1=debugging on)",
+)
+arg_parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=2,
+    help="how many of the next chunks to parse in the background while one is replayed (default: 2)",
+)
+instrument.add_arguments(arg_parser)
+log.add_arguments(arg_parser)
+
+
+def lowpass_sos(cutoff: float):
+    # Same elliptic design as analyze.LOWPASS, with the cutoff left open
+    return signal.ellip(3, 2, 300, cutoff, output="sos", btype="lowpass")
+
+
+class TurnDetector:
+    """
+    Single-pass turn detector fed a chunk of rows at a time. Everything that
+    has to survive a chunk boundary (filter state, the turn in progress, the
+    last few heading values) is kept on the object, so memory stays bounded
+    and feeding a ride in pieces gives exactly the same events as feeding it
+    whole.
+
+    gyroz: a turn is a run of low-passed yaw rate beyond `threshold` rad/s,
+    reported at the row where the rate integrated over the run reaches
+    `angle` degrees. Positive yaw is counter-clockwise, i.e. LEFT.
+
+    azimuth: a turn is reported where the low-passed, unwrapped azimuth has
+    moved `angle` degrees over the last `window` seconds, and nothing more is
+    reported for another `window` seconds. Azimuth grows clockwise, so a
+    positive change is RIGHT.
+    """
+
+    def __init__(
+        self,
+        source: str = "gyroz",
+        threshold: float = 0.15,
+        angle: float = 45.0,
+        cutoff: float = 0.01,
+        window: float = 3.0,
+        rate: float = LINES_PER_SECOND,
+    ):
+        if source not in ("gyroz", "azimuth"):
+            raise ValueError(f"Unknown turn signal '{source}'")
+        self.source = source
+        self.threshold = threshold
+        self.angle = angle
+        self.cutoff = cutoff
+        self.rate = rate
+        self.lag = max(1, int(round(window * rate)))
+        self.sos = lowpass_sos(cutoff)
+        self.zi = None
+        self.events = []
+        # gyroz: the run in progress
+        self.run_state = 0
+        self.run_angle = 0.0
+        self.run_reported = False
+        # azimuth: unwrapping and look-back state
+        self.last_raw = None
+        self.last_heading = 0.0
+        self.history = np.empty(0)
+        self.next_allowed = 0
+
+    def label(self) -> str:
+        if self.source == "gyroz":
+            return f"gyroz t={self.threshold:g} a={self.angle:g} c={self.cutoff:g}"
+        return f"azimuth a={self.angle:g} w={self.lag / self.rate:g}s c={self.cutoff:g}"
+
+    def feed(self, ride) -> list:
+        # Returns the (row, "LEFT"/"RIGHT") events found in this chunk; rows
+        # are file-wide. Chunks have to be fed in order.
+        if self.source not in ride or not len(ride):
+            return []
+        values = ride[self.source]
+        if self.source == "gyroz":
+            found = self._feed_gyroz(values, ride.first_row)
+        else:
+            found = self._feed_azimuth(values, ride.first_row)
+        self.events.extend(found)
+        return found
+
+    def _filter(self, values: np.ndarray, initial: float) -> np.ndarray:
+        if self.zi is None:
+            # Start the filter settled at the first value so there's no step
+            self.zi = signal.sosfilt_zi(self.sos) * initial
+        filtered, self.zi = signal.sosfilt(self.sos, values, zi=self.zi)
+        return filtered
+
+    def _feed_gyroz(self, values: np.ndarray, base: int) -> list:
+        rate = self._filter(values, 0.0)
+        state = np.zeros(len(rate), dtype=np.int8)
+        state[rate > self.threshold] = 1
+        state[rate < -self.threshold] = -1
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(state)) + 1, [len(state)]))
+        limit = np.radians(self.angle)
+        found = []
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            s = int(state[lo])
+            if s != self.run_state or lo > 0:
+                # A new run; only the first run of a chunk can continue one
+                self.run_state, self.run_angle, self.run_reported = s, 0.0, False
+            if s == 0:
+                continue
+            swept = self.run_angle + np.cumsum(rate[lo:hi]) / self.rate
+            if not self.run_reported:
+                hit = np.flatnonzero(np.abs(swept) >= limit)
+                if len(hit):
+                    found.append((base + lo + int(hit[0]), "LEFT" if s > 0 else "RIGHT"))
+                    self.run_reported = True
+            self.run_angle = float(swept[-1])
+        return found
+
+    def _feed_azimuth(self, values: np.ndarray, base: int) -> list:
+        if self.last_raw is None:
+            self.last_raw = float(values[0])
+            self.last_heading = float(values[0])
+        steps = np.diff(np.concatenate(([self.last_raw], values)))
+        heading = self.last_heading + np.cumsum((steps + 180.0) % 360.0 - 180.0)
+        self.last_raw = float(values[-1])
+        self.last_heading = float(heading[-1])
+
+        smooth = self._filter(heading, heading[0])
+        ext = np.concatenate((self.history, smooth))
+        self.history = ext[-self.lag :]
+        if len(ext) <= self.lag:
+            return []
+        change = ext[self.lag :] - ext[: -self.lag]
+        # Rows in this chunk that the look-back covers start here
+        first = base + len(smooth) - len(change)
+        candidates = np.flatnonzero(np.abs(change) >= self.angle)
+        found = []
+        k = np.searchsorted(candidates, self.next_allowed - first)
+        while k < len(candidates):
+            idx = int(candidates[k])
+            row = first + idx
+            found.append((row, "RIGHT" if change[idx] > 0 else "LEFT"))
+            self.next_allowed = row + self.lag
+            k = np.searchsorted(candidates, self.next_allowed - first)
+        return found
+
+
+def score(events: list, markers: list, tolerance: int):
+    # Greedily pair each app marker with the nearest unused detection of the
+    # same direction within `tolerance` rows. Returns the number matched.
+    matched = 0
+    used = set()
+    for row, label in markers:
+        best = None
+        for k, (erow, elabel) in enumerate(events):
+            if k in used or elabel != label or abs(erow - row) > tolerance:
+                continue
+            if best is None or abs(erow - row) < abs(events[best][0] - row):
+                best = k
+        if best is not None:
+            used.add(best)
+            matched += 1
+    return matched
+
+
+def parse_list(text: str) -> list:
+    return [float(v) for v in text.split(",") if v.strip()]
+
+
+def main():
+    args = arg_parser.parse_args()
+    instrument.configure(args)
+
+    if not args.input:
+        arg_parser.print_help()
+        exit(1)
+
+    for path in args.input:
+        if not os.path.exists(path):
+            Log.error(f"File '{path}' was inaccessible or does not exist")
+            exit(2)
+
+    debug = False
+    if args.debug:
+        if args.debug != 0 and args.debug != 1:
+            Log.warning(
+                f"Expected debug level 0 or 1, got '{args.debug}'. Defaulting to 0."
+            )
+        else:
+            debug = args.debug == 1
+    log.configure(args, debug)
+
+    try:
+        thresholds = parse_list(args.threshold) if args.signal == "gyroz" else [0.0]
+        settings = list(itertools.product(thresholds, parse_list(args.angle), parse_list(args.cutoff)))
+    except ValueError:
+        Log.error("Thresholds, angles and cutoffs should be comma separated numbers")
+        exit(1)
+
+    # Every setting is run over the same chunks, so each file is read once
+    # however many settings are being compared, and only for the one column
+    # the detectors use. Only a few chunks are in memory at once: the next
+    # ones (of this file or the next) are parsed while this one is replayed.
+    totals = {setting: [0, 0, 0] for setting in settings}
+    start = time.time()
+    chunks = read_ahead(
+        (
+            (k, ride)
+            for k, path in enumerate(args.input)
+            for ride in iter_ride(path, MIN_CHUNK, columns=[args.signal])
+        ),
+        args.prefetch,
+    )
+    for path, (_, rides) in zip(args.input, itertools.groupby(chunks, key=lambda item: item[0])):
+        detectors = {
+            setting: TurnDetector(args.signal, *setting, window=args.window) for setting in settings
+        }
+        markers = []
+        with span("detect"):
+            for _, ride in rides:
+                count("rows", len(ride))
+                for row, label in zip(ride.marker_rows.tolist(), ride.marker_labels.tolist()):
+                    if label in ("LEFT", "RIGHT"):
+                        markers.append((ride.first_row + row, label))
+                for detector in detectors.values():
+                    detector.feed(ride)
+        tolerance = int(args.tolerance * LINES_PER_SECOND)
+        for setting, detector in detectors.items():
+            for row, label in detector.events:
+                Log.trace("%s: %s at row %d (%s)", path, label, row, detector.label())
+            matched = score(detector.events, markers, tolerance)
+            totals[setting][0] += len(detector.events)
+            totals[setting][1] += len(markers)
+            totals[setting][2] += matched
+        Log.info(f"Replayed {len(settings)} setting(s) over '{path}'")
+    end = time.time()
+    Log.ok(f"Finished processing in {end-start} seconds")
+
+    Log.flush()
+    print("=" * 72)
+    print(f"{'setting':<36} {'found':>7} {'markers':>8} {'matched':>8} {'prec':>5} {'recall':>6}")
+    print("-" * 72)
+    for setting in settings:
+        found, expected, matched = totals[setting]
+        label = TurnDetector(args.signal, *setting, window=args.window).label()
+        precision = f"{matched / found:.2f}" if found else "-"
+        recall = f"{matched / expected:.2f}" if expected else "-"
+        print(f"{label:<36} {found:>7} {expected:>8} {matched:>8} {precision:>5} {recall:>6}")
+    print("=" * 72)
+
+
+if __name__ == "__main__":
+    main()